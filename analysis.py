@@ -1,29 +1,20 @@
-import csv
-import json
+import sys
 
-from venue_match import get_min_venue_from_csv
+from db_cache import open_cache
+from chain_stats import ChainStatistics
 
-csv_reader = csv.DictReader(open('min_venues.csv', 'r'))  #, 'utf-8'))
-venues = {}
-for i, v in enumerate(csv_reader):
+# statistics are kept up to date as chains are written, so this doesn't need
+# to scan the chains. 'rebuild' recalculates them from scratch first.
+stats = ChainStatistics(open_cache('fsqexp'))
+if len(sys.argv) > 1 and sys.argv[1] == 'rebuild':
+    summary = stats.rebuild()
+else:
+    summary = stats.get()
 
-    if i % 10000 == 0:
-        print(i)
+for c in summary.get('top_chains', []):
+    if c['size'] > 30:
+        print c['chain_id'], c['size'], c['name']
 
-    venue = get_min_venue_from_csv(v)
-    venues[venue['id']] = venue
-
-with open('simple_chains_with_names.json', 'r') as in_file:
-    chains = json.load(in_file)
-
-    count = 0
-    for c in chains:
-        if len(c['venues']) > 30:
-            print c['id']
-            count += 1
-            for v in c['venues']:
-                print venues[v]['name'],
-
-    print "\n"
-    print len(chains)
-    print count
+print "\n"
+print summary['chains']
+print stats.chains_larger_than(30)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Stand-ins for the Foursquare API, so VenueSearcher (and everything built
+on it) can be run and benchmarked without network access or credentials.
+
+open_api() picks the API from CHAIN_API:
+
+    live (the default)      the real API, through api.APIWrapper
+    record:<directory>      the real API, saving every response as a fixture
+    replay:<directory>      responses from recorded fixtures
+    generate:<db_name>      responses made up from the venues in a cache
+
+replay and generate can be combined (replay:fixtures+generate:fsqexp) to
+fall back to generated responses for requests that weren't recorded.
+Stand-ins can also simulate the API's behaviour, set by CHAIN_API_LATENCY
+(seconds per request), CHAIN_API_ERROR_RATE (fraction of requests that
+fail) and CHAIN_API_HOURLY_LIMIT (requests an hour before 403s).
+"""
+
+import os
+import json
+import math
+import time
+import random
+import urllib2
+import hashlib
+import threading
+
+from collections import deque
+
+from db_cache import open_cache
+from venue_view import venue_data
+
+# generated venues without a location are placed at random in this box
+# (lat, lng, size in degrees)
+DEFAULT_AREA = (51.48, -3.18, 0.1)
+
+
+def request_key(resource, identifier, params):
+    """
+    The fixture name for a request
+    """
+    return hashlib.sha1(json.dumps([resource, identifier, params], sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def _distance(lat1, lng1, lat2, lng2):
+    # metres between two points (haversine)
+    lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+
+class VenueGenerator:
+    """
+    Makes API responses from the venues in a cache: venue details for the
+    venues it holds, and searches over them by name, location and category
+    """
+
+    def __init__(self, cache, area=DEFAULT_AREA):
+
+        self.cache = cache
+        self.area = area
+        self._venues = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        from venue_searcher import raw_response
+
+        venues = {}
+        for doc in self.cache.get_documents('venues', {}):
+            venue = dict(venue_data(raw_response(doc)))
+            if not venue.get('location'):
+                # somewhere repeatable within the area
+                rng = random.Random(venue['id'])
+                lat, lng, size = self.area
+                venue['location'] = {'lat': lat + rng.uniform(-size, size), 'lng': lng + rng.uniform(-size, size)}
+            venue['categories'] = [c if isinstance(c, dict) else {'id': c} for c in venue.get('categories') or []]
+            venues[venue['id']] = venue
+        return venues
+
+    @property
+    def venues(self):
+        with self._lock:
+            if self._venues is None:
+                self._venues = self._load()
+            return self._venues
+
+    def venue(self, venue_id):
+        venue = self.venues.get(venue_id)
+        if venue is None:
+            return None
+        return {'meta': {'code': 200}, 'response': {'venue': venue}}
+
+    def search(self, params):
+        query = params.get('query', '').lower()
+        categories = set(params['categoryId'].split(',')) if params.get('categoryId') else None
+        ll = None
+        if params.get('ll'):
+            ll = [float(x) for x in params['ll'].split(',')]
+        radius = params.get('radius', 100000)
+
+        found = []
+        for venue_id in sorted(self.venues):
+            venue = self.venues[venue_id]
+            if query and query not in venue['name'].lower():
+                continue
+            if categories is not None and not categories.intersection(c['id'] for c in venue['categories']):
+                continue
+            if ll is not None and _distance(ll[0], ll[1], venue['location']['lat'], venue['location']['lng']) > radius:
+                continue
+            found.append(venue)
+            if len(found) >= params.get('limit', 50):
+                break
+        return {'meta': {'code': 200}, 'response': {'venues': found}}
+
+
+class ReplayAPI:
+    """
+    A stand-in for api.APIWrapper, answering from recorded fixtures and/or a
+    VenueGenerator, with simulated latency, errors and rate limiting
+    """
+
+    def __init__(self, fixtures=None, generator=None, latency=0.0, error_rate=0.0, hourly_limit=None, seed=0):
+
+        self.fixtures = fixtures
+        self.generator = generator
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hourly_limit = hourly_limit
+
+        self.rng = random.Random(seed)
+        self._requests = deque()
+        self._lock = threading.Lock()
+
+    def _error(self, code, message):
+        return urllib2.HTTPError('https://api.foursquare.com/v2/', code, message, None, None)
+
+    def _simulate(self):
+        with self._lock:
+            if self.hourly_limit is not None:
+                now = time.time()
+                while self._requests and self._requests[0] < now - 3600:
+                    self._requests.popleft()
+                if len(self._requests) >= self.hourly_limit:
+                    raise self._error(403, 'rate_limit_exceeded')
+                self._requests.append(now)
+            failed = self.error_rate and self.rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise self._error(500, 'server_error')
+
+    def _fixture(self, key):
+        if self.fixtures is None:
+            return None
+        path = os.path.join(self.fixtures, '%s.json' % key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)['response']
+
+    def query_routine(self, resource, routine, params, userless=False, tenacious=False):
+        self._simulate()
+        response = self._fixture(request_key(resource, routine, params))
+        if response is None and self.generator is not None and resource == 'venues' and routine == 'search':
+            response = self.generator.search(params)
+        if response is None:
+            raise self._error(404, 'not_found')
+        return response
+
+    def query_resource(self, resource, identifier, get_params=None, userless=False, tenacious=False):
+        self._simulate()
+        response = self._fixture(request_key(resource, identifier, get_params))
+        if response is None and self.generator is not None and resource == 'venues':
+            response = self.generator.venue(identifier)
+        if response is None:
+            raise self._error(404, 'not_found')
+        return response
+
+
+class RecordingAPI:
+    """
+    Wraps the real API, saving each response as a fixture for ReplayAPI
+    """
+
+    def __init__(self, wrapper, fixtures):
+
+        self.wrapper = wrapper
+        self.fixtures = fixtures
+        if not os.path.exists(fixtures):
+            os.makedirs(fixtures)
+
+    def _record(self, key, request, response):
+        if response is not None:
+            path = os.path.join(self.fixtures, '%s.json' % key)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'request': request, 'response': response}, f)
+            os.rename(path + '.tmp', path)
+        return response
+
+    def query_routine(self, resource, routine, params, userless=False, tenacious=False):
+        response = self.wrapper.query_routine(resource, routine, params, userless, tenacious)
+        return self._record(request_key(resource, routine, params), [resource, routine, params], response)
+
+    def query_resource(self, resource, identifier, get_params=None, userless=False, tenacious=False):
+        response = self.wrapper.query_resource(resource, identifier, get_params=get_params, userless=userless, tenacious=tenacious)
+        return self._record(request_key(resource, identifier, get_params), [resource, identifier, get_params], response)
+
+
+def live_api():
+    from _credentials import access_token, client_id, client_secret
+    from api import APIGateway, APIWrapper
+
+    gateway = APIGateway(access_token, 500, [client_id, client_secret], 5000)
+    return APIWrapper(gateway)
+
+
+def open_api(spec=None):
+    """
+    The API given by spec or CHAIN_API (see above)
+    """
+    spec = spec or os.environ.get('CHAIN_API') or 'live'
+
+    if spec == 'live':
+        return live_api()
+    if spec.startswith('record:'):
+        return RecordingAPI(live_api(), spec[len('record:'):])
+
+    fixtures = None
+    generator = None
+    for part in spec.split('+'):
+        if part.startswith('replay:'):
+            fixtures = part[len('replay:'):]
+        elif part.startswith('generate'):
+            generator = VenueGenerator(open_cache(part[len('generate:'):] or 'fsqexp'))
+        else:
+            raise ValueError('unknown api %s' % part)
+
+    hourly_limit = os.environ.get('CHAIN_API_HOURLY_LIMIT')
+    return ReplayAPI(fixtures, generator,
+                     latency=float(os.environ.get('CHAIN_API_LATENCY', 0)),
+                     error_rate=float(os.environ.get('CHAIN_API_ERROR_RATE', 0)),
+                     hourly_limit=int(hourly_limit) if hourly_limit else None)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Shares the Foursquare API quota between the kinds of work that use it.
+
+Every API call takes a token from a token bucket that refills at the
+gateway's hourly limit. Callers wait in a queue for their request class,
+and each free token goes to the highest priority class that is waiting
+(classes of equal priority take turns). A class can also keep a reserve:
+tokens that lower priority classes can't take, so interactive lookups
+always have some budget left however much batch work is queued.
+
+    scheduler = default_scheduler()
+    with scheduler.slot('batch'):
+        response = wrapper.query_routine(...)
+
+The scheduler only sees the calls made in this process.
+"""
+
+import time
+import threading
+
+from collections import deque
+
+import metrics
+
+# userless requests allowed per hour (as given to the APIGateway)
+HOURLY_LIMIT = 5000
+
+# class -> (priority, reserve, max_waiting). Lower priorities go first.
+REQUEST_CLASSES = {
+    'interactive': (0, 50, 1000),
+    'batch': (1, 0, 100),
+    'refresh': (2, 0, 100),
+}
+
+
+class SchedulerBusy(Exception):
+    """
+    Raised when a request class already has as many callers waiting as it
+    is allowed
+    """
+    pass
+
+
+class ApiScheduler:
+    """
+    Token bucket of capacity tokens refilling at hourly_limit an hour, given
+    out to the request classes in priority order
+    """
+
+    def __init__(self, hourly_limit=HOURLY_LIMIT, capacity=100, classes=REQUEST_CLASSES):
+
+        self.rate = hourly_limit / 3600.0
+        self.capacity = capacity
+        self.classes = classes
+
+        self._tokens = float(capacity)
+        self._updated = time.time()
+
+        self._waiting = dict((name, deque()) for name in classes)
+        self._last_served = dict((name, 0.0) for name in classes)
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserved_above(self, name):
+        # tokens held back for the classes with a higher priority than name
+        priority = self.classes[name][0]
+        return sum(reserve for p, reserve, max_waiting in self.classes.itervalues() if p < priority)
+
+    def _next(self):
+        # the class whose caller gets the next token, if there is a token
+        for name in sorted(self._waiting, key=lambda name: (self.classes[name][0], self._last_served[name])):
+            if self._waiting[name]:
+                if self._tokens >= 1 + self._reserved_above(name):
+                    return name
+                return None
+        return None
+
+    def _report(self, name):
+        metrics.set_gauge('api_queue_depth', len(self._waiting[name]), request_class=name)
+
+    def acquire(self, name, timeout=None):
+        """
+        Wait for a token for a request of the given class. Returns False if
+        timeout seconds pass first, and raises SchedulerBusy if too many
+        callers of the class are already waiting.
+        """
+        ticket = object()
+        start = time.time()
+        with self._condition:
+            waiting = self._waiting[name]
+            if len(waiting) >= self.classes[name][2]:
+                metrics.inc('api_scheduler_rejected', request_class=name)
+                raise SchedulerBusy(name)
+            waiting.append(ticket)
+            self._report(name)
+
+            try:
+                while True:
+                    self._refill()
+                    if waiting[0] is ticket and self._next() == name:
+                        waiting.popleft()
+                        self._tokens -= 1
+                        self._last_served[name] = time.time()
+                        self._report(name)
+                        metrics.record('api_wait', time.time() - start, request_class=name)
+                        # the next caller may be able to go too
+                        self._condition.notify_all()
+                        return True
+
+                    wait = max((1 + self._reserved_above(name) - self._tokens) / self.rate, 0.01)
+                    if timeout is not None:
+                        remaining = start + timeout - time.time()
+                        if remaining <= 0:
+                            waiting.remove(ticket)
+                            self._report(name)
+                            self._condition.notify_all()
+                            metrics.inc('api_scheduler_timeouts', request_class=name)
+                            return False
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            except:
+                if ticket in waiting:
+                    waiting.remove(ticket)
+                    self._report(name)
+                    self._condition.notify_all()
+                raise
+
+    def slot(self, name):
+        """
+        Context manager holding a token for the block
+        """
+        return _Slot(self, name)
+
+
+class _Slot(object):
+
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+
+    def __enter__(self):
+        self.scheduler.acquire(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    The scheduler shared by everything in this process
+    """
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = ApiScheduler()
+        return _default_scheduler
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Compiled, memory-mapped versions of the JSON reference files.
+
+Each handle -> [values] map is compiled once into a binary file of sorted
+keys with packed value lists (fb.json -> fb.json.idx). Readers mmap the
+compiled file and binary search it, so a lookup only touches the pages it
+needs, nothing is deserialised up front, and forked workers share the same
+pages through the page cache.
+
+    python assets.py            # compile (or refresh) every asset
+
+Compiled files are rebuilt automatically when their source changes (size or
+mtime differ and the content hash doesn't match).
+"""
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+
+from array import array
+
+# name -> source file of each asset
+ASSETS = {
+    'fb': 'fb.json',
+    'twitter': 'twitter.json',
+    'facebook_names': 'facebook_names.json',
+    'twitter_names': 'twitter_names.json',
+    'categories': 'categories.json',
+}
+
+MAGIC = 'CHNASST1'
+
+# magic, source size, source mtime, number of keys, md5 of source
+HEADER = struct.Struct('<8sQdI16s')
+LENGTH = struct.Struct('<H')
+
+_readers = {}
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _source_hash(source):
+    md5 = hashlib.md5()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    return md5.digest()
+
+
+def category_records(categories):
+    """
+    Flatten the category hierarchy into id -> [name, parent id, root id]
+    (parent id is '' for root categories)
+    """
+    records = {}
+
+    def walk(node, parent_id, root_id):
+        # same naming as CategoryTree
+        name = node.get('pluralName') or node['name']
+        if name == 'Homes, Work, Others':
+            name = 'Homes - Work - Others'
+        records[node['id']] = [name, parent_id, root_id]
+        for child in node.get('categories', []):
+            walk(child, node['id'], root_id)
+
+    for root in categories['categories']:
+        walk(root, '', root['id'])
+    return records
+
+
+def _load_source(source):
+    with open(source, 'r') as f:
+        data = json.load(f)
+    if os.path.basename(source) == 'categories.json':
+        return category_records(data)
+    return data
+
+
+def compile_asset(source, target=None):
+    """
+    Compile a JSON handle -> [values] map into a sorted, packed binary file.
+    Written to a temporary file and renamed into place, so readers never see
+    a half-written asset.
+    """
+    if target is None:
+        target = source + '.idx'
+
+    stat = os.stat(source)
+    digest = _source_hash(source)
+    data = _load_source(source)
+
+    items = sorted((_utf8(key), [_utf8(value) for value in values]) for key, values in data.iteritems())
+
+    offsets = array('I')
+    records = []
+    position = 0
+    for key, values in items:
+        offsets.append(position)
+        record = [LENGTH.pack(len(key)), key, LENGTH.pack(len(values))]
+        for value in values:
+            record.append(LENGTH.pack(len(value)))
+            record.append(value)
+        record = ''.join(record)
+        records.append(record)
+        position += len(record)
+    offsets.append(position)
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime, len(items), digest))
+        offsets.tofile(f)
+        for record in records:
+            f.write(record)
+    os.chmod(temp, 0644)
+    os.rename(temp, target)
+    return target
+
+
+def is_fresh(source, target):
+    """
+    Whether a compiled asset is up to date with its source. A changed size or
+    mtime falls back to comparing content hashes, and if the content is the
+    same the stored mtime is brought up to date so the hash isn't needed next
+    time (if the asset can be written: checkouts may be read-only).
+    """
+    if not os.path.exists(target):
+        return False
+    stat = os.stat(source)
+    with open(target, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+    magic, size, mtime, count, digest = HEADER.unpack(header)
+    if magic != MAGIC:
+        return False
+    if size == stat.st_size and mtime == stat.st_mtime:
+        return True
+    if size != stat.st_size or digest != _source_hash(source):
+        return False
+    try:
+        with open(target, 'r+b') as f:
+            f.write(HEADER.pack(magic, size, stat.st_mtime, count, digest))
+    except (IOError, OSError):
+        pass
+    return True
+
+
+class AssetReader:
+    """
+    Read-only lookups into a compiled asset, without loading it
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, size, mtime, self._count, digest = HEADER.unpack(self._map[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError('%s is not a compiled asset' % path)
+
+        self._offsets = HEADER.size
+        self._data = self._offsets + (self._count + 1) * 4
+
+    def _offset(self, i):
+        return self._data + struct.unpack_from('<I', self._map, self._offsets + i * 4)[0]
+
+    def _key(self, i):
+        offset = self._offset(i)
+        length, = LENGTH.unpack_from(self._map, offset)
+        return self._map[offset + 2:offset + 2 + length]
+
+    def _values(self, i):
+        offset = self._offset(i)
+        length, = LENGTH.unpack_from(self._map, offset)
+        offset += 2 + length
+        count, = LENGTH.unpack_from(self._map, offset)
+        offset += 2
+        values = []
+        for v in xrange(count):
+            length, = LENGTH.unpack_from(self._map, offset)
+            values.append(self._map[offset + 2:offset + 2 + length].decode('utf-8'))
+            offset += 2 + length
+        return values
+
+    def _find(self, key):
+        # binary search of the sorted keys
+        key = _utf8(key)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._key(lo) == key:
+            return lo
+        return None
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i is None:
+            return default
+        return self._values(i)
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return self._values(i)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        return self._count
+
+    def keys(self):
+        for i in xrange(self._count):
+            yield self._key(i).decode('utf-8')
+
+    def close(self):
+        self._map.close()
+
+
+def load_asset(name):
+    """
+    Reader for one of the ASSETS, compiling it first if it is missing or out
+    of date. Readers are shared within a process.
+    """
+    if name not in _readers:
+        source = ASSETS[name]
+        target = source + '.idx'
+        if not is_fresh(source, target):
+            compile_asset(source, target)
+        _readers[name] = AssetReader(target)
+    return _readers[name]
+
+
+class CategoryIndex:
+    """
+    Root category lookups from the compiled categories asset, for code that
+    only needs get_root_node_for_id rather than the whole CategoryTree
+    """
+
+    def __init__(self):
+        self.categories = load_asset('categories')
+
+    def get_root_node_for_id(self, foursq_id):
+        """
+        The root category ({'foursq_id', 'name'}) of a category, or None if
+        the category isn't known
+        """
+        record = self.categories.get(foursq_id)
+        if record is None:
+            return None
+        root_id = record[2]
+        return {'foursq_id': root_id, 'name': self.categories[root_id][0]}
+
+
+if __name__ == '__main__':
+
+    for name, source in sorted(ASSETS.items()):
+        target = source + '.idx'
+        if is_fresh(source, target):
+            print '%s is up to date' % target
+        else:
+            compile_asset(source, target)
+            print 'compiled %s' % target
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Times each stage of the matching pipeline on synthetic venues, against an
+in-memory cache, and stores the results as JSON so they can be compared
+across commits.
+
+    python benchmark.py                         # 10k venues, every stage
+    python benchmark.py --scale 100k --scale 1m
+    python benchmark.py --stage venue_match --stage chain_save
+
+Results are written to benchmark_results/<commit>-<scale>.json.
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import random
+import shutil
+import runpy
+import argparse
+import platform
+import tempfile
+import traceback
+import subprocess
+
+from collections import defaultdict
+from datetime import datetime
+
+from assets import ASSETS, load_asset
+from memory_cache import MemoryCache
+from synthetic_venues import SyntheticVenues, venue_document
+
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+
+RESULTS_DIR = 'benchmark_results'
+
+
+class NoChainSearcher:
+    # stands in for the Foursquare searcher: no venue claims to be a chain
+    def venue_has_chain_property(self, venue):
+        return False
+
+
+class NullOutput:
+    # swallows whatever the pipeline prints, unicode included
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class Benchmark:
+    """
+    One benchmark run over size synthetic venues. Each stage method does its
+    work and returns how many operations it did.
+    """
+
+    def __init__(self, size, seed=0, api_latency=0.0):
+
+        self.size = size
+        self.seed = seed
+        self.api_latency = api_latency
+        self.rng = random.Random(seed)
+        self.home = os.getcwd()
+
+    def setup(self):
+        # compile the reference assets here first, so they're only built once
+        for name in ASSETS:
+            load_asset(name)
+
+        # the matcher and simple_matching read min_venues.csv (and the
+        # reference files) from the working directory, so give them one
+        self.workdir = tempfile.mkdtemp(prefix='chain-benchmark-')
+        for source in ASSETS.values():
+            os.symlink(os.path.join(self.home, source), os.path.join(self.workdir, source))
+        os.chdir(self.workdir)
+
+        self.generator = SyntheticVenues(seed=self.seed)
+        self.generator.write_csv('min_venues.csv', self.size)
+        with open('min_venues.csv', 'rb') as f:
+            self.rows = [dict((k, v.decode('utf-8')) for k, v in row.iteritems()) for row in csv.DictReader(f)]
+
+        self.cache = MemoryCache()
+        venues = self.cache.db['venues']
+        for row in self.rows:
+            venues.docs[row['id']] = venue_document(row)
+
+        # the chains the generator made, by brand
+        self.brands = defaultdict(list)
+        for row in self.rows:
+            brand = self.generator.brand.get(row['id'])
+            if brand is not None:
+                self.brands[brand].append(row)
+
+    def teardown(self):
+        os.chdir(self.home)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def stage_min_venue_from_csv(self):
+        from venue_match import get_min_venue_from_csv
+        for row in self.rows:
+            get_min_venue_from_csv(row)
+        return len(self.rows)
+
+    def stage_venue_match(self):
+        from venue_match import calc_venue_match_confidence
+        pairs = min(self.size, 100000)
+        chain_rows = [rows for rows in self.brands.values() if len(rows) > 1]
+        for i in xrange(pairs):
+            # one in ten pairs are from the same chain
+            if i % 10 == 0 and chain_rows:
+                v1, v2 = self.rng.sample(self.rng.choice(chain_rows), 2)
+            else:
+                v1, v2 = self.rng.choice(self.rows), self.rng.choice(self.rows)
+            calc_venue_match_confidence(v1, v2)
+        return pairs
+
+    def _chain_documents(self):
+        from chain_manager import CachedChain
+        chains = []
+        for brand, rows in self.brands.iteritems():
+            if len(rows) > 1:
+                chain = CachedChain(self.cache)
+                for row in rows[:50]:
+                    chain.add_venue(row)
+                chains.append(chain._to_dict())
+        return chains
+
+    def stage_best_chain_match(self):
+        from chain_match import find_best_chain_match
+        chains = self._chain_documents()
+        venues = [self.rng.choice(self.rows) for i in xrange(100)]
+        for venue in venues:
+            find_best_chain_match(venue, chains)
+        return len(venues) * len(chains)
+
+    def stage_chain_save(self):
+        from chain_manager import ChainManager
+        cm = ChainManager(cache=MemoryCache())
+        # the manager's chains need the venues to be in its cache too
+        cm.cache.db.collections['venues'] = self.cache.db['venues']
+        saves = 0
+        for rows in self.brands.values():
+            if len(rows) > 1 and saves < 500:
+                chain = cm.create_chain(rows[:5])
+                for row in rows[5:10]:
+                    chain = cm.add_to_chain(chain.id, [row])
+                    saves += 1
+                saves += 1
+        return saves
+
+    def stage_simple_matching(self):
+        runpy.run_path(os.path.join(self.home, 'simple_matching.py'), run_name='benchmark')
+        return self.size
+
+    def _searcher(self):
+        # a VenueSearcher with an empty cache, whose API makes up responses
+        # from the benchmark venues, with no quota to wait for
+        from venue_searcher import VenueSearcher
+        from api_scheduler import ApiScheduler
+        from api_replay import ReplayAPI, VenueGenerator
+        api = ReplayAPI(generator=VenueGenerator(self.cache), latency=self.api_latency)
+        return VenueSearcher(api=api, cache=MemoryCache(), scheduler=ApiScheduler(hourly_limit=10 ** 12, capacity=10 ** 6))
+
+    def stage_venue_searcher(self):
+        vs = self._searcher()
+        rows = [self.rng.choice(self.rows) for i in xrange(min(self.size, 1000))]
+        # every venue twice, the first from the api and then from the cache
+        for row in rows + rows:
+            vs.get_venue_json(row['id'])
+        for row in rows[:100]:
+            vs.global_search(row['name'].split()[0])
+            vs.search_alternates(vs.get_venue_json(row['id']))
+        return len(rows) * 2 + 300
+
+    def stage_local_comparison(self):
+        from local_options import LocalComparison, DISTANCES
+        vs = self._searcher()
+        lc = LocalComparison(searcher=vs, cache=vs.cache)
+        # each alternate found is checked with is_chain, a pass over every venue
+        rows = [self.rng.choice(self.rows) for i in xrange(10)]
+        for row in rows:
+            lc.compare_venue(row['id'], DISTANCES)
+        return len(rows)
+
+    def stage_is_chain(self):
+        from chain_decision import ChainDecider
+        cd = ChainDecider(cache=MemoryCache(), searcher=NoChainSearcher())
+        cd.ccm.cache.db.collections['venues'] = self.cache.db['venues']
+        # each call makes a pass over every venue, so do fewer at scale
+        calls = max(1, 100000 // self.size)
+        for i in xrange(calls):
+            cd.is_chain(self.rng.choice(self.rows))
+        return calls
+
+    def run(self, stages):
+        """
+        Run the stages, returning {stage: {'ops', 'seconds', 'per_op_us'}}
+        (or {'error'} for a stage that couldn't run)
+        """
+        results = {}
+        self.setup()
+        try:
+            for stage in stages:
+                print '%s: %s' % (self.size, stage)
+                stdout = sys.stdout
+                try:
+                    # the pipeline prints a lot, keep it out of the report
+                    sys.stdout = NullOutput()
+                    start = time.time()
+                    ops = getattr(self, 'stage_' + stage)()
+                    seconds = time.time() - start
+                    results[stage] = {'ops': ops, 'seconds': seconds, 'per_op_us': seconds / max(ops, 1) * 1e6}
+                except Exception:
+                    results[stage] = {'error': traceback.format_exc().splitlines()[-1]}
+                finally:
+                    sys.stdout = stdout
+                print '    %s' % results[stage]
+        finally:
+            self.teardown()
+        return results
+
+
+STAGES = ['min_venue_from_csv', 'venue_match', 'best_chain_match', 'chain_save', 'simple_matching', 'is_chain',
+          'venue_searcher', 'local_comparison']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the matching pipeline on synthetic venues')
+    parser.add_argument('--scale', action='append', choices=sorted(SCALES.keys()))
+    parser.add_argument('--stage', action='append', choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to each (simulated) API request')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    if not os.path.exists(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+
+    for scale in args.scale or ['10k']:
+        stages = Benchmark(SCALES[scale], args.seed, args.api_latency).run(args.stage or STAGES)
+        result = {
+            'commit': commit,
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'scale': scale,
+            'venues': SCALES[scale],
+            'seed': args.seed,
+            'api_latency': args.api_latency,
+            'stages': stages,
+        }
+        path = os.path.join(RESULTS_DIR, '%s-%s.json' % (commit, scale))
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print 'results written to %s' % path
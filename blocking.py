@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import math
+import time
+
+from collections import defaultdict
+from Levenshtein import ratio
+
+import metrics
+
+# values that mean 'no value' rather than a shared name or handle
+NULL_KEYS = set(['', 'none', 'null', 'n/a', 'na', '-', '.', 'http:', 'https:'])
+
+
+def normalise_key(key):
+    if key is None:
+        return ''
+    return key.strip().lower()
+
+
+class BlockIndex:
+    """
+    Groups venue ids into blocks by a key (name, url, handle...), keeping
+    the key frequencies so that common keys can be recognised.
+
+    Blocks bigger than max_block_size are split by a secondary key such as
+    the url netloc or root category. Anything still too big is not used,
+    but kept in oversized for review, so no block has more than
+    max_block_size * (max_block_size - 1) / 2 pairs in it.
+    """
+
+    def __init__(self, max_block_size=100):
+
+        self.max_block_size = max_block_size
+        self.index = defaultdict(set)
+        self.venues = set()
+
+        # key -> size of the blocks that were too big to use
+        self.oversized = {}
+
+    def add(self, key, venue_id):
+        self.venues.add(venue_id)
+        key = normalise_key(key)
+        if key not in NULL_KEYS:
+            self.index[key].add(venue_id)
+
+    def frequency(self, key):
+        return len(self.index.get(normalise_key(key), ()))
+
+    def weight(self, key):
+        """
+        IDF-style weight of a key: high for keys shared by a few venues, near
+        zero for keys shared by a large fraction of them (used by
+        name_similarity to keep common names out of the fuzzy passes)
+        """
+        frequency = self.frequency(key)
+        if frequency == 0:
+            return 0.0
+        return math.log(float(len(self.venues)) / frequency)
+
+    def blocks(self, secondary=None, min_size=2):
+        """
+        Generate (key, venue ids) for every block of at least min_size venues.
+        Oversized blocks are split by secondary(venue_id), with the subkey
+        appended to the key ('home/residence').
+        """
+        self.oversized = {}
+        for key, ids in self.index.iteritems():
+            if len(ids) < min_size:
+                continue
+            if len(ids) <= self.max_block_size:
+                yield key, ids
+                continue
+            if secondary is None:
+                self.oversized[key] = len(ids)
+                continue
+
+            sub_blocks = defaultdict(set)
+            for venue_id in ids:
+                sub_key = normalise_key(secondary(venue_id))
+                # venues without a secondary key can't be placed
+                if sub_key not in NULL_KEYS:
+                    sub_blocks[sub_key].add(venue_id)
+            for sub_key, sub_ids in sub_blocks.iteritems():
+                if len(sub_ids) < min_size:
+                    continue
+                if len(sub_ids) <= self.max_block_size:
+                    yield '%s/%s' % (key, sub_key), sub_ids
+                else:
+                    self.oversized['%s/%s' % (key, sub_key)] = len(sub_ids)
+
+    def max_pairs(self):
+        # worst case number of pairwise comparisons in any block
+        return self.max_block_size * (self.max_block_size - 1) / 2
+
+
+def name_similarity(index, min_ratio=0.8, min_weight=5.0):
+    """
+    A similar(name1, name2) test for sorted_neighbourhood. Names are similar
+    if they are close ('Starbuck's'/'Starbucks'), or if one is the start of
+    the other ('Starbucks'/'Starbucks Coffee'). Identical names are left to
+    the exact name blocks, and common names ('Home'/'Homes', 'Home Depot'),
+    judged by their weight in the name index, never match.
+    """
+    def similar(name1, name2):
+        name1 = normalise_key(name1)
+        name2 = normalise_key(name2)
+        if name1 == name2 or name1 in NULL_KEYS or name2 in NULL_KEYS:
+            return False
+        if min(index.weight(name1), index.weight(name2)) < min_weight:
+            return False
+        if metrics.enabled:
+            metrics.inc('ratio_calls', caller='blocking')
+        if ratio(name1, name2) >= min_ratio:
+            return True
+        shorter, longer = sorted([name1.split(), name2.split()], key=len)
+        return longer[:len(shorter)] == shorter
+    return similar
+
+
+def name_sort_keys(name):
+    """
+    The keys a name is sorted by in each sorted-neighbourhood pass: the
+    name, the name reversed (so names that differ at the start still end up
+    near each other) and the name with its words sorted
+    """
+    name = normalise_key(name)
+    return [name, name[::-1], ' '.join(sorted(name.split()))]
+
+
+def sorted_neighbourhood(records, window, similar, passes=3):
+    """
+    Find similar pairs of (venue id, name) records without comparing every
+    pair: for each sort key the records are sorted, and each is compared
+    only with the window - 1 records that follow it. Costs
+    O(passes * N (log N + window)) comparisons.
+
+    Generates (venue id, venue id) pairs, each pair at most once.
+    """
+    keyed = [(name_sort_keys(name), venue_id, name) for venue_id, name in records]
+    found = set()
+
+    for p in xrange(passes):
+        keyed.sort(key=lambda record: record[0][p])
+        for i, (keys, venue_id, name) in enumerate(keyed):
+            for other_keys, other_id, other_name in keyed[i + 1:i + window]:
+                pair = (venue_id, other_id) if venue_id < other_id else (other_id, venue_id)
+                if pair not in found and similar(name, other_name):
+                    found.add(pair)
+                    yield pair
+
+
+def window_table(records, similar, windows=(2, 5, 10, 20, 50)):
+    """
+    Recall and runtime of sorted_neighbourhood at several window sizes,
+    against comparing every pair of records. Returns a list of (window,
+    pairs found, recall, comparisons, seconds), starting with the all pairs
+    baseline (window None).
+    """
+    comparisons = [0]
+    def counted(name1, name2):
+        comparisons[0] += 1
+        return similar(name1, name2)
+
+    start = time.time()
+    expected = set()
+    for i, (venue_id, name) in enumerate(records):
+        for other_id, other_name in records[i + 1:]:
+            if counted(name, other_name):
+                expected.add((venue_id, other_id) if venue_id < other_id else (other_id, venue_id))
+    rows = [(None, len(expected), 1.0, comparisons[0], time.time() - start)]
+
+    for window in windows:
+        comparisons[0] = 0
+        start = time.time()
+        found = set(sorted_neighbourhood(records, window, counted))
+        recall = len(found & expected) / float(len(expected)) if expected else 1.0
+        rows.append((window, len(found), recall, comparisons[0], time.time() - start))
+    return rows
+
+
+if __name__ == '__main__':
+
+    import random
+
+    from assets import load_asset
+
+    # venue names from the facebook page map, as a sample of real names
+    pages = load_asset('fb')
+    names = load_asset('facebook_names')
+    records = []
+    for page in pages.keys():
+        records.extend(zip(pages[page], names[page]))
+
+    index = BlockIndex()
+    for venue_id, name in records:
+        index.add(name, venue_id)
+
+    random.seed(0)
+    sample = random.sample(records, min(3000, len(records)))
+
+    print 'window\tpairs\trecall\tcompared\tseconds'
+    for window, pairs, recall, compared, seconds in window_table(sample, name_similarity(index)):
+        print '%s\t%d\t%.3f\t%d\t%.2f' % (window or 'all', pairs, recall, compared, seconds)
@@ -14,53 +14,115 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import csv
-import codecs
+import sys
+import Queue
+import argparse
+import threading
+import multiprocessing
+
+import metrics
 
 from urlparse import urlparse
 from decorators import venue_response
 
-from db_cache import MongoDBCache
-from chain_manager import ChainManager, CachedChain
-from category_utils import CategoryTree
+from db_cache import open_cache
+from chain_manager import ChainManager, CachedChain, CHAIN_PROPERTIES
+from assets import CategoryIndex
 
-from venue_match import calc_venue_match_confidence, get_min_venue_from_csv
+from venue_view import VenueView, as_venue_view, read_min_venues
+from venue_match import calc_venue_match_confidence
 from chain_match import calc_chain_match_confidence, find_best_chain_match
 
 
+def score_batch(task):
+    """
+    The CPU-bound part of matching a batch of venues (min_venues.csv rows),
+    run in the scoring workers of the pipelined do_matching: each venue's
+    best chain in the snapshot of chains, then, for those venues without a
+    good enough chain, the rows after its own in the csv file that match it
+    (start is the csv position of the first row).
+    Returns [(best chain id, confidence, [matching rows])] for the rows.
+    """
+    rows, chains, start, required_chain_confidence, required_venue_confidence = task
+
+    venues = [VenueView(row) for row in rows]
+    results = []
+    for venue in venues:
+        best_match, confidence = find_best_chain_match(venue, chains)
+        results.append((best_match['_id'] if best_match is not None else None, confidence, []))
+
+    fuzzy = [(start + offset, venue, matches) for offset, (venue, (chain_id, chain_confidence, matches)) in enumerate(zip(venues, results))
+             if chain_confidence < required_chain_confidence]
+    if fuzzy:
+        for count, csv_v in enumerate(read_min_venues()):
+            if count > start:
+                v = VenueView(csv_v)
+                for position, venue, matches in fuzzy:
+                    if count > position and venue.id != v.id:
+                        nd, um, sm, cm = calc_venue_match_confidence(venue, v)
+                        if sum([nd, um, sm, cm]) > required_venue_confidence:
+                            matches.append(csv_v)
+    return results
+
+
+def _put(queue, item, stop, poll=0.1):
+    # put an item on a bounded queue, giving up (returning False) once the
+    # pipeline has been stopped
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=poll)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _get(queue, stop, poll=0.1):
+    # the next item from a queue, or None once the pipeline has been stopped
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=poll)
+        except Queue.Empty:
+            pass
+    return None
+
+
 class CacheChainMatcher():
     """
     Class to match venues to chains or other venues in a cache
     """
-    def __init__(self, db_name='fsqexp', required_chain_confidence=0.9, required_venue_confidence=0.95):
+    def __init__(self, db_name='fsqexp', required_chain_confidence=0.9, required_venue_confidence=0.95, cache=None):
 
         # access to the database
-        self.cache = MongoDBCache(db=db_name)
+        if cache is None:
+            cache = open_cache(db_name)
+        self.cache = cache
 
         # read venues from file
-        self.csv_reader = csv.DictReader(codecs.open('min_venues.csv', 'r', 'utf-8'))
+        self.csv_reader = read_min_venues()
 
         # ChainManager handles chain operations
-        self.cm = ChainManager(db_name=db_name)
+        self.cm = ChainManager(db_name=db_name, cache=self.cache)
+        # in-memory venue -> chain mirror, shared with the ChainManager
+        self.lookup = self.cm.lookup
         # category tools
-        self.ct = CategoryTree()
+        self.ct = CategoryIndex()
 
         # value we use to decide if two venues should be matched together
         self.required_venue_confidence = required_venue_confidence
         # value we use to decide if a venue should be part of a chain
         self.required_chain_confidence = required_chain_confidence
 
+        # position in the csv file, venues before this have already been compared
+        self.i = 0
+
     @venue_response
     def check_chain_lookup(self, venue):
         """
         Checks for a venue lookup document to see if the venue has already
         been assigned to a chain
         """
-        chain_id = None
-        if self.cache.document_exists('chain_id_lookup', {'_id': venue['id']}):
-            chain_id = self.cache.get_document('chain_id_lookup', {'_id': venue['id']})['chain_id']
-
-        return chain_id
+        return self.lookup.get(venue.id)
 
     @venue_response
     def check_existing_chains(self, venue):
@@ -68,8 +130,8 @@ class CacheChainMatcher():
         Check all existing chains to see if this venue should be added to one of them
         """
 
-        # get all existing chains
-        chains = self.cache.get_collection('chains').find()
+        # get all existing chains, without their (possibly large) membership
+        chains = self.cache.get_documents('chains', {}, CHAIN_PROPERTIES)
         # find the best match
         best_match, confidence = find_best_chain_match(venue, chains)
 
@@ -79,36 +141,67 @@ class CacheChainMatcher():
         else:
             return None
 
-    @venue_response
-    def fuzzy_compare_to_cache(self, venue):
+    def find_venue_matches(self, venue):
+        """
+        Find the venues in the cache that are close enough to this venue to
+        be matched with it. Returns a list starting with the venue itself.
+        """
+        return self.find_venue_matches_many([venue])[0]
 
-        chain_id = None
+    def find_venue_matches_many(self, venues):
+        """
+        Find venue matches for a batch of venues with a single pass over
+        the cache, rather than one pass per venue.
+        """
 
-        venue_matches = [venue]
+        venues = [as_venue_view(venue) for venue in venues]
+        venue_matches = [[venue] for venue in venues]
 
         # look at all the other venues that haven't already been compared
         # extract information about all the venues from the database
         # v_copy = self.cache.get_collection('venues').find(timeout=False)
-        v_copy = csv.DictReader(codecs.open('min_venues.csv', 'r', 'utf-8'))
-
-        count = 0
+        v_copy = read_min_venues()
 
         print("starting at %d" % self.i)
 
-        for csv_v in v_copy:
+        rows = 0
+        with metrics.timed('csv_pass'):
+            for count, csv_v in enumerate(v_copy):
+
+                rows += 1
+                if count > self.i:
+
+                    v = VenueView(csv_v)
 
-            v = get_min_venue_from_csv(csv_v)
+                    for venue, matches in zip(venues, venue_matches):
 
-            if count > self.i:
+                        if venue.id != v.id:
 
-                if venue['id'] != v['id']:
+                            # calculate match with this venue
+                            nd, um, sm, cm = calc_venue_match_confidence(venue, v)
+                            confidence = sum([nd, um, sm, cm])
+                            if confidence > self.required_venue_confidence:
+                                matches.append(v)
+
+        metrics.inc('csv_rows', rows)
+        return venue_matches
+
+    @venue_response
+    def fuzzy_compare_to_cache(self, venue, venue_matches=None, updated_chains=None):
+        """
+        Match the venue against the rest of the cache, and create or extend
+        chains from the matches. venue_matches can be passed in if they have
+        already been found (see find_venue_matches_many). If updated_chains
+        is given, any chain created or changed is recorded in it by id.
+        """
+
+        chain_id = None
 
-                    # calculate match with this venue
-                    nd, um, sm, cm = calc_venue_match_confidence(venue, v)
-                    confidence = sum([nd, um, sm, cm])
-                    if confidence > self.required_venue_confidence:
-                        venue_matches.append(v)
-            count += 1
+        if venue_matches is None:
+            venue_matches = self.find_venue_matches(venue)
+        else:
+            # we modify the list below
+            venue_matches = list(venue_matches)
 
         # have we found any matches?
         if len(venue_matches) <= 1:
@@ -126,10 +219,14 @@ class CacheChainMatcher():
         if len(chains) == 0:
             chain = self.cm.create_chain(venue_matches)
             chain_id = chain.id
+            if updated_chains is not None:
+                updated_chains[chain.id] = chain._to_dict()
         # adding to an existing chain
         elif len(chains) == 1:
             chain_id = list(chains)[0]
             chain = self.cm.add_to_chain(chain_id, venue_matches)
+            if updated_chains is not None:
+                updated_chains[chain.id] = chain._to_dict()
         # find best match out of many chains
         else:
             candidate_chains = [self.cache.get_document('chains', {"_id": chain}) for chain in chains]
@@ -138,9 +235,32 @@ class CacheChainMatcher():
                 if confidence > self.required_chain_confidence:
                     chain_id = chain['_id']
                     chain = self.cm.add_to_chain(chain_id, [v])
+                    if updated_chains is not None:
+                        updated_chains[chain.id] = chain._to_dict()
+        return chain_id
+
+    @venue_response
+    def match_venue(self, venue):
+        """
+        Find (or create) the chain for a single venue
+        """
+        chain_id = None
+        # check if the venue is already in a chain
+        chain_id = self.check_chain_lookup(venue)
+        if chain_id is None:
+            # compare the venue against existing chains
+            chain_id = self.check_existing_chains(venue)
+            if chain_id is None:
+                # check the rest of the venues in the cache
+                chain_id = self.fuzzy_compare_to_cache(venue)
         return chain_id
 
-    def do_matching(self):
+    def do_matching(self, refresh_every=1000):
+        """
+        Match every venue in the csv file. Other processes may be matching at
+        the same time, so every refresh_every venues we pick up the chain
+        lookups they have written.
+        """
 
         # extract information about all the venues from the database
         # self.venues = self.cache.get_collection('venues').find(timeout=False)
@@ -150,24 +270,214 @@ class CacheChainMatcher():
 
             print(v)
 
-            venue = get_min_venue_from_csv(v)
+            venue = VenueView(v)
 
             print(self.i)
             
-            chain_id = None
-            # check if the venue is already in a chain
-            chain_id = self.check_chain_lookup(venue)
-            if chain_id is None:
-                # compare the venue against existing chains
-                chain_id = self.check_existing_chains(venue)
-                if chain_id is None:
-                    # check the rest of the venues in the cache
-                    chain_id = self.fuzzy_compare_to_cache(venue)
+            chain_id = self.match_venue(venue)
             self.i += 1     
+            if self.i % refresh_every == 0:
+                self.lookup.refresh()
+
+    def _read_batches(self, batch_size, batches, versions, errors, stop):
+        """
+        Reader stage: batches of csv rows, each with a snapshot of the chains
+        and the chain version the snapshot was taken at
+        """
+        try:
+            start = 0
+            rows = []
+            for row in read_min_venues():
+                rows.append(row)
+                if len(rows) == batch_size:
+                    if not self._put_batch(batches, versions, start, rows, stop):
+                        return
+                    start += len(rows)
+                    rows = []
+            if rows:
+                self._put_batch(batches, versions, start, rows, stop)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            _put(batches, None, stop)
+
+    def _put_batch(self, batches, versions, start, rows, stop):
+        with metrics.timed('pipeline', stage='read'):
+            # anything changed after this version is rescored by the decider
+            version = versions['current']
+            chains = list(self.cache.get_documents('chains', {}, CHAIN_PROPERTIES))
+        return _put(batches, (start, rows, chains, version), stop)
+
+    def _score_batches(self, batches, scored, pool, workers, errors, stop):
+        """
+        Scoring stage: hands each batch to the pool of CPU workers, split
+        across them, passing the pending results on in order
+        """
+        try:
+            while True:
+                batch = _get(batches, stop)
+                if batch is None:
+                    break
+                start, rows, chains, version = batch
+                size = max(1, -(-len(rows) // workers))
+                tasks = [(rows[i:i + size], chains, start + i, self.required_chain_confidence, self.required_venue_confidence)
+                         for i in xrange(0, len(rows), size)]
+                if pool is None:
+                    result = map(score_batch, tasks)
+                else:
+                    result = pool.map_async(score_batch, tasks)
+                if not _put(scored, (start, rows, chains, version, result), stop):
+                    break
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            _put(scored, None, stop)
+
+    def _decide(self, venue, best_id, confidence, matches, chains, changed):
+        # the same decisions as match_venue, using the scores worked out in
+        # the pipeline, and rescoring the venue against any chain that has
+        # changed since they were
+        chain_id = self.check_chain_lookup(venue)
+        if chain_id is not None:
+            return None
+
+        # the scorers only look for venue matches when no chain was good
+        # enough in the snapshot
+        scored_matches = confidence < self.required_chain_confidence
+
+        if best_id in changed:
+            best_match, confidence = find_best_chain_match(venue, chains.values())
+            best_id = best_match['_id'] if best_match is not None else None
+        else:
+            for changed_id in changed:
+                ar, uc, sc, cc = calc_chain_match_confidence(venue, chains[changed_id])
+                chain_confidence = sum([ar, uc, sc, cc])
+                if chain_confidence > confidence:
+                    best_id, confidence = changed_id, chain_confidence
+
+        if confidence >= self.required_chain_confidence:
+            chain = self.cm.add_to_chain(best_id, [venue])
+            return {best_id: chain._to_dict()}
+
+        if scored_matches:
+            venue_matches = [venue] + [VenueView(row) for row in matches]
+        else:
+            # the chain it was matched with has changed and no longer fits,
+            # so the venue matches were never looked for
+            venue_matches = self.find_venue_matches(venue)
+
+        updated = {}
+        self.fuzzy_compare_to_cache(venue, venue_matches, updated)
+        return updated
+
+    def do_matching_pipelined(self, batch_size=100, workers=None, prefetch=2, refresh_every=1000):
+        """
+        Match every venue in the csv file, as do_matching, but overlapping
+        the I/O with the scoring. A reader thread reads ahead batches of
+        venues with a snapshot of the chains, a pool of worker processes
+        scores them (chain matches and the fuzzy pass over the csv), and
+        this thread makes the decisions and writes the chains, in csv
+        order, one batch at a time. The stages are joined by queues holding
+        at most prefetch batches.
+
+        There is no separate writer stage: whether a write claims a venue's
+        lookup decides the venues that follow it, so the decisions are
+        written as they are made, each batch's writes grouped in one
+        cache.batch().
+
+        Venues are scored against chain snapshots that may be a batch or
+        two old, so every chain created or changed since a batch's snapshot
+        is rescored against its venues before deciding, and a venue placed
+        in a chain by an earlier decision is skipped.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+        # chain id -> (version, chain) for every chain we change, with the
+        # version counter the reader snapshots against
+        versions = {'current': 0}
+        changes = {}
+
+        # exceptions raised in the reader and scorer, raised again here
+        errors = []
+        # set when the pipeline is finished with, so the reader and scorer
+        # stop rather than waiting on a queue nobody is reading
+        stop = threading.Event()
+
+        batches = Queue.Queue(prefetch)
+        scored = Queue.Queue(prefetch)
+        reader = threading.Thread(target=self._read_batches, args=(batch_size, batches, versions, errors, stop))
+        scorer = threading.Thread(target=self._score_batches, args=(batches, scored, pool, max(workers, 1), errors, stop))
+        reader.daemon = scorer.daemon = True
+        reader.start()
+        scorer.start()
+
+        try:
+            while True:
+                item = _get(scored, stop)
+                if item is None:
+                    break
+                start, rows, chains, version, result = item
+                with metrics.timed('pipeline', stage='score_wait'):
+                    if pool is not None:
+                        result = result.get()
+                results = [r for part in result for r in part]
+
+                with metrics.timed('pipeline', stage='decide'):
+                    chains = dict((chain['_id'], chain) for chain in chains)
+                    changed = set()
+                    for chain_id, (changed_version, chain) in changes.iteritems():
+                        if changed_version > version:
+                            chains[chain_id] = chain
+                            changed.add(chain_id)
+
+                    with self.cache.batch():
+                        for offset, (row, (best_id, confidence, matches)) in enumerate(zip(rows, results)):
+                            self.i = start + offset
+                            updated = self._decide(VenueView(row), best_id, confidence, matches, chains, changed)
+                            if updated:
+                                versions['current'] += 1
+                                for chain_id, chain in updated.iteritems():
+                                    changes[chain_id] = (versions['current'], chain)
+                                    chains[chain_id] = chain
+                                    changed.add(chain_id)
+                            if (self.i + 1) % refresh_every == 0:
+                                self.lookup.refresh()
+
+                metrics.inc('pipeline_venues', len(rows))
+                print 'matched %d venues' % (start + len(rows))
+        finally:
+            stop.set()
+            reader.join()
+            scorer.join()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
 
 if __name__ == '__main__':
 
-    ccm = CacheChainMatcher()
-    ccm.do_matching()
+    dumper = None
+    if metrics.enabled:
+        dumper = metrics.start_dumper(60)
+
+    parser = argparse.ArgumentParser(description='Match the venues in min_venues.csv into chains')
+    parser.add_argument('--db', default='fsqexp')
+    parser.add_argument('--pipelined', action='store_true', help='overlap reading, scoring and writing')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=None, help='scoring processes (default: one per cpu)')
+    args = parser.parse_args()
+
+    ccm = CacheChainMatcher(args.db)
+    if args.pipelined:
+        ccm.do_matching_pipelined(args.batch_size, args.workers)
+    else:
+        ccm.do_matching()
+
+    if dumper is not None:
+        dumper.stop()
     
 
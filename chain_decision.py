@@ -14,9 +14,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import metrics
+
 from decorators import venue_response
-from chain_manager import ChainManager
-from category_utils import CategoryTree
+from chain_manager import ChainManager, CHAIN_PROPERTIES
+from chain_match import calc_chain_match_confidence, find_best_chain_match
+from venue_view import as_venue_view
+from assets import CategoryIndex
 from venue_searcher import VenueSearcher
 from cache_chain_matching import CacheChainMatcher
 
@@ -26,20 +30,25 @@ class ChainDecider():
     whether it belongs to a chain or not. 
     """
 
-    def __init__(self):
-        self.cm = ChainManager()
-        self.vs = VenueSearcher()
-        self.ct = CategoryTree()
-        self.ccm = CacheChainMatcher()
+    def __init__(self, db_name='fsqexp', cache=None, searcher=None, use_global=False):
+        if searcher is None:
+            searcher = VenueSearcher(db_name)
+        self.vs = searcher
+        # also compare against venues found by a global name search
+        self.use_global = use_global
+        self.ct = CategoryIndex()
+        self.ccm = CacheChainMatcher(db_name, cache=cache)
+        # share the matcher's ChainManager, so there is one chain lookup mirror
+        self.cm = self.ccm.cm
 
     @venue_response
     def is_home(self, venue):
 
         # don't include homes or residences
-        if venue.get('categories'):
-            if len(venue['categories']) > 0:
+        if venue.category_ids:
+            if len(venue.category_ids) > 0:
                 # check the first (primary) category
-                root_category = self.ct.get_root_node_for_id(venue['categories'][0]['id'])
+                root_category = self.ct.get_root_node_for_id(venue.category_ids[0])
                 # if the root exists
                 if root_category is not None:
                     # if it's not Homes and Residences
@@ -68,49 +77,181 @@ class ChainDecider():
 
         if not self.is_home(venue):
             # compare against the chains/venues in the cache
-            chain_id = self.is_chain_cached(venue)
-            #if chain_id == None:
-                # check against a global search for similar venues
-                #chain_id = self.is_chain_global(venue)
+            if self.use_global:
+                # check against a global search for similar venues, which
+                # compares the venue to the cache once they are in it
+                chain_id, stage = self._resolve_global(venue)
+            else:
+                chain_id, stage = self._resolve_cached(venue)
             if chain_id == None and self.vs.venue_has_chain_property(venue):
                 # if foursquare insist it's a chain, create a new chain
                 chain = self.cm.create_chain([venue])
                 chain_id = chain.id
+                stage = 'chain_property'
+        else:
+            stage = 'home'
+
+        # each venue is counted once, at the stage that resolved it
+        metrics.inc('venues_resolved', stage=stage)
 
         return chain_id
 
+    def is_chain_many(self, venues, chain_property=True, count=True):
+        """
+        Find out which chains a batch of venues belong to. Returns a list of
+        chain ids (or None) in the same order as the venues, the same as
+        calling is_chain on each venue in turn, but with a single pass over
+        the chains collection and a single fuzzy pass over the cache.
+        Without chain_property, venues are only compared to the cache (as in
+        is_chain_cached), and no chains are made for venues that Foursquare
+        says are chains. Without count, the venues aren't counted in the
+        venues_resolved metric.
+        """
+
+        # just need the venue data, not the whole API response
+        venues = [as_venue_view(v) for v in venues]
+
+        chain_ids = [None] * len(venues)
+
+        # don't include homes or residences
+        candidates = [i for i, venue in enumerate(venues) if not self.is_home(venue)]
+
+        # lookups are answered from memory, so venues already in a chain
+        # can be skipped without any I/O
+        unassigned = [i for i in candidates if self.ccm.check_chain_lookup(venues[i]) is None]
+
+        # score every unassigned venue against the chains in one pass
+        chains = {}
+        best_matches = dict((i, (None, 0.0)) for i in unassigned)
+        for chain in self.ccm.cache.get_documents('chains', {}, CHAIN_PROPERTIES):
+            chains[chain['_id']] = chain
+            for i in unassigned:
+                ar, uc, sc, cc = calc_chain_match_confidence(venues[i], chain)
+                confidence = sum([ar, uc, sc, cc])
+                if confidence > best_matches[i][1]:
+                    best_matches[i] = (chain['_id'], confidence)
+
+        # venues that won't be placed in an existing chain need the fuzzy
+        # comparison, do all of them together in one pass over the cache
+        fuzzy = [i for i in unassigned if best_matches[i][1] < self.ccm.required_chain_confidence]
+        venue_matches = dict(zip(fuzzy, self.ccm.find_venue_matches_many([venues[i] for i in fuzzy])))
+
+        # chains created or modified while working through the batch
+        changed = set()
+
+        # now make the decisions in order, so earlier venues can create or
+        # extend chains that later venues are then matched against
+        for i in candidates:
+            venue = venues[i]
+
+            chain_id = self.ccm.check_chain_lookup(venue)
+            stage = 'lookup'
+            if chain_id is None:
+                best_id, confidence = self._best_chain_match(i, venue, best_matches, chains, changed)
+                if confidence >= self.ccm.required_chain_confidence:
+                    chain = self.cm.add_to_chain(best_id, [venue])
+                    chains[best_id] = chain._to_dict()
+                    changed.add(best_id)
+                    chain_id = best_id
+                    stage = 'existing_chains'
+                else:
+                    matches = venue_matches.get(i)
+                    updated = {}
+                    chain_id = self.ccm.fuzzy_compare_to_cache(venue, matches, updated)
+                    chains.update(updated)
+                    changed.update(updated)
+                    stage = 'fuzzy' if chain_id is not None else 'unresolved'
+
+            if chain_id == None and chain_property and self.vs.venue_has_chain_property(venue):
+                # if foursquare insist it's a chain, create a new chain
+                chain = self.cm.create_chain([venue])
+                chain_id = chain.id
+                chains[chain.id] = chain._to_dict()
+                changed.add(chain.id)
+                stage = 'chain_property'
+
+            if count:
+                metrics.inc('venues_resolved', stage=stage)
+
+            chain_ids[i] = chain_id
+
+        return chain_ids
+
+    def _best_chain_match(self, i, venue, best_matches, chains, changed):
+        # best chain match for a venue, reusing its score from the batch
+        # pass for every chain that hasn't changed since then
+        if i not in best_matches or best_matches[i][0] in changed:
+            best_match, confidence = find_best_chain_match(venue, chains.values())
+            if best_match is None:
+                return None, confidence
+            return best_match['_id'], confidence
+
+        best_id, confidence = best_matches[i]
+        for chain_id in changed:
+            ar, uc, sc, cc = calc_chain_match_confidence(venue, chains[chain_id])
+            chain_confidence = sum([ar, uc, sc, cc])
+            if chain_confidence > confidence:
+                best_id, confidence = chain_id, chain_confidence
+        return best_id, confidence
+
     @venue_response
-    def is_chain_global(self, venue):      
+    def is_chain_global(self, venue):
+
+        chain_id, stage = self._resolve_global(venue)
+        metrics.inc('venues_resolved', stage=stage)
+        return chain_id
+
+    def _resolve_global(self, venue):
+        # the global search costs API calls and a pass over the cache for
+        # the venues found, so first try the cheap checks; the venue's own
+        # fuzzy pass over the cache is made once, after the search
+        chain_id, stage = self._resolve_cached(venue, fuzzy=False)
+        if chain_id is not None:
+            return chain_id, stage
 
         # search for venues with similar names
-        global_venues = self.vs.global_search(venue['name'])
+        global_venues = self.vs.global_search(venue.name) or []
 
-        # go through all the returned venues and see if 
-        # any of them belong to a chain
-        for v in global_venues:
-            # need to work with full response
-            v = self.vs.get_venue_json(v['id'])
-            if not self.is_home(v):
-                chain_id = self.is_chain_cached(v)
+        # need to work with the full venues: fetch them all together, from
+        # the cache where possible and the API in parallel for the rest
+        ids = [v['id'] for v in global_venues if v['id'] != venue.id]
+        found = [v for v in self.vs.get_venue_jsons(ids) if v is not None]
 
-        # now can compare the venue to the cache
-        return self.is_chain_cached(venue)
+        # place them in the cache's chains as one batch (is_chain_many
+        # skips homes), so the venue can be compared with them. They are
+        # not the venues being resolved, so they aren't counted
+        self.is_chain_many(found, chain_property=False, count=False)
 
+        # now can compare the venue to the cache
+        return self._resolve_cached(venue)
 
     @venue_response
-    def is_chain_cached(self, venue):       
+    def is_chain_cached(self, venue):
 
-        chain_id = None
+        chain_id, stage = self._resolve_cached(venue)
+        metrics.inc('venues_resolved', stage=stage)
+        return chain_id
+
+    def _resolve_cached(self, venue, fuzzy=True):
+        # the chain the venue belongs to (or None) and the stage that
+        # decided it, without counting it in venues_resolved. Without
+        # fuzzy, only the lookup and the existing chains are checked
 
         # check if the venue is already in a chain
         chain_id = self.ccm.check_chain_lookup(venue)
+        stage = 'lookup'
         if chain_id == None:
             # compare the venue against existing chains
             chain_id = self.ccm.check_existing_chains(venue)
+            stage = 'existing_chains'
             if chain_id == None:
-                # check the rest of the venues in the cache
-                chain_id = self.ccm.fuzzy_compare_to_cache(venue)
-        return chain_id
+                stage = 'unresolved'
+                if fuzzy:
+                    # check the rest of the venues in the cache
+                    chain_id = self.ccm.fuzzy_compare_to_cache(venue)
+                    if chain_id is not None:
+                        stage = 'fuzzy'
+        return chain_id, stage
 
 if __name__ == "__main__":
 
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import random
+import struct
+import hashlib
+import argparse
+
+from collections import defaultdict
+from urlparse import urlparse
+
+from chain_manager import ChainManager, CHAIN_PROPERTIES, load_venues
+from chain_match import calc_chain_match_confidence
+
+# a Mersenne prime bigger than any token hash, for the permutations
+_PRIME = (1 << 61) - 1
+
+
+def chain_tokens(chain):
+    """
+    The tokens a chain is compared on: 3 letter shingles of its names, plus
+    its url hosts and social media handles as whole tokens
+    """
+    tokens = set()
+    for name in chain.get('names', []):
+        name = ' %s ' % re.sub(r'\s+', ' ', name.lower().strip())
+        for i in xrange(len(name) - 2):
+            tokens.add(u'n:' + name[i:i + 3])
+    for url in chain.get('urls', []):
+        netloc = urlparse(url).netloc or url
+        if netloc.startswith('www.'):
+            netloc = netloc[4:]
+        if netloc:
+            tokens.add(u'u:' + netloc.lower())
+    for handle in chain.get('twitter', []):
+        tokens.add(u't:' + handle.lower())
+    for page in chain.get('facebook', []):
+        tokens.add(u'f:' + page.lower())
+    return tokens
+
+
+def _token_hash(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(token).digest()[:8])[0] % _PRIME
+
+
+class MinHasher:
+    """
+    MinHash signatures: the minimum of num_perm random permutations of the
+    token hashes. The fraction of positions two signatures agree on
+    estimates the Jaccard similarity of their token sets.
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+
+        self.num_perm = num_perm
+        rng = random.Random(seed)
+        self.permutations = [(rng.randint(1, _PRIME - 1), rng.randint(0, _PRIME - 1)) for i in xrange(num_perm)]
+
+    def signature(self, tokens):
+        hashes = [_token_hash(token) for token in tokens]
+        if not hashes:
+            return None
+        return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in self.permutations)
+
+
+class LSHIndex:
+    """
+    Locality sensitive hashing over MinHash signatures. Signatures are split
+    into bands of rows; chains that agree on every row of any band land in
+    the same bucket and become candidate pairs. With b bands of r rows, pairs
+    with Jaccard similarity s are proposed with probability 1 - (1 - s^r)^b.
+
+    Buckets bigger than max_bucket (e.g. shingles every chain shares) are
+    ignored, so the number of pairs stays near-linear.
+    """
+
+    def __init__(self, bands=16, rows=4, max_bucket=50):
+
+        self.bands = bands
+        self.rows = rows
+        self.max_bucket = max_bucket
+        self.buckets = defaultdict(list)
+
+    def add(self, key, signature):
+        for band in xrange(self.bands):
+            start = band * self.rows
+            self.buckets[(band, signature[start:start + self.rows])].append(key)
+
+    def candidates(self):
+        """
+        Set of candidate (key, key) pairs, smaller key first
+        """
+        pairs = set()
+        for keys in self.buckets.itervalues():
+            if len(keys) < 2 or len(keys) > self.max_bucket:
+                continue
+            keys = sorted(keys)
+            for i, key in enumerate(keys):
+                for other in keys[i + 1:]:
+                    pairs.add((key, other))
+        return pairs
+
+
+class ChainDeduplicator:
+    """
+    Finds chains that are really the same chain (created separately before
+    the matcher saw they were related), and optionally merges them.
+
+    Candidate pairs come from an LSH index over every chain's names, urls and
+    handles; each candidate is then checked by scoring a sample of one
+    chain's venues against the other with calc_chain_match_confidence.
+    """
+
+    def __init__(self, db_name='fsqexp', required_confidence=0.9, sample_size=10, bands=16, rows=4):
+
+        self.cm = ChainManager(db_name=db_name)
+        self.cache = self.cm.cache
+
+        self.required_confidence = required_confidence
+        # number of venues of the smaller chain scored against the bigger one
+        self.sample_size = sample_size
+
+        self.hasher = MinHasher(bands * rows)
+        self.bands = bands
+        self.rows = rows
+
+    def candidate_pairs(self):
+        """
+        Candidate duplicate pairs, and the properties of every chain in them
+        """
+        index = LSHIndex(self.bands, self.rows)
+        chains = {}
+        for chain in self.cache.get_documents('chains', {}, CHAIN_PROPERTIES):
+            signature = self.hasher.signature(chain_tokens(chain))
+            if signature is not None:
+                index.add(chain['_id'], signature)
+                chains[chain['_id']] = chain
+        pairs = index.candidates()
+
+        # only keep the chains we need to verify pairs
+        wanted = set()
+        for pair in pairs:
+            wanted.update(pair)
+        return pairs, dict((chain_id, chains[chain_id]) for chain_id in wanted)
+
+    def sample_members(self, chain_id):
+        lookups = self.cache.get_documents('chain_id_lookup', {'chain_id': chain_id}, {'_id': True}).limit(self.sample_size)
+        return load_venues(self.cache, [lookup['_id'] for lookup in lookups])
+
+    def verify(self, chain1, chain2):
+        """
+        Confidence that two chains are the same: the average confidence of a
+        sample of the smaller chain's venues matching the bigger chain
+        """
+        if chain1.get('size', 0) > chain2.get('size', 0):
+            chain1, chain2 = chain2, chain1
+        venues = self.sample_members(chain1['_id'])
+        if not venues:
+            return 0.0
+        total = 0.0
+        for venue in venues:
+            total += sum(calc_chain_match_confidence(venue, chain2))
+        return total / len(venues)
+
+    def duplicate_groups(self):
+        """
+        Groups of chain ids that are all the same chain (duplicate pairs that
+        share a chain are joined into one group)
+        """
+        pairs, chains = self.candidate_pairs()
+
+        parent = {}
+        def find(chain_id):
+            while parent.setdefault(chain_id, chain_id) != chain_id:
+                parent[chain_id] = parent[parent[chain_id]]
+                chain_id = parent[chain_id]
+            return chain_id
+
+        for chain1, chain2 in pairs:
+            if find(chain1) == find(chain2):
+                continue
+            if self.verify(chains[chain1], chains[chain2]) >= self.required_confidence:
+                parent[find(chain2)] = find(chain1)
+
+        groups = defaultdict(list)
+        for chain_id in parent:
+            groups[find(chain_id)].append(chain_id)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def run(self, merge=False):
+        """
+        Find duplicate chains, merging each group into one chain if merge is
+        set. Returns the groups found.
+        """
+        groups = self.duplicate_groups()
+        if merge:
+            for group in groups:
+                self.cm.merge_chain_ids(group)
+        return groups
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Find (and merge) duplicate chains')
+    parser.add_argument('--db', default='fsqexp')
+    parser.add_argument('--merge', action='store_true', help='merge the duplicates found')
+    parser.add_argument('--confidence', type=float, default=0.9)
+    args = parser.parse_args()
+
+    cd = ChainDeduplicator(db_name=args.db, required_confidence=args.confidence)
+    groups = cd.run(merge=args.merge)
+    for group in groups:
+        print ', '.join(group)
+    print '%d groups of duplicate chains, %d chains' % (len(groups), sum(len(group) for group in groups))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import calendar
+
+from datetime import datetime
+
+# venue id -> how many times the venue's lookup has been removed, and when
+# it last was. Lets mirrors in other processes drop removed lookups, and
+# gives a chain made again from a venue a different id (see
+# chain_manager.new_chain_id).
+REMOVALS = 'chain_id_removals'
+
+
+def remove_lookups(cache, query):
+    """
+    Remove the lookups matching the query, leaving a tombstone in REMOVALS
+    for each one. Returns the ids of the venues whose lookups were removed.
+    """
+    venue_ids = [lookup['_id'] for lookup in cache.get_documents('chain_id_lookup', query, {'_id': True})]
+    if not venue_ids:
+        return []
+    if '_id' not in query:
+        # only what we've read, so nothing goes without a tombstone
+        query = dict(query, _id={'$in': venue_ids})
+    cache.remove_documents('chain_id_lookup', query)
+    cache.bulk_update(REMOVALS, [({'_id': venue_id}, {'$inc': {'removals': 1}}) for venue_id in venue_ids], upsert=True)
+    return venue_ids
+
+
+def removal_counts(cache, venue_ids):
+    """
+    How many times each venue's lookup has been removed (venues never removed
+    are left out)
+    """
+    counts = {}
+    for removal in cache.get_documents(REMOVALS, {'_id': {'$in': list(venue_ids)}}, {'removals': True}):
+        counts[removal['_id']] = removal.get('removals', 0)
+    return counts
+
+
+class ChainLookup:
+    """
+    In-memory mirror of the chain_id_lookup collection (venue id -> chain id).
+
+    The mirror is warm loaded from the cache once, and kept up to date by
+    CachedChain whenever lookups are written or removed. Lookups written or
+    removed by other processes are picked up by refresh(). Once loaded, the common 'not
+    in a chain' answer never needs a database round trip.
+    """
+
+    def __init__(self, cache):
+
+        self.cache = cache
+        self.chain_ids = {}
+
+        self.load()
+
+    def load(self):
+        # pull every lookup, but only the field we need
+        self.loaded_at = calendar.timegm(datetime.utcnow().utctimetuple())
+        self.chain_ids = {}
+        for lookup in self.cache.get_documents('chain_id_lookup', {}, {'chain_id': True}):
+            self.chain_ids[lookup['_id']] = lookup['chain_id']
+
+    def refresh(self, slack=5):
+        """
+        Pick up lookups written or removed by other processes since we last
+        loaded or refreshed. slack (seconds) allows for clock skew between
+        hosts.
+        """
+        since = self.loaded_at - slack
+        self.loaded_at = calendar.timegm(datetime.utcnow().utctimetuple())
+        query = {'last_modified': {'$gte': since}}
+
+        written = set()
+        for lookup in self.cache.get_documents('chain_id_lookup', query, {'chain_id': True}):
+            self.set(lookup['_id'], lookup['chain_id'])
+            written.add(lookup['_id'])
+
+        # removed since, unless written again afterwards
+        for removal in self.cache.get_documents(REMOVALS, query, {'_id': True}):
+            if removal['_id'] not in written:
+                self.remove(removal['_id'])
+
+    def get(self, venue_id):
+        """
+        Returns the id of the chain the venue belongs to, or None
+        """
+        return self.chain_ids.get(venue_id)
+
+    def __contains__(self, venue_id):
+        return self.get(venue_id) is not None
+
+    def __len__(self):
+        return len(self.chain_ids)
+
+    def set(self, venue_id, chain_id):
+        """
+        Record that a venue now belongs to a chain
+        """
+        self.chain_ids[venue_id] = chain_id
+
+    def remove(self, venue_id):
+        """
+        Record that a venue no longer belongs to a chain
+        """
+        self.chain_ids.pop(venue_id, None)
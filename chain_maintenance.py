@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import uuid
+import multiprocessing
+
+from collections import Counter
+
+from db_cache import open_cache
+from chain_stats import ChainStatistics
+from chain_lookup import remove_lookups
+from chain_manager import PROPERTY_FIELDS, load_venues, rescore_members, venue_properties
+
+# each worker process has its own connection to the cache
+_cache = None
+
+def _init_worker(db_name):
+    global _cache
+    _cache = open_cache(db_name, shared=True)
+
+
+def rescore_chain(job):
+    """
+    Rescore every member of one chain against the rest of the chain, and
+    work out what to remove. Runs in a worker process.
+
+    Returns the chain id, whether its membership is spilled into the
+    lookups, the version of the chain that was scored, the confidences of
+    the venues being kept, the venues being removed, the property values
+    that only the removed venues provided, and the categories of the
+    removed venues.
+    """
+    chain_id, venue_ids, spilled, version, required_confidence = job
+
+    venues = load_venues(_cache, venue_ids)
+    confidences = rescore_members(venues)
+
+    # members whose venue can't be found can't be scored, so go too
+    removed = set(venue_ids) - set(confidences)
+    for venue, confidence in confidences.items():
+        if confidence < required_confidence:
+            removed.add(venue)
+            del confidences[venue]
+
+    # property values that no remaining member provides
+    pulled = {}
+    categories = []
+    if removed:
+        remaining = dict((field, Counter()) for field in PROPERTY_FIELDS)
+        for venue in venues:
+            if venue.id not in removed:
+                for field in PROPERTY_FIELDS:
+                    remaining[field].update(venue_properties(venue, field))
+        for venue in venues:
+            if venue.id in removed:
+                if venue.category_ids:
+                    categories.append(venue.category_ids[0])
+                for field in PROPERTY_FIELDS:
+                    for value in venue_properties(venue, field):
+                        if value not in remaining[field]:
+                            pulled.setdefault(field, set()).add(value)
+
+    return chain_id, spilled, version, confidences, list(removed), dict((field, list(values)) for field, values in pulled.iteritems()), categories
+
+
+class ChainMaintenance:
+    """
+    Re-validates every chain in the cache: each member venue is rescored
+    against the rest of its chain, venues below required_confidence are
+    removed, and the new confidences are written back, all in bulk.
+    Chains are streamed from the cache and scored in a pool of processes.
+
+    A chain is only written back if it is still at the version that was
+    scored; chains changed in the meantime are scored again.
+    """
+
+    # how many times to rescore chains that changed while being scored
+    max_retries = 10
+
+    def __init__(self, db_name='fsqexp', required_confidence=0.9, processes=None, batch_size=100):
+
+        self.db_name = db_name
+        self.cache = open_cache(db_name, shared=True)
+        self.stats = ChainStatistics(self.cache)
+
+        self.required_confidence = required_confidence
+        self.processes = processes or multiprocessing.cpu_count()
+        # number of chains to collect before writing back
+        self.batch_size = batch_size
+
+    def chain_jobs(self, query=None):
+        # stream the chains, with just their membership and version
+        for chain in self.cache.get_documents('chains', query or {}, {'venues': True, 'spilled': True, 'version': True}):
+            if chain.get('spilled'):
+                # membership of big chains lives in chain_id_lookup
+                lookups = self.cache.get_documents('chain_id_lookup', {'chain_id': chain['_id']}, {'_id': True})
+                venue_ids = [lookup['_id'] for lookup in lookups]
+            else:
+                venue_ids = chain.get('venues', [])
+            yield chain['_id'], venue_ids, chain.get('spilled', False), chain.get('version', 0), self.required_confidence
+
+    def write_results(self, results):
+        """
+        Write back a batch of rescored chains: one bulk update for the chains
+        (and one remove for those left empty), one for the lookups, and one
+        remove for the lookups of removed venues. Each chain is only written
+        if it is still at the version that was scored. Returns the ids of
+        the chains that had changed, and so weren't written.
+        """
+        # marks the chains this batch updated, as a bulk update only says
+        # how many of them matched
+        token = uuid.uuid4().hex
+        chain_updates = []
+        emptied = []
+
+        for chain_id, spilled, version, confidences, removed, pulled, categories in results:
+            # (a missing version matches None, for chains saved before versioning)
+            query = {'_id': chain_id, 'version': version if version else {'$in': [0, None]}}
+            if not confidences:
+                # nothing left in the chain
+                emptied.append(query)
+                continue
+            update = {'$set': {'maintained': token}, '$inc': {'version': 1}}
+            if not spilled:
+                # spilled chains only hold confidences in their lookups
+                for venue, confidence in confidences.iteritems():
+                    update['$set']['confidences.%s' % venue] = confidence
+            if removed:
+                update['$pull'] = {}
+                if not spilled:
+                    update['$pull']['venues'] = {'$in': removed}
+                    update['$unset'] = dict(('confidences.%s' % venue, '') for venue in removed)
+                for field, values in pulled.iteritems():
+                    update['$pull'][field] = {'$in': values}
+                if not update['$pull']:
+                    del update['$pull']
+                update['$inc']['size'] = -len(removed)
+            chain_updates.append((query, update))
+
+        with self.cache.batch():
+            changed = set()
+            if chain_updates and self.cache.bulk_update('chains', chain_updates) < len(chain_updates):
+                changed.update(query['_id'] for query, update in chain_updates)
+                updated = self.cache.get_documents('chains', {'_id': {'$in': list(changed)}, 'maintained': token}, {'_id': True})
+                changed.difference_update(chain['_id'] for chain in updated)
+            if emptied:
+                self.cache.remove_documents('chains', {'$or': emptied})
+                # any still there had changed
+                kept = self.cache.get_documents('chains', {'_id': {'$in': [query['_id'] for query in emptied]}}, {'_id': True})
+                changed.update(chain['_id'] for chain in kept)
+
+            # only the lookups of the chains written are brought into line
+            lookup_updates = []
+            removed_lookups = []
+            for chain_id, spilled, version, confidences, removed, pulled, categories in results:
+                if chain_id in changed:
+                    continue
+                for venue, confidence in confidences.iteritems():
+                    lookup_updates.append(({'_id': venue, 'chain_id': chain_id}, {'$set': {'confidence': confidence}}))
+                if removed:
+                    removed_lookups.append({'chain_id': chain_id, '_id': {'$in': removed}})
+            self.cache.bulk_update('chain_id_lookup', lookup_updates)
+            if removed_lookups:
+                remove_lookups(self.cache, {'$or': removed_lookups})
+
+            for chain_id, spilled, version, confidences, removed, pulled, categories in results:
+                if removed and chain_id not in changed:
+                    size = len(confidences) + len(removed)
+                    self.stats.record_resize(chain_id, size, size - len(removed))
+                    self.stats.record_categories(categories, -1)
+
+        return list(changed)
+
+    def run(self):
+        """
+        Rescore and prune every chain. Returns the number of chains processed
+        and venues removed.
+        """
+        pool = multiprocessing.Pool(self.processes, _init_worker, (self.db_name,))
+
+        counts = {'chains': 0, 'removed': 0}
+        def write(results, retry):
+            changed = set(self.write_results(results))
+            retry.extend(changed)
+            for result in results:
+                if result[0] not in changed:
+                    counts['chains'] += 1
+                    counts['removed'] += len(result[4])
+
+        try:
+            jobs = self.chain_jobs()
+            for attempt in xrange(self.max_retries):
+                retry = []
+                results = []
+                for result in pool.imap_unordered(rescore_chain, jobs, chunksize=8):
+                    results.append(result)
+                    if len(results) >= self.batch_size:
+                        write(results, retry)
+                        results = []
+                        print '%d chains, %d venues removed' % (counts['chains'], counts['removed'])
+                if results:
+                    write(results, retry)
+                if not retry:
+                    break
+                # score the chains that changed again, from their new versions
+                jobs = self.chain_jobs({'_id': {'$in': retry}})
+            else:
+                print '%d chains kept changing, and were left' % len(retry)
+        finally:
+            pool.close()
+            pool.join()
+
+        return counts['chains'], counts['removed']
+
+
+if __name__ == '__main__':
+
+    cm = ChainMaintenance()
+    chains, removed = cm.run()
+    print '%d chains checked, %d venues removed' % (chains, removed)
@@ -15,40 +15,209 @@
 #   limitations under the License.
 
 import uuid
+import hashlib
 
-from urlparse import urlparse
-from db_cache import MongoDBCache
+from collections import Counter
+
+from db_cache import open_cache, DuplicateDocumentError
+from chain_lookup import ChainLookup, REMOVALS, remove_lookups, removal_counts
+from chain_stats import ChainStatistics
+from compact import InternedSet, VenueIdSet, ConfidenceMap
 from decorators import venue_response
 from chain_match import calc_chain_match_confidence
-from venue_match import get_min_venue_from_db
+from venue_view import VenueView, as_venue_view, venue_projection
+
+# the set-valued properties of a chain (other than its venues)
+PROPERTY_FIELDS = ['names', 'categories', 'urls', 'twitter', 'facebook']
+
+# projection for reading a chain without its membership
+CHAIN_PROPERTIES = {'venues': False, 'confidences': False}
 
-class CachedChain:
+
+class ChainConflictError(Exception):
+    """
+    Raised when a chain can't be saved because other processes keep
+    changing it underneath us
+    """
+    pass
+
+
+class PartialChainError(Exception):
+    """
+    Raised when a chain loaded without its membership is asked to do
+    something that needs every member
     """
-    Python representation of a Chain object to be stored in a Cache
+    pass
+
+
+def venue_properties(venue, field):
+    """
+    The values a venue contributes to one of the chain properties
+    """
+    if field == 'names':
+        return [venue.name]
+    if field == 'urls':
+        return [venue.url] if venue.url else []
+    if field == 'twitter':
+        return [venue.twitter] if venue.twitter else []
+    if field == 'facebook':
+        return [venue.facebook] if venue.facebook else []
+    return []
+
+
+def load_venues(cache, venue_ids):
+    """
+    Fetch the matching fields of many venues in a single query, as VenueViews
+    """
+    venues = []
+    for venue in cache.get_documents('venues', {'_id': {'$in': list(venue_ids)}}, venue_projection()):
+        venues.append(VenueView(venue))
+    return venues
+
+
+def read_chain(cache, chain_id):
     """
+    The stored chain document with its membership (read from the lookups
+    for a spilled chain), or None if there isn't one with this id
+    """
+    chain = cache.get_fresh_document('chains', {'_id': chain_id})
+    if chain is not None and chain.get('spilled'):
+        # membership of big chains lives in chain_id_lookup
+        chain['venues'] = []
+        chain['confidences'] = {}
+        for lookup in cache.get_documents('chain_id_lookup', {'chain_id': chain_id}, {'confidence': True}):
+            chain['venues'].append(lookup['_id'])
+            chain['confidences'][lookup['_id']] = lookup['confidence']
+    return chain
+
+
+def rescore_members(venues):
+    """
+    Work out the confidence that each venue belongs to the chain made up of
+    all the other venues. The chain's properties are counted once, and each
+    venue is scored against them with its own contribution taken out, rather
+    than rebuilding the chain without it.
+    """
+    counts = dict((field, Counter()) for field in PROPERTY_FIELDS)
+    for venue in venues:
+        for field in PROPERTY_FIELDS:
+            counts[field].update(set(venue_properties(venue, field)))
+
+    confidences = {}
+    for venue in venues:
+        chain = {}
+        for field in PROPERTY_FIELDS:
+            own = venue_properties(venue, field)
+            chain[field] = [value for value, count in counts[field].iteritems() if count > 1 or value not in own]
+        nd, um, sm, cm = calc_chain_match_confidence(venue, chain)
+        confidences[venue.id] = sum([nd, um, sm, cm])
+    return confidences
+
+
+def cluster_chain_id(venue_ids, removals=0):
+    """
+    Chain id for a new chain made from a cluster of venues. Derived from the
+    cluster rather than random, so two processes creating a chain for the
+    same cluster create the same chain, and their saves merge. removals is
+    the number of times the cluster's seed venue has been removed from a
+    chain, so a chain made again after a delete or prune gets a new id.
+    """
+    seed = min(venue_ids)
+    if isinstance(seed, unicode):
+        seed = seed.encode('utf-8')
+    if removals:
+        return hashlib.md5('chain:%s:%d' % (seed, removals)).hexdigest()
+    return hashlib.md5('chain:%s' % seed).hexdigest()
+
+
+def new_chain_id(cache, venue_ids):
+    """
+    cluster_chain_id for a cluster, with its seed's removals from the cache
+    """
+    seed = min(venue_ids)
+    return cluster_chain_id(venue_ids, removal_counts(cache, [seed]).get(seed, 0))
+
+class CachedChain(object):
+    """
+    Python representation of a Chain object to be stored in a Cache.
+
+    Held compactly in memory: venue ids are packed into a sorted binary
+    buffer with their confidences alongside, and names, urls and handles
+    are interned (see compact.py).
+
+    Saving only sends what has changed since the chain was loaded, and once
+    a chain grows past spill_size its membership is held only in the
+    chain_id_lookup collection rather than in the chain document.
+    """
+
+    __slots__ = ('id', 'venues', 'names', 'categories', 'urls', 'twitter', 'facebook', 'cache', 'lookup',
+                 'stats', 'size', 'spilled', 'version', 'partial', '_pending')
+
+    # chains bigger than this keep their membership out of the chain document
+    spill_size = 1000
 
-    def __init__(self, cache):
+    # how many times to retry a save that lost a race with another process
+    max_retries = 10
 
-        # initialise with a unique ID
-        self.id = uuid.uuid4().hex
+    def __init__(self, cache, lookup=None, chain_id=None, stats=None):
+
+        # initialise with a unique ID, unless we're given one
+        if chain_id is None:
+            chain_id = uuid.uuid4().hex
+        self.id = chain_id
 
         # empty chain object to store data in
         self._empty_chain()
 
+        # number of venues in the stored chain, and whether its membership
+        # has been moved out into chain_id_lookup
+        self.size = 0
+        self.spilled = False
+
+        # version of the stored chain this object was loaded from (0 if new)
+        self.version = 0
+
+        # whether venues holds only some of the members (the chain was loaded
+        # without its membership), so membership changes can't be worked out
+        self.partial = False
+
         # the cache we may be loaded from/saved to
         self.cache=cache
 
+        # in-memory mirror of chain_id_lookup, shared with whoever created us
+        self.lookup = lookup
+
+        # chain statistics to keep up to date as we change the chain
+        self.stats = stats
+
     
     def _from_dict(self, chain):
         # create a Chain object from data held in a Python dict
         self.id = chain["_id"]
-        self.venues = set(chain["venues"])
-        self.names = set(chain["names"])
-        self.categories = set(chain["categories"])
-        self.urls = set(chain["urls"])
-        self.twitter = set(chain["twitter"])
-        self.facebook = set(chain["facebook"])
-        self.confidences = chain["confidences"]   
+        self.venues = VenueIdSet(chain.get("venues", []))
+        self.names = InternedSet(chain.get("names", []))
+        self.categories = InternedSet(chain.get("categories", []))
+        self.urls = InternedSet(chain.get("urls", []))
+        self.twitter = InternedSet(chain.get("twitter", []))
+        self.facebook = InternedSet(chain.get("facebook", []))
+        self.confidences = chain.get("confidences", {})
+        self.size = chain.get("size", len(self.venues))
+        self.spilled = chain.get("spilled", False)
+        self.version = chain.get("version", 0)
+        self._pending = []
+
+
+    def _get_confidences(self):
+        # confidences are stored alongside the venues they belong to
+        return ConfidenceMap(self.venues)
+
+    def _set_confidences(self, confidences):
+        self.venues.clear_confidences()
+        for venue, confidence in confidences.iteritems():
+            if venue in self.venues:
+                self.venues.set_confidence(venue, confidence)
+
+    confidences = property(_get_confidences, _set_confidences)
 
 
     def _to_dict(self):
@@ -58,7 +227,7 @@ class CachedChain:
             "venues": list(self.venues),
             "names": list(self.names),
             "categories": list(self.categories),
-            "confidences": self.confidences,
+            "confidences": self.confidences.to_dict(),
             "urls": list(self.urls),
             "twitter": list(self.twitter),
             "facebook": list(self.facebook)
@@ -68,125 +237,386 @@ class CachedChain:
 
     def _empty_chain(self):
         # empty all the data out of this chain
-        self.venues = set()
-        self.names = set()
-        self.categories = set()
-        self.urls = set()
-        self.twitter = set()
-        self.facebook = set()
-        self.confidences = {}
+        self.venues = VenueIdSet()
+        self.names = InternedSet()
+        self.categories = InternedSet()
+        self.urls = InternedSet()
+        self.twitter = InternedSet()
+        self.facebook = InternedSet()
+        # venues added since the chain was loaded, with the property values
+        # each of them introduced to the chain
+        self._pending = []
+
+
+    def _check_membership(self):
+        if self.partial:
+            raise PartialChainError(self.id)
 
 
     def calculate_confidences(self):
         # go through all the venues in the chain and work out the confidence
         # that the venue actually belongs to the chain
-        for venue in self.venues:
-            venue_data = self.cache.get_document('venues', {"_id": venue})
-            venue_data = get_min_venue_from_db(venue_data)
-            nd, um, sm, cm = self.get_venue_match_confidence(venue_data)
-            self.confidences[venue] = sum([nd, um, sm, cm])     
+        self._check_membership()
+        for venue, confidence in rescore_members(load_venues(self.cache, self.venues)).iteritems():
+            self.confidences[venue] = confidence
 
 
     def prune_chain(self, required_confidence):
-        # remove any venues that have a confidence lower than required_confidence
-        self.calculate_confidences()
-        to_remove = set()
-        for venue, confidence in self.confidences.iteritems():
-            if confidence < required_confidence:
-                to_remove.add(venue)
+        # remove any venues that have a confidence lower than required_confidence,
+        # loading the members once for both the scoring and the removal
+        self._check_membership()
+        members = load_venues(self.cache, self.venues)
+        confidences = rescore_members(members)
+        for venue, confidence in confidences.iteritems():
+            self.confidences[venue] = confidence
+        to_remove = [venue for venue in members if confidences[venue.id] < required_confidence]
         # if there's any to remove, remove them
-        for venue in to_remove:
-            self.remove_venue(self.cache.get_document('venues', {"_id": venue}))
+        if to_remove:
+            self.remove_venues(to_remove, members)
 
 
     def get_venue_match_confidence(self, venue):
 
-        if venue.get('response'):
-            venue = venue['response']['venue']
+        venue = as_venue_view(venue)
 
         # if it's a new venue (not currently in the chain), just return the match confidence
-        if venue['id'] not in self.venues:
+        if venue.id not in self.venues:
             return calc_chain_match_confidence(venue, self._to_dict())
         # otherwise build a copy of the chain with the venue removed,
         # then calculate and return the confidence
         else:
+            self._check_membership()
             chain = CachedChain(self.cache)
-            for v in self.venues:
-                if v != venue['id']:
-                    v_data = self.cache.get_document('venues', {"_id": v})
-                    v_data = get_min_venue_from_db(v_data)
-                    chain.add_venue(v_data)
+            for v in load_venues(self.cache, [v for v in self.venues if v != venue.id]):
+                chain.add_venue(v)
             return chain.get_venue_match_confidence(venue)
 
 
+    @venue_response
     def remove_venue(self, venue):
+        """
+        Remove a venue from the chain (see remove_venues)
+        """
+        self.remove_venues([venue])
+
+    def remove_venues(self, venues, members=None):
+        """
+        Remove venues from the chain, with one update to the chain and one to
+        the lookups. Only the property values the removed venues brought are
+        re-checked (is a remaining member still providing them?), rather than
+        rebuilding the chain from every member. members, the chain's venues,
+        can be passed in if they have already been loaded.
+
+        The update is only applied if the stored chain is still at the
+        version we loaded; if it isn't, the chain is read again and the
+        values to pull are worked out against its current members.
+        """
+        self._check_membership()
+
+        candidates = [as_venue_view(venue) for venue in venues]
+        for attempt in xrange(self.max_retries):
+
+            removed = set(venue.id for venue in candidates if venue.id in self.venues)
+            venues = [venue for venue in candidates if venue.id in removed]
+            if not venues:
+                return
+            if members is None:
+                members = load_venues(self.cache, [v for v in self.venues if v not in removed])
+
+            # which of the removed venues' property values do remaining members share?
+            shared = dict((field, set()) for field in PROPERTY_FIELDS)
+            for other in members:
+                if other.id not in removed:
+                    for field in PROPERTY_FIELDS:
+                        shared[field].update(venue_properties(other, field))
+
+            update = {'$pull': {'venues': {'$in': list(removed)}},
+                      '$unset': dict(('confidences.%s' % venue_id, '') for venue_id in removed),
+                      '$inc': {'size': -len(removed), 'version': 1}}
+            unshared = {}
+            for field in PROPERTY_FIELDS:
+                values = set()
+                for venue in venues:
+                    values.update(value for value in venue_properties(venue, field) if value not in shared[field])
+                if values:
+                    unshared[field] = values
+                    update['$pull'][field] = {'$in': list(values)}
+
+            if self.cas_update(update):
+                break
+            # someone else has changed the chain since we read it
+            self._reload()
+            members = None
+        else:
+            raise ChainConflictError(self.id)
 
-        if venue.get('response'):
-            venue = venue['response']['venue']   
+        for venue_id in removed:
+            self.venues.discard(venue_id)
+        for field, values in unshared.iteritems():
+            for value in values:
+                getattr(self, field).discard(value)
+        self.size -= len(removed)
 
-        # copy the list of venues
-        venues = self.venues[:]
-        # empty the chain
-        self._empty_chain()
-        # recreate the chain, but without the venue to be removed
-        for v in venues:
-            if venue['id'] != v['id']:
-                self.add_venue(v)
+        if self.stats is not None:
+            self.stats.record_resize(self.id, self.size + len(removed), self.size, self._display_name())
+            self.stats.record_venues(venues, -1)
 
-        # remove the lookup pointing the removed venue to this chain
-        self.cache.remove_document('chain_id_lookup', {'_id': venue['id']})
-        self.calculate_confidences()
+        # remove the lookups pointing the removed venues to this chain
+        remove_lookups(self.cache, {'_id': {'$in': list(removed)}, 'chain_id': self.id})
+        if self.lookup is not None:
+            for venue_id in removed:
+                self.lookup.remove(venue_id)
 
     @venue_response
     def add_venue(self, venue):
 
-        if venue.get('response'):
-            venue = venue['response']['venue']
+        if venue.id in self.venues:
+            return
 
-        self.venues.add(venue['id'])
-        self.names.add(venue['name'])
+        introduced = {}
+        def add_property(field, value):
+            values = getattr(self, field)
+            if value not in values:
+                values.add(value)
+                introduced.setdefault(field, []).append(value)
+
+        self.venues.add(venue.id)
+        add_property('names', venue.name)
         # add any extra details
-        if venue.get('url'):
-            venue_url = urlparse(venue['url']).netloc
-            self.urls.add(venue['url'])
-        if venue.get('contact'):
-            if venue['contact'].get('twitter'):
-                self.twitter.add(venue['contact']['twitter'])
-            if venue['contact'].get('facebook'):
-                self.facebook.add(venue['contact']['facebook'])
+        if venue.url:
+            add_property('urls', venue.url)
+        if venue.twitter:
+            add_property('twitter', venue.twitter)
+        if venue.facebook:
+            add_property('facebook', venue.facebook)
+
+        self._pending.append((venue, introduced))
         # if venue.get('categories'):
         #     for category in venue['categories']:
                 # self.categories.add(category)
 
-    def save(self):
-
-        chain = self._to_dict()
-        self.cache.put_document('chains', chain)
+    def _properties_without(self, venue, introduced):
+        # the chain properties as they would be without this (pending) venue:
+        # anything it introduced, unless another pending venue also has it
+        chain = {}
+        for field in PROPERTY_FIELDS:
+            values = set(getattr(self, field))
+            for value in introduced.get(field, []):
+                shared = False
+                for other, other_introduced in self._pending:
+                    if other.id != venue.id and value in venue_properties(other, field):
+                        shared = True
+                        break
+                if not shared:
+                    values.discard(value)
+            chain[field] = list(values)
+        return chain
 
-        # check inverse relationships (venue_id -> chain) are correct
+    def save(self):
+        """
+        Write the changes to this chain to the cache as a delta: new venues
+        and property values are added to the stored sets, and confidences
+        are set individually, so the cost doesn't depend on the chain size.
+
+        Several processes may be saving the same chain at once. The update is
+        only applied if the stored chain is still at the version we loaded;
+        if it isn't, the stored properties are merged into ours (the set
+        fields merge without conflict), confidences are recalculated against
+        the merged chain, and the save is retried.
+        """
+
+        for attempt in xrange(self.max_retries):
+
+            # venues added since loading that aren't already in this chain
+            new_venues = []
+            for venue, introduced in self._pending:
+                if self._get_lookup(venue.id) != self.id:
+                    # confidence against the chain made of every other venue
+                    nd, um, sm, cm = calc_chain_match_confidence(venue, self._properties_without(venue, introduced))
+                    confidence = sum([nd, um, sm, cm])
+                    self.confidences[venue.id] = confidence
+                    new_venues.append((venue.id, confidence))
+
+            update = {'$addToSet': {}, '$set': {}, '$setOnInsert': {}, '$inc': {'size': len(new_venues), 'version': 1}}
+            for field in PROPERTY_FIELDS:
+                values = set()
+                for venue, introduced in self._pending:
+                    values.update(introduced.get(field, []))
+                if values:
+                    update['$addToSet'][field] = {'$each': list(values)}
+                else:
+                    update['$setOnInsert'][field] = []
+            if not self.spilled and new_venues:
+                update['$addToSet']['venues'] = {'$each': [venue for venue, confidence in new_venues]}
+                for venue, confidence in new_venues:
+                    update['$set']['confidences.%s' % venue] = confidence
+            for operator in ['$addToSet', '$set', '$setOnInsert']:
+                if not update[operator]:
+                    del update[operator]
+
+            try:
+                # (a missing version matches None, for chains saved before versioning)
+                if self.cas_update(update, upsert=True):
+                    break
+            except DuplicateDocumentError:
+                # someone else created a chain with this id first
+                pass
+            self._refresh()
+        else:
+            raise ChainConflictError(self.id)
+
+        old_size = self.size
+        self.size += len(new_venues)
+
+        # add the inverse relationships (venue_id -> chain) for the new venues
+        joined = []
+        for venue, confidence in new_venues:
+            previous = self._get_lookup(venue)
+            owner = self._claim_lookup(venue, confidence)
+            if owner != self.id:
+                # the venue belongs to another chain, so it isn't part of this one
+                self._pull_venue(self.id, venue)
+                self.venues.discard(venue)
+                self.size -= 1
+            elif previous is None:
+                # (venues taken from another chain were already counted)
+                joined.append(venue)
+
+        # check inverse relationships are correct for the rest of the venues
+        pending = set(venue.id for venue, introduced in self._pending)
         for venue in self.venues:
-            # if the lookup doesn't already exist
-            if not self.cache.document_exists('chain_id_lookup', {"_id": venue}):
-                # add the inverse lookup
-                v = self.cache.get_document('venues', {"_id": venue})
-                v = get_min_venue_from_db(v)
+            if venue not in pending and self._get_lookup(venue) != self.id:
+                v = VenueView(self.cache.get_fresh_document('venues', {"_id": venue}, fields=venue_projection()))
                 nd, um, sm, cm = self.get_venue_match_confidence(v)
-                data = {'_id': venue,
-                        'chain_id': self.id,
-                        'confidence': sum([nd,um,sm,cm])}
-                self.cache.put_document('chain_id_lookup', data)
-            # if the lookup already exists, ensure it's pointing to the right chain
-            else:
-                lookup = self.cache.get_document('chain_id_lookup', {"_id": venue})
-                if lookup['chain_id'] != self.id:     
-                    # add the inverse lookup
-                    v = self.cache.get_document('venues', {"_id": venue})
-                    v = get_min_venue_from_db(v)
-                    nd, um, sm, cm = self.get_venue_match_confidence(v)
-                    data = {'_id': venue,
-                            'chain_id': self.id,
-                            'confidence': sum([nd,um,sm,cm])}
-                    self.cache.put_document('chain_id_lookup', data)
+                self._claim_lookup(venue, sum([nd,um,sm,cm]))
+
+        if self.stats is not None:
+            self.stats.record_resize(self.id, old_size, self.size, self._display_name())
+            joined = set(joined)
+            self.stats.record_venues([venue for venue, introduced in self._pending if venue.id in joined])
+
+        self._pending = []
+
+        # big chains keep their membership in chain_id_lookup only
+        if not self.spilled and self.size > self.spill_size:
+            if self.cas_update({'$unset': {'venues': '', 'confidences': ''}, '$set': {'spilled': True}, '$inc': {'version': 1}}):
+                self.spilled = True
+
+    def cas_update(self, update, upsert=False):
+        """
+        Apply an update to the stored chain only if it is still at the version
+        this chain object last saw (compare and swap). Returns True if the
+        update was applied.
+        """
+        query = {'_id': self.id, 'version': self.version if self.version else {'$in': [0, None]}}
+        if self.cache.update_document('chains', query, update, upsert=upsert) > 0:
+            self.version += 1
+            return True
+        return False
+
+    def _reload(self):
+        # read the stored chain again, membership included, keeping any
+        # venues added here but not yet saved
+        pending = self._pending
+        chain = read_chain(self.cache, self.id)
+        if chain is None:
+            # the chain has gone (deleted or merged away)
+            self._empty_chain()
+            self.size = 0
+            self.version = 0
+        else:
+            self._from_dict(chain)
+        self._pending = pending
+
+    def _refresh(self):
+        # merge the stored chain's properties into ours after losing a race to
+        # update it; set fields are unions, so nothing either side added is lost
+        stored = None
+        for chain in self.cache.get_documents('chains', {'_id': self.id}, CHAIN_PROPERTIES):
+            stored = chain
+        if stored is None:
+            self.version = 0
+            return
+
+        self.version = stored.get('version', 0)
+        self.size = stored.get('size', self.size)
+        self.spilled = stored.get('spilled', False)
+        for field in PROPERTY_FIELDS:
+            values = getattr(self, field)
+            stored_values = set(stored.get(field, []))
+            for value in stored_values:
+                values.add(value)
+            # values someone else has already stored don't need sending again
+            for venue, introduced in self._pending:
+                if field in introduced:
+                    introduced[field] = [value for value in introduced[field] if value not in stored_values]
+
+    def _claim_lookup(self, venue, confidence):
+        """
+        Point a venue's lookup at this chain. A venue another chain already
+        has is only taken if it matches this chain with a higher confidence
+        than it matches that one; otherwise the existing owner keeps it. The
+        lookup is only changed if no other process has changed it since we
+        read it. Returns the id of the chain the venue ends up belonging to.
+        """
+        data = {'chain_id': self.id, 'confidence': confidence}
+        previous = self._get_lookup(venue)
+        current = None
+
+        for attempt in xrange(self.max_retries):
+            if previous is None:
+                try:
+                    self.cache.insert_document('chain_id_lookup', dict(data, _id=venue))
+                    owner = self.id
+                    break
+                except DuplicateDocumentError:
+                    pass
+            elif previous != self.id and current is not None and (current.get('confidence') or 0) >= confidence:
+                # the venue stays where it is
+                owner = previous
+                break
+            elif previous == self.id or current is not None:
+                if self.cache.update_document('chain_id_lookup', {'_id': venue, 'chain_id': previous}, {'$set': dict(data)}) > 0:
+                    owner = self.id
+                    # the other chain loses the venue to this one
+                    if previous != self.id:
+                        self._pull_venue(previous, venue)
+                    break
+
+            # see who has the venue now, and how well it matches them
+            current = self.cache.get_fresh_document('chain_id_lookup', {'_id': venue})
+            previous = current['chain_id'] if current is not None else None
+        else:
+            raise ChainConflictError(self.id)
+
+        if self.lookup is not None:
+            self.lookup.set(venue, owner)
+        return owner
+
+    def _pull_venue(self, chain_id, venue):
+        # remove a venue from a stored chain, without needing its version
+        chain = self.cache.find_and_modify('chains', {'_id': chain_id},
+                                           {'$pull': {'venues': venue}, '$unset': {'confidences.%s' % venue: ''},
+                                            '$inc': {'size': -1, 'version': 1}})
+        # our own size changes are recorded when we finish saving
+        if self.stats is not None and chain is not None and chain_id != self.id:
+            names = chain.get('names') or [None]
+            self.stats.record_resize(chain_id, chain['size'] + 1, chain['size'], names[0])
+
+    def _display_name(self):
+        # any one of the chain's names, to label it in the statistics
+        for name in self.names:
+            return name
+        return None
+
+    def _get_lookup(self, venue_id):
+        # find the chain a venue currently points to, from the in-memory
+        # mirror if we have one, otherwise from the cache
+        if self.lookup is not None:
+            return self.lookup.get(venue_id)
+        if self.cache.document_exists('chain_id_lookup', {"_id": venue_id}):
+            return self.cache.get_document('chain_id_lookup', {"_id": venue_id})['chain_id']
+        return None
 
 
 class ChainManager:
@@ -194,41 +624,139 @@ class ChainManager:
     ChainManager is responsible for handling chain operations.
     """
 
-    def __init__(self, db_name='fsqexp'):
+    def __init__(self, db_name='fsqexp', cache=None):
 
-        self.cache = MongoDBCache(db=db_name)
+        # use the cache we're given (e.g. a MemoryCache), or connect to mongo
+        if cache is None:
+            cache = open_cache(db_name)
+        self.cache = cache
+
+        # members of large chains are found through their lookups, and other
+        # processes' new and removed lookups by when they were written
+        self.cache.ensure_index('chain_id_lookup', 'chain_id')
+        self.cache.ensure_index('chain_id_lookup', 'last_modified')
+        self.cache.ensure_index(REMOVALS, 'last_modified')
+
+        # venue id -> chain id mirror, shared by every chain we hand out
+        self.lookup = ChainLookup(self.cache)
+
+        # totals, size histogram and biggest chains, kept up to date on write
+        self.stats = ChainStatistics(self.cache)
               
 
     def create_chain(self, venues):
-        chain = CachedChain(self.cache)
+        venues = [as_venue_view(venue) for venue in venues]
+        chain = CachedChain(self.cache, self.lookup, new_chain_id(self.cache, [venue.id for venue in venues]), self.stats)
         for venue in venues:
             chain.add_venue(venue)
         chain.save()
         return chain
 
     def add_to_chain(self, chain_id, venues):
-        chain = self.load_chain(chain_id)
+        # adding venues only needs the chain's properties, not its membership,
+        # so the returned chain is partial, holding just the venues added here
+        chain = self.load_chain(chain_id, venues=False)
+        if chain is None:
+            raise KeyError('no chain %s' % chain_id)
         for venue in venues:
             chain.add_venue(venue)
         chain.save()
         return chain       
 
     def delete_chain(self, chain):
-        venues = chain.venues[:]
-        for venue in venues:
-            chain.remove_venue(venue)
+        # drop every lookup pointing at the chain in one go, then the chain;
+        # the lookups give the members even if the chain is partly loaded
+        members = remove_lookups(self.cache, {'chain_id': chain.id})
+        for venue in members:
+            self.lookup.remove(venue)
         self.cache.remove_document('chains', {"_id": chain.id})
 
+        self.stats.record_resize(chain.id, chain.size, 0)
+        self.stats.record_venues(load_venues(self.cache, members), -1)
+
     def merge_chains(self, chain1, chain2):
-        venues = chain1.venues[:] + chain2.venues[:]
-        self.delete_chain(chain1)
-        self.delete_chain(chain2)
-        return self.create_chain(venues)
-
-    def load_chain(self, chain_id):
-        chain = self.cache.get_document('chains', {"_id": chain_id})
-        c = CachedChain(self.cache)
+        return self.merge_chain_ids([chain1.id, chain2.id])
+
+    def merge_chain_ids(self, chain_ids):
+        """
+        Merge several chains into one. Of the chains that still exist, the
+        one with the lowest id is kept, and the others' venues and properties
+        are moved into it in one update per collection, rather than deleting
+        and recreating the chain. Moved venues keep the confidences they had;
+        the maintenance job rescores them. Returns the kept chain, or None if
+        fewer than two of the chains exist (they may have been merged or
+        deleted since the ids were found).
+        """
+        chains = self.cache.get_documents('chains', {'_id': {'$in': list(set(chain_ids))}}, {'size': True, 'spilled': True, 'names': {'$slice': 1}})
+        chains = sorted(chains, key=lambda chain: chain['_id'])
+        if len(chains) < 2:
+            return None
+        keeper, other_ids = chains[0], [chain['_id'] for chain in chains[1:]]
+        keeper_id = keeper['_id']
+        keeper_size = keeper.get('size', 0)
+
+        # the other chains' properties and members
+        properties = dict((field, set()) for field in PROPERTY_FIELDS)
+        confidences = {}
+        sizes = {}
+        for other in self.cache.get_documents('chains', {'_id': {'$in': other_ids}}):
+            for field in PROPERTY_FIELDS:
+                properties[field].update(other.get(field, []))
+            sizes[other['_id']] = other.get('size', len(other.get('venues', [])))
+            if not other.get('spilled'):
+                for venue in other.get('venues', []):
+                    confidences[venue] = other.get('confidences', {}).get(venue)
+        for lookup in self.cache.get_documents('chain_id_lookup', {'chain_id': {'$in': other_ids}}, {'confidence': True}):
+            confidences[lookup['_id']] = lookup.get('confidence')
+
+        update = {'$addToSet': {}, '$set': {}, '$inc': {'size': len(confidences), 'version': 1}}
+        for field, values in properties.iteritems():
+            if values:
+                update['$addToSet'][field] = {'$each': list(values)}
+        if not keeper.get('spilled') and confidences:
+            update['$addToSet']['venues'] = {'$each': confidences.keys()}
+            for venue, confidence in confidences.iteritems():
+                if confidence is not None:
+                    update['$set']['confidences.%s' % venue] = confidence
+        if not update['$addToSet']:
+            del update['$addToSet']
+
+        self.cache.update_document('chains', {'_id': keeper_id}, update)
+        self.cache.update_documents('chain_id_lookup', {'chain_id': {'$in': other_ids}}, {'$set': {'chain_id': keeper_id}})
+        self.cache.remove_documents('chains', {'_id': {'$in': other_ids}})
+
+        for venue in confidences:
+            self.lookup.set(venue, keeper_id)
+        for other_id, size in sizes.iteritems():
+            self.stats.record_resize(other_id, size, 0)
+        names = keeper.get('names') or [None]
+        self.stats.record_resize(keeper_id, keeper_size, keeper_size + len(confidences), names[0])
+
+        chain = self.load_chain(keeper_id, venues=False)
+        # big chains keep their membership in chain_id_lookup only
+        if not chain.spilled and chain.size > chain.spill_size:
+            if chain.cas_update({'$unset': {'venues': '', 'confidences': ''}, '$set': {'spilled': True}, '$inc': {'version': 1}}):
+                chain.spilled = True
+        return chain
+
+    def load_chain(self, chain_id, venues=True):
+        """
+        Load a chain, or None if there isn't one with this id. Without venues
+        only the chain's properties are read, and the chain is partial.
+        """
+        if venues:
+            chain = read_chain(self.cache, chain_id)
+            if chain is None:
+                return None
+        else:
+            chain = None
+            for chain in self.cache.get_documents('chains', {"_id": chain_id}, CHAIN_PROPERTIES):
+                break
+            if chain is None:
+                return None
+        c = CachedChain(self.cache, self.lookup, stats=self.stats)
         c._from_dict(chain)
+        c.partial = not venues
         return c
 
 
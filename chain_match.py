@@ -15,21 +15,22 @@
 #   limitations under the License.
 
 from Levenshtein import ratio
-from urlparse import urlparse
+from venue_view import as_venue_view
+
+import metrics
 
 def calc_chain_match_confidence(venue, chain):
 
     # just need the venue data, not the whole API response
-    if venue.get('response'):
-        v = venue['response']['venue']
-    else:
-        v = venue
+    v = as_venue_view(venue)
 
     # calculate average name ratio
+    if metrics.enabled:
+        metrics.inc('ratio_calls', len(chain['names']), caller='chain_match')
     ratios = []
     average_ratio = 0.0
     for name in chain['names']:
-        ratios.append(ratio(v['name'], name))
+        ratios.append(ratio(v.name, name))
     if len(ratios) > 0:
         average_ratio = float(sum(ratios))/len(ratios)
     else:
@@ -37,33 +38,27 @@ def calc_chain_match_confidence(venue, chain):
 
     # check url matches
     url_confidence = 0.0
-    if v.get('url'):
-        url = urlparse(venue['url']).netloc
-        if url in chain['urls']:
+    if v.url:
+        if v.netloc in chain['urls']:
             url_confidence = 1.0
     
     # check social media matches
     social_media_confidence = 0.0
-    if v.get('contact'):
-        if v['contact'].get('twitter'):
-            twitter = v['contact']['twitter']
-            if twitter in chain['twitter']:
-                social_media_confidence += 1.0
-        if v['contact'].get('facebook'):
-            facebook = v['contact']['facebook']
-            if facebook in chain['facebook']:
-                social_media_confidence += 1.0
+    if v.twitter:
+        if v.twitter in chain['twitter']:
+            social_media_confidence += 1.0
+    if v.facebook:
+        if v.facebook in chain['facebook']:
+            social_media_confidence += 1.0
 
     # check category matches
     category_confidence = 0.0
     if average_ratio > 0.9:
         c1 = set()
         c2 = set()
-        if v.get('categories'):
-            for category in v['categories']:
-                c1.add(category)
-            for category in chain['categories']:
-                c2.add(category)
+        if v.category_ids:
+            c1.update(v.category_ids)
+            c2.update(chain['categories'])
         common = c1 & c2
         if len(common) > 0:
             category_confidence = 1.0
@@ -75,11 +70,9 @@ def calc_chain_match_confidence(venue, chain):
 
 def find_best_chain_match(venue, candidate_chains):
 
-    # just need the venue data, not the whole API response
-    if venue.get('response'):
-        v = venue['response']['venue']
-    else:
-        v = venue
+    # just need the venue data, not the whole API response, wrapped once
+    # so its derived fields are shared by every comparison
+    v = as_venue_view(venue)
 
     max_confidence = 0.0
     best_match = None
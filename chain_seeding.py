@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+
+from collections import Counter
+from Levenshtein import ratio
+
+from db_cache import open_cache
+from assets import load_asset
+from chain_lookup import ChainLookup, remove_lookups
+from chain_stats import ChainStatistics
+from chain_manager import CachedChain, PROPERTY_FIELDS, new_chain_id, load_venues, rescore_members, venue_properties
+
+# handle map -> the names of the venues in it (in the same order)
+HANDLE_ASSETS = [('twitter', 'twitter_names'), ('fb', 'facebook_names')]
+
+
+def _normalise(name):
+    return re.sub(r'[^\w]+', ' ', name.lower(), flags=re.UNICODE).strip()
+
+
+def consistent_names(handle, names, min_ratio=0.6):
+    """
+    Indices of the names that look like they belong to the same brand: the
+    name contains the handle, is close to the most common name, or shares a
+    word with most of the other names ('Hilton Pasadena', 'Washington Hilton')
+    """
+    normalised = [_normalise(name) for name in names]
+    common_name = Counter(normalised).most_common(1)[0][0]
+
+    words = Counter()
+    for name in normalised:
+        words.update(set(word for word in name.split() if len(word) > 2))
+    brand_words = set(word for word, count in words.iteritems() if count * 2 >= len(names))
+
+    handle = _normalise(handle).replace(' ', '')
+
+    consistent = []
+    for i, name in enumerate(normalised):
+        if (handle and handle in name.replace(' ', '')) or \
+           ratio(name, common_name) >= min_ratio or \
+           brand_words.intersection(name.split()):
+            consistent.append(i)
+    return consistent
+
+
+class ChainSeeder:
+    """
+    Creates chains in bulk from the venues that share a twitter handle or
+    facebook page, before the fuzzy matcher runs. Venues seeded here already
+    have a chain lookup, so the matcher skips them.
+
+    Handles whose venues' names mostly disagree are left to the matcher, as
+    are the individual venues whose names don't fit the rest of their handle.
+    """
+
+    def __init__(self, db_name='fsqexp', min_ratio=0.6, min_consistent=0.5, batch_size=100):
+
+        self.cache = open_cache(db_name)
+        self.stats = ChainStatistics(self.cache)
+
+        # how close a name has to be to the handle's most common name
+        self.min_ratio = min_ratio
+        # fraction of a handle's venues that must agree for it to be used
+        self.min_consistent = min_consistent
+        # number of chains written in each bulk insert
+        self.batch_size = batch_size
+
+    def handle_clusters(self):
+        """
+        Groups of venue ids sharing a handle, after the name checks
+        """
+        for handles_name, names_name in HANDLE_ASSETS:
+            handles = load_asset(handles_name)
+            names = load_asset(names_name)
+            for handle in handles.keys():
+                venue_ids = handles[handle]
+                if len(venue_ids) < 2:
+                    continue
+                consistent = consistent_names(handle, names[handle], self.min_ratio)
+                if len(consistent) < 2 or len(consistent) < self.min_consistent * len(venue_ids):
+                    continue
+                yield set(venue_ids[i] for i in consistent)
+
+    def clusters(self, existing):
+        """
+        Merge the handle clusters that share venues (a venue with the same
+        twitter handle and facebook page as others is one chain, not two),
+        leaving out venues that are already in a chain
+        """
+        parent = {}
+
+        def find(venue):
+            while parent[venue] != venue:
+                parent[venue] = parent[parent[venue]]
+                venue = parent[venue]
+            return venue
+
+        for cluster in self.handle_clusters():
+            cluster = [venue for venue in cluster if existing.get(venue) is None]
+            if len(cluster) < 2:
+                continue
+            for venue in cluster:
+                parent.setdefault(venue, venue)
+            root = find(cluster[0])
+            for venue in cluster[1:]:
+                other = find(venue)
+                if other != root:
+                    parent[other] = root
+
+        groups = {}
+        for venue in parent:
+            groups.setdefault(find(venue), []).append(venue)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def chain_documents(self, venue_ids):
+        """
+        The chain and lookup documents for one cluster, built from the venues
+        in a single query
+        """
+        venues = load_venues(self.cache, venue_ids)
+        if len(venues) < 2:
+            return None, [], venues
+
+        chain_id = new_chain_id(self.cache, [venue.id for venue in venues])
+        confidences = rescore_members(venues)
+
+        chain = {'_id': chain_id, 'categories': [], 'size': len(venues), 'version': 1}
+        for field in PROPERTY_FIELDS:
+            values = set()
+            for venue in venues:
+                values.update(venue_properties(venue, field))
+            chain[field] = list(values)
+        if len(venues) > CachedChain.spill_size:
+            # big chains keep their membership in chain_id_lookup only
+            chain['spilled'] = True
+        else:
+            chain['venues'] = [venue.id for venue in venues]
+            chain['confidences'] = confidences
+
+        lookups = [{'_id': venue.id, 'chain_id': chain_id, 'confidence': confidences[venue.id]} for venue in venues]
+        return chain, lookups, venues
+
+    def write_batch(self, batch):
+        """
+        Insert a batch of chains and their lookups, in two bulk inserts. The
+        lookups go first, as they claim the venues: a chain with a venue
+        another process has put in a chain since we started, or whose id is
+        already taken, is dropped (its claims are taken back and its venues
+        left to the matcher). Stats are only recorded for the chains that
+        were really inserted. Returns the number of chains and venues
+        written.
+        """
+        with self.cache.batch():
+            claimed = set(self.cache.insert_documents('chain_id_lookup', [lookup for chain, lookups, venues in batch for lookup in lookups]))
+            complete = [chain for chain, lookups, venues in batch if all(lookup['_id'] in claimed for lookup in lookups)]
+            inserted = set(self.cache.insert_documents('chains', complete))
+
+            released = [lookup['_id'] for chain, lookups, venues in batch if chain['_id'] not in inserted
+                        for lookup in lookups if lookup['_id'] in claimed]
+            if released:
+                remove_lookups(self.cache, {'_id': {'$in': released}})
+
+            batch = [(chain, lookups, venues) for chain, lookups, venues in batch if chain['_id'] in inserted]
+            for chain, lookups, venues in batch:
+                self.stats.record_resize(chain['_id'], 0, chain['size'], chain['names'][0] if chain['names'] else None)
+                self.stats.record_venues(venues)
+
+        return len(batch), sum(len(lookups) for chain, lookups, venues in batch)
+
+    def run(self):
+        """
+        Seed the chains. Returns the number of chains created and the number
+        of venues put into them.
+        """
+        existing = ChainLookup(self.cache)
+
+        chains = 0
+        venues = 0
+        batch = []
+        for cluster in self.clusters(existing):
+            chain, lookups, members = self.chain_documents(cluster)
+            if chain is None:
+                continue
+            batch.append((chain, lookups, members))
+            if len(batch) >= self.batch_size:
+                written_chains, written_venues = self.write_batch(batch)
+                chains += written_chains
+                venues += written_venues
+                batch = []
+                print '%d chains, %d venues' % (chains, venues)
+        if batch:
+            written_chains, written_venues = self.write_batch(batch)
+            chains += written_chains
+            venues += written_venues
+
+        return chains, venues
+
+
+if __name__ == '__main__':
+
+    cs = ChainSeeder()
+    chains, venues = cs.run()
+    print '%d chains seeded with %d venues' % (chains, venues)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import Counter
+
+from assets import CategoryIndex
+from venue_view import VenueView
+
+# lower bounds of the chain size histogram buckets. chains_larger_than can
+# only count exactly from a bucket bound, so 31 is one (analysis.py reports
+# the chains with more than 30 venues)
+SIZE_BUCKETS = [1, 2, 5, 10, 31, 100, 1000]
+
+
+def size_bucket(size):
+    """
+    Name of the histogram bucket a chain of this size falls in ('31-99' etc.)
+    """
+    for lower, upper in zip(SIZE_BUCKETS, SIZE_BUCKETS[1:]):
+        if lower <= size < upper:
+            if upper - lower == 1:
+                return '%d' % lower
+            return '%d-%d' % (lower, upper - 1)
+    return '%d+' % SIZE_BUCKETS[-1]
+
+
+class ChainStatistics:
+    """
+    Summary statistics about the chains, kept up to date as chains are
+    written rather than recalculated by scanning them. Everything is held in
+    a single document, so reading the statistics is one query:
+
+        chains, venues          - totals
+        size_histogram          - number of chains in each size bucket
+        venues_by_category      - number of chain venues per root category
+        top_chains              - the top_n biggest chains, largest first
+    """
+
+    def __init__(self, cache, top_n=100, collection='chain_stats'):
+
+        self.cache = cache
+        self.top_n = top_n
+        self.collection = collection
+        self.doc_id = 'chains'
+
+        # category tree is only loaded if we need it
+        self._ct = None
+
+        # size of the smallest chain in the top list, so we only touch the
+        # list for chains that could be in it
+        self._top_floor = 0
+
+    def _root_category(self, category_id):
+        if self._ct is None:
+            self._ct = CategoryIndex()
+        root = self._ct.get_root_node_for_id(category_id)
+        if root is None:
+            return None
+        return root['foursq_id']
+
+    def record_resize(self, chain_id, old_size, new_size, name=None):
+        """
+        Record a chain changing size from old_size to new_size (0 for a new
+        or deleted chain)
+        """
+        if old_size == new_size:
+            return
+
+        inc = {'venues': new_size - old_size}
+        if old_size == 0:
+            inc['chains'] = 1
+        if new_size == 0:
+            inc['chains'] = -1
+        if old_size > 0:
+            inc['size_histogram.%s' % size_bucket(old_size)] = -1
+        if new_size > 0:
+            bucket = 'size_histogram.%s' % size_bucket(new_size)
+            inc[bucket] = inc.get(bucket, 0) + 1
+
+        self.cache.update_document(self.collection, {'_id': self.doc_id}, {'$inc': inc}, upsert=True)
+
+        if new_size >= self._top_floor or old_size >= self._top_floor:
+            self._update_top(chain_id, new_size, name)
+
+    def _update_top(self, chain_id, size, name):
+        # take the chain out of the top list, and put it back in its place
+        self.cache.update_document(self.collection, {'_id': self.doc_id},
+                                   {'$pull': {'top_chains': {'chain_id': chain_id}}}, upsert=True)
+        if size > 0:
+            if name is None:
+                for chain in self.cache.get_documents('chains', {'_id': chain_id}, {'names': {'$slice': 1}}):
+                    name = (chain.get('names') or [None])[0]
+            entry = {'chain_id': chain_id, 'size': size, 'name': name}
+            stats = self.cache.find_and_modify(self.collection, {'_id': self.doc_id},
+                                               {'$push': {'top_chains': {'$each': [entry],
+                                                                         '$sort': {'size': -1},
+                                                                         '$slice': self.top_n}}})
+            top = stats.get('top_chains', [])
+            if len(top) >= self.top_n:
+                self._top_floor = top[-1]['size']
+
+    def record_venues(self, venues, sign=1):
+        """
+        Record venues joining (or with sign=-1, leaving) chains
+        """
+        self.record_categories([venue.category_ids[0] for venue in venues if venue.category_ids], sign)
+
+    def record_categories(self, category_ids, sign=1):
+        """
+        Record venues with these (primary) categories joining or leaving chains
+        """
+        counts = Counter()
+        for category_id in category_ids:
+            root = self._root_category(category_id)
+            if root is not None:
+                counts[root] += sign
+        if counts:
+            inc = dict(('venues_by_category.%s' % root, count) for root, count in counts.iteritems())
+            self.cache.update_document(self.collection, {'_id': self.doc_id}, {'$inc': inc}, upsert=True)
+
+    def get(self):
+        """
+        The current statistics document
+        """
+        stats = self.cache.get_document(self.collection, {'_id': self.doc_id})
+        if stats is None:
+            stats = {'chains': 0, 'venues': 0, 'size_histogram': {}, 'venues_by_category': {}, 'top_chains': []}
+        return stats
+
+    def chains_larger_than(self, size):
+        """
+        Number of chains with more than size venues. size + 1 must be the
+        lower bound of a histogram bucket, as the histogram can't count from
+        anywhere else.
+        """
+        if size + 1 not in SIZE_BUCKETS:
+            raise ValueError('chain sizes are only counted from %s' % ', '.join(str(lower - 1) for lower in SIZE_BUCKETS))
+        histogram = self.get().get('size_histogram', {})
+        count = 0
+        for lower in SIZE_BUCKETS:
+            if lower > size:
+                count += histogram.get(size_bucket(lower), 0)
+        return count
+
+    def rebuild(self):
+        """
+        Recalculate the statistics from scratch by scanning the chains, for
+        when they're first introduced or have drifted
+        """
+        stats = {'_id': self.doc_id, 'chains': 0, 'venues': 0, 'size_histogram': {}, 'venues_by_category': {}, 'top_chains': []}
+
+        sizes = []
+        for chain in self.cache.get_documents('chains', {}, {'size': True, 'venues': True, 'names': True}):
+            size = chain.get('size', len(chain.get('venues', [])))
+            if size <= 0:
+                continue
+            names = chain.get('names') or [None]
+            sizes.append((size, chain['_id'], names[0]))
+            stats['chains'] += 1
+            stats['venues'] += size
+            bucket = size_bucket(size)
+            stats['size_histogram'][bucket] = stats['size_histogram'].get(bucket, 0) + 1
+
+        sizes.sort(reverse=True)
+        stats['top_chains'] = [{'chain_id': chain_id, 'size': size, 'name': name} for size, chain_id, name in sizes[:self.top_n]]
+
+        # venue categories, from the venues that have a chain lookup
+        counts = Counter()
+        lookups = self.cache.get_documents('chain_id_lookup', {}, {'_id': True})
+        ids = [lookup['_id'] for lookup in lookups]
+        for start in xrange(0, len(ids), 1000):
+            for venue in self.cache.get_documents('venues', {'_id': {'$in': ids[start:start + 1000]}},
+                                                  {'min.categories': True, 'categories': True, 'response.venue.categories.id': True}):
+                # categories may be objects, bare ids or a csv column
+                category_ids = VenueView(venue).category_ids
+                if category_ids:
+                    root = self._root_category(category_ids[0])
+                    if root is not None:
+                        counts[root] += 1
+        stats['venues_by_category'] = dict(counts)
+
+        self.cache.put_document(self.collection, stats)
+        if len(stats['top_chains']) >= self.top_n:
+            self._top_floor = stats['top_chains'][-1]['size']
+        return stats
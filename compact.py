@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Compact set types used to hold chain data in memory.
+
+Venue ids (24 character hex strings) are packed into 12 byte binary values
+held in one sorted buffer, with their confidences in a float32 array in the
+same order. Names, urls and social media handles are interned once in a
+global StringTable and sets of them are held as sorted arrays of integer ids.
+The table counts the sets holding each string, and drops a string once no
+set holds it, so it only grows with the chains actually in memory.
+"""
+
+import math
+import binascii
+import threading
+
+from array import array
+from bisect import bisect_left
+
+VENUE_ID_BYTES = 12
+
+
+class StringTable(object):
+    """
+    Global intern table mapping strings to small integer ids and back. Each
+    string is counted once for every set holding it, and is dropped (its id
+    given to the next new string) when the last one releases it.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+        self.counts = array('l')
+        # ids of dropped strings, to be reused
+        self.free = []
+        # re-entrant, as a set may be collected (and release) during intern
+        self._lock = threading.RLock()
+
+    def intern(self, string):
+        # the string's id, counting one more holder of it
+        with self._lock:
+            string_id = self.ids.get(string)
+            if string_id is None:
+                if self.free:
+                    string_id = self.free.pop()
+                    self.strings[string_id] = string
+                else:
+                    string_id = len(self.strings)
+                    self.strings.append(string)
+                    self.counts.append(0)
+                self.ids[string] = string_id
+            self.counts[string_id] += 1
+            return string_id
+
+    def release(self, string_id):
+        # one fewer holder of the string, dropping it if that was the last
+        with self._lock:
+            self.counts[string_id] -= 1
+            if self.counts[string_id] == 0:
+                del self.ids[self.strings[string_id]]
+                self.strings[string_id] = None
+                self.free.append(string_id)
+
+    def get_id(self, string):
+        return self.ids.get(string)
+
+    def get_string(self, string_id):
+        return self.strings[string_id]
+
+    def __len__(self):
+        return len(self.ids)
+
+# shared by every InternedSet, so each distinct string is held only once
+strings = StringTable()
+
+
+class InternedSet(object):
+    """
+    Set of strings held as a sorted array of ids into the global StringTable
+    """
+
+    __slots__ = ('_ids',)
+
+    def __init__(self, items=()):
+        self._ids = array('i')
+        self.update(items)
+
+    def _position(self, string):
+        # position of the string's id in the set, or None if it isn't there
+        string_id = strings.get_id(string)
+        if string_id is None:
+            return None
+        position = bisect_left(self._ids, string_id)
+        if position < len(self._ids) and self._ids[position] == string_id:
+            return position
+        return None
+
+    def add(self, string):
+        if self._position(string) is None:
+            string_id = strings.intern(string)
+            self._ids.insert(bisect_left(self._ids, string_id), string_id)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def discard(self, string):
+        position = self._position(string)
+        if position is not None:
+            strings.release(self._ids.pop(position))
+
+    def __contains__(self, string):
+        return self._position(string) is not None
+
+    def __del__(self):
+        # strings is None if the module has been torn down at exit
+        if strings is not None:
+            for string_id in self._ids:
+                strings.release(string_id)
+
+    def __iter__(self):
+        for string_id in self._ids:
+            yield strings.get_string(string_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return 'InternedSet(%r)' % list(self)
+
+
+def pack_venue_id(venue_id):
+    # 24 hex characters -> 12 bytes
+    try:
+        if len(venue_id) == VENUE_ID_BYTES * 2:
+            return buffer(binascii.unhexlify(venue_id))
+    except TypeError:
+        pass
+    raise ValueError('venue id must be %d hex characters: %r' % (VENUE_ID_BYTES * 2, venue_id))
+
+
+def unpack_venue_id(packed):
+    return binascii.hexlify(packed).decode('ascii')
+
+
+class VenueIdSet(object):
+    """
+    Set of venue ids packed as 12 byte values in one sorted buffer, with a
+    float32 confidence for each venue held in an array in the same order.
+    Ids that can't be packed are kept as they are, with their confidences,
+    in a dict on the side, so a set never loses a member.
+    """
+
+    __slots__ = ('_buffer', '_confidences', '_unpacked')
+
+    def __init__(self, items=()):
+        self._buffer = bytearray()
+        self._confidences = array('f')
+        self._unpacked = None
+        self.update(items)
+
+    def _key(self, position):
+        # a view of the packed id, compared in place rather than copied out
+        return buffer(self._buffer, position * VENUE_ID_BYTES, VENUE_ID_BYTES)
+
+    def _find(self, packed):
+        # binary search for the position the packed id is at, or should go
+        low, high = 0, len(self._confidences)
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < packed:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _position(self, venue_id):
+        # position of the venue in the set, or None if it isn't there
+        try:
+            packed = pack_venue_id(venue_id)
+        except (ValueError, TypeError):
+            return None
+        position = self._find(packed)
+        if position < len(self._confidences) and self._key(position) == packed:
+            return position
+        return None
+
+    def add(self, venue_id):
+        try:
+            packed = pack_venue_id(venue_id)
+        except (ValueError, TypeError):
+            if self._unpacked is None:
+                self._unpacked = {}
+            # confidence is unknown until it has been calculated
+            self._unpacked.setdefault(venue_id, float('nan'))
+            return
+        position = self._find(packed)
+        if position == len(self._confidences) or self._key(position) != packed:
+            start = position * VENUE_ID_BYTES
+            self._buffer[start:start] = packed
+            # confidence is unknown until it has been calculated
+            self._confidences.insert(position, float('nan'))
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def discard(self, venue_id):
+        position = self._position(venue_id)
+        if position is not None:
+            start = position * VENUE_ID_BYTES
+            del self._buffer[start:start + VENUE_ID_BYTES]
+            self._confidences.pop(position)
+        elif self._unpacked:
+            self._unpacked.pop(venue_id, None)
+
+    def __contains__(self, venue_id):
+        return self._position(venue_id) is not None or bool(self._unpacked and venue_id in self._unpacked)
+
+    def __iter__(self):
+        for position in xrange(len(self._confidences)):
+            yield unpack_venue_id(self._key(position))
+        if self._unpacked:
+            for venue_id in self._unpacked.keys():
+                yield venue_id
+
+    def __len__(self):
+        return len(self._confidences) + len(self._unpacked or ())
+
+    def __repr__(self):
+        return 'VenueIdSet(%r)' % list(self)
+
+    def get_confidence(self, venue_id):
+        position = self._position(venue_id)
+        if position is not None:
+            confidence = self._confidences[position]
+        elif self._unpacked and venue_id in self._unpacked:
+            confidence = self._unpacked[venue_id]
+        else:
+            raise KeyError(venue_id)
+        if math.isnan(confidence):
+            raise KeyError(venue_id)
+        return confidence
+
+    def set_confidence(self, venue_id, confidence):
+        position = self._position(venue_id)
+        if position is not None:
+            self._confidences[position] = confidence
+        elif self._unpacked and venue_id in self._unpacked:
+            self._unpacked[venue_id] = confidence
+        else:
+            raise KeyError(venue_id)
+
+    def clear_confidences(self):
+        for position in xrange(len(self._confidences)):
+            self._confidences[position] = float('nan')
+        if self._unpacked:
+            for venue_id in self._unpacked:
+                self._unpacked[venue_id] = float('nan')
+
+    def confidences(self):
+        # (venue id, confidence) for every venue with a known confidence
+        for position in xrange(len(self._confidences)):
+            confidence = self._confidences[position]
+            if not math.isnan(confidence):
+                yield unpack_venue_id(self._key(position)), confidence
+        if self._unpacked:
+            for venue_id, confidence in self._unpacked.items():
+                if not math.isnan(confidence):
+                    yield venue_id, confidence
+
+
+class ConfidenceMap(object):
+    """
+    dict-like view of the confidences held in a VenueIdSet
+    """
+
+    __slots__ = ('_venues',)
+
+    def __init__(self, venues):
+        self._venues = venues
+
+    def __getitem__(self, venue_id):
+        return self._venues.get_confidence(venue_id)
+
+    def __setitem__(self, venue_id, confidence):
+        self._venues.set_confidence(venue_id, confidence)
+
+    def __contains__(self, venue_id):
+        try:
+            self._venues.get_confidence(venue_id)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, venue_id, default=None):
+        try:
+            return self._venues.get_confidence(venue_id)
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        return self._venues.confidences()
+
+    def items(self):
+        return list(self._venues.confidences())
+
+    def keys(self):
+        return [venue_id for venue_id, confidence in self._venues.confidences()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self._venues.confidences())
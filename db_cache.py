@@ -20,20 +20,67 @@ import json
 import calendar
 
 from pymongo import *
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from bson.objectid import ObjectId
+from contextlib import contextmanager
 from datetime import timedelta, datetime
 
+import metrics
+
+# where open_cache keeps its data: a mongodb:// url, sqlite:<directory> for
+# a SQLite file per database, or memory: to keep everything in memory
+DEFAULT_STORAGE = 'mongodb://localhost:27017/'
+
+# in-memory databases by name, so every cache opened in a process sees the
+# same data
+_memory_databases = {}
+
+
+class DuplicateDocumentError(Exception):
+    """
+    Raised when inserting a document whose _id is already in the collection
+    """
+    pass
+
+
+@contextmanager
+def _no_batch():
+    yield None
+
 
 class MongoDBCache(object):
+    """
+    The document store everything is kept in. By default this is a mongo
+    database, but any object with the pymongo database/collection API can
+    be passed as the database instead (see memory_cache and sqlite_cache).
+    """
 
-    def __init__(self, mongo_db='mongodb://localhost:27017/', db='test', refresh_time=timedelta(days=365)):
+    # the storage the cache is kept in, as reported in metrics
+    backend = 'mongo'
 
-        self.client = MongoClient(mongo_db)
-        self.db = self.client[db]
+    def __init__(self, mongo_db='mongodb://localhost:27017/', db='test', refresh_time=timedelta(days=365), database=None):
+
+        if database is None:
+            self.client = MongoClient(mongo_db)
+            self.db = self.client[db]
+        else:
+            self.client = None
+            self.db = database
 
         self.refresh_time = refresh_time
 
+    def batch(self):
+        """
+        Context manager grouping the writes made inside it into a single
+        transaction, for backends that have them (mongo writes are applied
+        as they are made)
+        """
+        if self.client is None and hasattr(self.db, 'batch'):
+            return self.db.batch()
+        return _no_batch()
+
 
+    @metrics.timed_collection_op('db')
     def document_exists(self, collection, query, check_fresh=False):
         """
         Checks to see if a document matching the query exists within the database. Will
@@ -66,6 +113,7 @@ class MongoDBCache(object):
         else:
             return False
 
+    @metrics.timed_collection_op('db')
     def get_document(self, collection, query, check_fresh=False):
         try:
             assert self.document_exists(collection, query, check_fresh)
@@ -74,24 +122,206 @@ class MongoDBCache(object):
             pass
         return self.db[collection].find_one(query)
 
-    def get_documents(self, collection, query):
-        return self.db[collection].find(query)
+    @metrics.timed_collection_op('db')
+    def get_fresh_document(self, collection, query, check_fresh=False, fields=None):
+        """
+        The document matching the query, or None if there isn't one (or, with
+        check_fresh, if it is stale). A single read, unlike calling
+        document_exists and then get_document.
+        """
+        if fields is not None and any(fields.values()):
+            # keep last_modified, to tell how fresh the document is
+            fields = dict(fields, last_modified=True)
+        item = self.db[collection].find_one(query, fields)
+        if item is not None and check_fresh and self.freshness(item) > 1:
+            return None
+        return item
 
+    def freshness(self, item):
+        """
+        How far through refresh_time a document is: 0 when it has just been
+        written, over 1 once it is stale. Documents without last_modified
+        never go stale.
+        """
+        if not item.get('last_modified'):
+            return 0.0
+        return (time.time() - item['last_modified']) / self.refresh_time.total_seconds()
+
+    @metrics.timed_collection_op('db', cursor=True)
+    def get_documents(self, collection, query, fields=None):
+        return self.db[collection].find(query, fields)
 
+
+    @metrics.timed_collection_op('db')
     def put_document(self, collection, data):
         if not data.get('last_modified'):
             data['last_modified'] = calendar.timegm(datetime.utcnow().utctimetuple())
         return self.db[collection].save(data)
 
 
+    @metrics.timed_collection_op('db')
+    def insert_document(self, collection, data):
+        """
+        Insert a new document, raising DuplicateDocumentError if one with the
+        same _id already exists (unlike put_document, which overwrites)
+        """
+        if not data.get('last_modified'):
+            data['last_modified'] = calendar.timegm(datetime.utcnow().utctimetuple())
+        try:
+            return self.db[collection].insert(data)
+        except DuplicateKeyError:
+            raise DuplicateDocumentError(data['_id'])
+
+
+    @metrics.timed_collection_op('db')
+    def insert_documents(self, collection, documents):
+        """
+        Insert many new documents in a single round trip. Documents whose _id
+        is already taken are skipped rather than failing the whole batch.
+        Returns the _ids of the documents that were inserted.
+        """
+        if not documents:
+            return []
+        now = calendar.timegm(datetime.utcnow().utctimetuple())
+        bulk = self.db[collection].initialize_unordered_bulk_op()
+        for data in documents:
+            if not data.get('last_modified'):
+                data['last_modified'] = now
+            bulk.insert(data)
+
+        skipped = set()
+        try:
+            with self.batch():
+                bulk.execute()
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            # anything other than a duplicate _id is a real failure
+            if e.details.get('writeConcernErrors') or any(error.get('code') != 11000 for error in errors):
+                raise
+            skipped = set(error['index'] for error in errors)
+        return [data['_id'] for i, data in enumerate(documents) if i not in skipped]
+
+
+    @metrics.timed_collection_op('db')
+    def update_document(self, collection, query, update, upsert=False):
+        """
+        Apply an update (using operators such as $set or $addToSet) to the
+        document matching the query, rather than rewriting the whole document.
+        Returns the number of documents matched (or inserted, for an upsert).
+        An upsert whose query doesn't match an existing _id raises
+        DuplicateDocumentError.
+        """
+        update.setdefault('$set', {})
+        if not update['$set'].get('last_modified'):
+            update['$set']['last_modified'] = calendar.timegm(datetime.utcnow().utctimetuple())
+        try:
+            result = self.db[collection].update(query, update, upsert=upsert)
+        except DuplicateKeyError:
+            raise DuplicateDocumentError(query.get('_id'))
+        return result['n']
+
+
+    @metrics.timed_collection_op('db')
+    def update_documents(self, collection, query, update):
+        """
+        Apply an update to every document matching the query. Returns the
+        number of documents matched.
+        """
+        update.setdefault('$set', {})
+        if not update['$set'].get('last_modified'):
+            update['$set']['last_modified'] = calendar.timegm(datetime.utcnow().utctimetuple())
+        return self.db[collection].update(query, update, multi=True)['n']
+
+
+    @metrics.timed_collection_op('db')
+    def find_and_modify(self, collection, query, update, sort=None):
+        """
+        Atomically apply an update to one document matching the query, and
+        return the updated document (or None if nothing matched)
+        """
+        update.setdefault('$set', {})
+        if not update['$set'].get('last_modified'):
+            update['$set']['last_modified'] = calendar.timegm(datetime.utcnow().utctimetuple())
+        return self.db[collection].find_and_modify(query, update, sort=sort, new=True)
+
+
+    def ensure_index(self, collection, key):
+        return self.db[collection].ensure_index(key)
+
+
+    @metrics.timed_collection_op('db', cursor=True)
     def get_collection(self, collection):
         return self.db[collection].find()
 
 
+    @metrics.timed_collection_op('db')
     def remove_document(self, collection, query):
         assert self.document_exists(collection, query, False)
         return self.db[collection].remove(query)
 
 
+    @metrics.timed_collection_op('db')
+    def remove_documents(self, collection, query):
+        # remove everything matching the query, which may be nothing
+        return self.db[collection].remove(query)
+
+
+    @metrics.timed_collection_op('db')
+    def bulk_update(self, collection, updates, upsert=False):
+        """
+        Apply many (query, update) pairs in a single round trip. Each update
+        applies to one document (inserted from the query, with upsert, if
+        there isn't one).
+        """
+        if not updates:
+            return 0
+        last_modified = calendar.timegm(datetime.utcnow().utctimetuple())
+        bulk = self.db[collection].initialize_unordered_bulk_op()
+        for query, update in updates:
+            update.setdefault('$set', {})
+            update['$set'].setdefault('last_modified', last_modified)
+            operation = bulk.find(query)
+            if upsert:
+                operation = operation.upsert()
+            operation.update_one(update)
+        with self.batch():
+            return bulk.execute()['nMatched']
+
+
+def open_cache(db_name='fsqexp', storage=None, refresh_time=timedelta(days=365), shared=False):
+    """
+    Open the cache for a database, in the storage given by the storage
+    argument, the CHAIN_STORAGE environment variable, or DEFAULT_STORAGE:
+
+        mongodb://host:port/    a mongo server
+        sqlite:<directory>      <directory>/<db_name>.sqlite, on this machine
+        memory:                 in memory, for tests and experiments
+
+    Memory storage belongs to the process that opened it, so it is refused
+    when the cache is shared with other processes (shared=True), which
+    would each see their own empty copy.
+    """
+    storage = storage or os.environ.get('CHAIN_STORAGE') or DEFAULT_STORAGE
+
+    if storage.startswith('mongodb://'):
+        return MongoDBCache(storage, db=db_name, refresh_time=refresh_time)
+
+    if storage.startswith('sqlite:'):
+        from sqlite_cache import SQLiteCache
+        directory = storage[len('sqlite:'):]
+        if directory.startswith('//'):
+            directory = directory[2:]
+        directory = directory or '.'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return SQLiteCache(os.path.join(directory, '%s.sqlite' % db_name), refresh_time=refresh_time)
+
+    if storage.startswith('memory:'):
+        if shared:
+            raise ValueError('memory: storage can not be shared between processes, use sqlite: or mongodb://')
+        from memory_cache import MemoryCache, MemoryDatabase
+        if db_name not in _memory_databases:
+            _memory_databases[db_name] = MemoryDatabase()
+        return MemoryCache(refresh_time=refresh_time, database=_memory_databases[db_name])
 
-        
\ No newline at end of file
+    raise ValueError('unknown storage %s' % storage)
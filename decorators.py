@@ -1,12 +1,17 @@
+from functools import wraps
+
+from venue_view import VenueView, as_venue_view
+
 def venue_response(func):
 
-    def venue_checker(*args):
-        # just need the venue data, not the whole API response
+    @wraps(func)
+    def venue_checker(*args, **kwargs):
+        # just need the venue data, not the whole API response - the
+        # venue is the first dict argument, wrap it in a view over the venue
+        args = list(args)
         for i, arg in enumerate(args):
-            if type(arg) == type(dict):
-                if arg.get('response'):
-                    args[i] = arg['response']['venue']
-
-            return func(*args)
+            if isinstance(arg, (dict, VenueView)):
+                args[i] = as_venue_view(arg)
+                break
+        return func(*args, **kwargs)
     return venue_checker
-
@@ -17,7 +17,7 @@
 import csv
 
 from decorators import venue_response
-from db_cache import MongoDBCache
+from db_cache import open_cache
 from chain_decision import ChainDecider
 from venue_searcher import VenueSearcher
 
@@ -25,24 +25,24 @@ from venue_searcher import VenueSearcher
 
 class LocalComparison():
 
-    def __init__(self):
+    def __init__(self, db_name='fsqexp', searcher=None, cache=None):
 
-        self.vs = VenueSearcher()
-        self.cd = ChainDecider()
-        self.db = MongoDBCache(db='fsqexp')
+        if cache is None:
+            cache = open_cache(db_name)
+        if searcher is None:
+            # a bulk job, so its API calls give way to interactive lookups
+            searcher = VenueSearcher(db_name, request_class='batch', cache=cache)
+        self.vs = searcher
+        self.cd = ChainDecider(db_name, cache=cache, searcher=self.vs)
+        self.db = cache
 
     def get_venue_ids(self):
         venues = []
-        # get all the venues from the database
-        db_venues = self.db.get_collection('venues').find(timeout=False)
+        # get all the venue ids from the database (venues are stored by id)
+        db_venues = self.db.get_documents('venues', {}, {'_id': True})
         
-        # extract information needed for comparison
         for v in db_venues:
-            # just work with venue information instead of whole response
-            if v.get('response'):
-                v = v['response']['venue']  
-                
-            venues.append(v['id'])
+            venues.append(v['_id'])
         return venues
 
     @venue_response
@@ -66,65 +66,73 @@ class LocalComparison():
 
         return chain_alternates, indie_alternates
 
+    def compare_venue(self, venue_id, distances):
+        """
+        Build the output row for one venue: whether it is a chain, and the
+        chain and independent alternatives within each distance
+        """
+        v = self.vs.get_venue_json(venue_id)
+
+        data = dict.fromkeys(data_fields(distances), "")
+        data['venue_id'] = v['id']
+        data['venue_name'] = v['name']
+        data['chain'] = self.cd.is_chain(v)
+
+        print v['name']
+
+        for distance in distances:
+            c_a, i_a = self.local_comparison(v, distance)
+
+            data['%d_chain_names' % distance] = []
+            data['%d_chain_ids' % distance] = []
+            data['%d_indie_names' % distance] = []
+            data['%d_indie_ids' % distance] = []
+
+            for alt in c_a:
+                if alt.get('response'):
+                    data['%d_chain_names' % distance].append(alt['response']['venue']['name'])
+                    data['%d_chain_ids' % distance].append(alt['response']['venue']['id'])
+                else:
+                    if alt.get('name'):
+                        data['%d_chain_names' % distance].append(alt['name'])
+                    if alt.get('id'):
+                        data['%d_chain_ids' % distance].append(alt['id'])
+
+            for alt in i_a:
+                if alt.get('response'):
+                    data['%d_indie_names' % distance].append(alt['response']['venue']['name'])
+                    data['%d_indie_ids' % distance].append(alt['response']['venue']['id'])
+                else:
+                    if alt.get('name'):
+                        data['%d_indie_names' % distance].append(alt['name'])
+                    if alt.get('id'):
+                        data['%d_indie_ids' % distance].append(alt['id'])
+
+        return data
+
+
+DISTANCES = [50, 250, 500]
+
+def data_fields(distances):
+    fields = ['venue_id', 'venue_name', 'chain']
+    for distance in distances:
+        fields.append('%d_indie_names' % distance)
+        fields.append('%d_indie_ids' % distance)
+        fields.append('%d_chain_names' % distance)
+        fields.append('%d_chain_ids' % distance)
+    return fields
+
 
 if __name__ == '__main__':
     
-    distances = [50, 250, 500]
-    
-    data_fields = ['venue_id', 'venue_name', 'chain']
-    for distance in distances:
-        data_fields.append('%d_indie_names' % distance)
-        data_fields.append('%d_indie_ids' % distance)
-        data_fields.append('%d_chain_names' % distance)
-        data_fields.append('%d_chain_ids' % distance)
-
     with open('chain_indie_data.csv', 'w') as output_file:
 
-        writer = csv.DictWriter(output_file, data_fields)
+        writer = csv.DictWriter(output_file, data_fields(DISTANCES))
         writer.writeheader()
 
         lc = LocalComparison()
         venues = lc.get_venue_ids()
 
         for venue in venues[0:1000]:
-
-            v = lc.vs.get_venue_json(venue)
-            
-            data = dict.fromkeys(data_fields, "")
-            data['venue_id'] = v['id']
-            data['venue_name'] = v['name']
-            data['chain'] = lc.cd.is_chain(v)
-
-            print v['name']
-
-            for distance in distances:
-                c_a, i_a = lc.local_comparison(v, distance)
-
-                data['%d_chain_names' % distance] = []
-                data['%d_chain_ids' % distance] = []
-                data['%d_indie_names' % distance] = []
-                data['%d_indie_ids' % distance] = []
-
-                for alt in c_a:
-                    if alt.get('response'):
-                        data['%d_chain_names' % distance],append(alt['response']['venue']['name'])
-                        data['%d_chain_ids' % distance],append(alt['response']['venue']['id'])
-                    else:
-                        if alt.get('name'):
-                            data['%d_chain_names' % distance].append(alt['name'])
-                        if alt.get('id'):
-                            data['%d_chain_ids' % distance].append(alt['id'])
-
-                for alt in i_a:
-                    if alt.get('response'):
-                        data['%d_indie_names' % distance].append(alt['response']['venue']['name'])
-                        data['%d_indie_ids' % distance].append(alt['response']['venue']['id'])
-                    else:
-                        if alt.get('name'):
-                            data['%d_indie_names' % distance].append(alt['name'])
-                        if alt.get('id'):
-                            data['%d_indie_ids' % distance].append(alt['id'])
-
-            writer.writerow(data)
-
+            writer.writerow(lc.compare_venue(venue, DISTANCES))
 
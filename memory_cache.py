@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+An in-memory storage backend, for benchmarks and experiments that
+shouldn't need a mongod. MemoryCache is a MongoDBCache whose database is
+held in dicts, implementing the parts of the pymongo collection API (and
+the query and update operators) that the cache uses. The query, projection
+and update code is shared with the SQLite backend (see sqlite_cache).
+"""
+
+import copy
+import uuid
+
+from datetime import timedelta
+
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from db_cache import MongoDBCache
+
+_missing = object()
+
+
+def _get_path(doc, path):
+    # values at a dotted path, looking inside arrays as mongo does
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        found.append(item[part])
+        values = found
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _compare(values, operator, operand):
+    if operator == '$in':
+        return any(value in operand for value in values) or (not values and None in operand)
+    if operator == '$nin':
+        return not _compare(values, '$in', operand)
+    if operator == '$ne':
+        return operand not in values and not (not values and operand is None)
+    if operator == '$exists':
+        return bool(values) == bool(operand)
+    if operator == '$lt':
+        return any(value is not None and value < operand for value in values)
+    if operator == '$lte':
+        return any(value is not None and value <= operand for value in values)
+    if operator == '$gt':
+        return any(value is not None and value > operand for value in values)
+    if operator == '$gte':
+        return any(value is not None and value >= operand for value in values)
+    raise ValueError('unsupported query operator %s' % operator)
+
+
+def matches(doc, query):
+    """
+    Whether a document matches a mongo query
+    """
+    for key, condition in query.iteritems():
+        if key == '$or':
+            if not any(matches(doc, q) for q in condition):
+                return False
+            continue
+        if key == '$and':
+            if not all(matches(doc, q) for q in condition):
+                return False
+            continue
+
+        values = _get_path(doc, key)
+        if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            for operator, operand in condition.iteritems():
+                if not _compare(values, operator, operand):
+                    return False
+        elif condition is None:
+            if values and None not in values:
+                return False
+        elif condition not in values:
+            return False
+    return True
+
+
+def project(doc, fields):
+    """
+    Copy of a document with a find() projection applied
+    """
+    if not fields:
+        return copy.deepcopy(doc)
+    if isinstance(fields, list):
+        fields = dict((field, True) for field in fields)
+
+    slices = dict((k, v['$slice']) for k, v in fields.iteritems() if isinstance(v, dict) and '$slice' in v)
+    flags = dict((k, v) for k, v in fields.iteritems() if k not in slices)
+    include = any(v for k, v in flags.iteritems() if k != '_id')
+
+    if include:
+        result = {}
+        if flags.get('_id', True) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for path, wanted in flags.iteritems():
+            if wanted and path != '_id':
+                _copy_path(doc, result, path.split('.'))
+    else:
+        result = copy.deepcopy(doc)
+        for path, wanted in flags.iteritems():
+            if not wanted:
+                _unset(result, path)
+
+    for path, count in slices.iteritems():
+        value = _get_one(doc, path)
+        if isinstance(value, list):
+            _set(result, path, copy.deepcopy(value[:count] if count >= 0 else value[count:]))
+    return result
+
+
+def _copy_path(source, target, parts):
+    if not isinstance(source, dict) or parts[0] not in source:
+        return
+    value = source[parts[0]]
+    if len(parts) == 1:
+        target[parts[0]] = copy.deepcopy(value)
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(parts[0], {}), parts[1:])
+    elif isinstance(value, list):
+        items = target.setdefault(parts[0], [{} for item in value])
+        for item, copied in zip(value, items):
+            _copy_path(item, copied, parts[1:])
+
+
+def _get_one(doc, path, default=None):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return default
+        doc = doc[part]
+    return doc
+
+
+def _parent(doc, path, create=True):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if part not in doc:
+            if not create:
+                return None, parts[-1]
+            doc[part] = {}
+        doc = doc[part]
+    return doc, parts[-1]
+
+
+def _set(doc, path, value):
+    parent, key = _parent(doc, path)
+    parent[key] = value
+
+
+def _unset(doc, path):
+    parent, key = _parent(doc, path, create=False)
+    if parent is not None:
+        parent.pop(key, None)
+
+
+def _pull_matches(item, condition):
+    if isinstance(condition, dict):
+        if condition and all(k.startswith('$') for k in condition):
+            return all(_compare([item], operator, operand) for operator, operand in condition.iteritems())
+        return isinstance(item, dict) and matches(item, condition)
+    return item == condition
+
+
+def apply_update(doc, update, inserting=False):
+    """
+    Apply a mongo update (operators, or a replacement document) in place
+    """
+    if not any(key.startswith('$') for key in update):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+
+    for operator, changes in update.iteritems():
+        for path, value in changes.iteritems():
+            value = copy.deepcopy(value)
+            if operator == '$set':
+                _set(doc, path, value)
+            elif operator == '$setOnInsert':
+                if inserting:
+                    _set(doc, path, value)
+            elif operator == '$unset':
+                _unset(doc, path)
+            elif operator == '$inc':
+                _set(doc, path, _get_one(doc, path, 0) + value)
+            elif operator == '$addToSet':
+                current = _get_one(doc, path)
+                if current is None:
+                    current = []
+                    _set(doc, path, current)
+                each = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                for item in each:
+                    if item not in current:
+                        current.append(item)
+            elif operator == '$push':
+                current = _get_one(doc, path)
+                if current is None:
+                    current = []
+                    _set(doc, path, current)
+                if isinstance(value, dict) and '$each' in value:
+                    current.extend(value['$each'])
+                    if '$sort' in value:
+                        for key, direction in reversed(value['$sort'].items()):
+                            current.sort(key=lambda item: item.get(key), reverse=direction < 0)
+                    if '$slice' in value:
+                        count = value['$slice']
+                        current[:] = current[:count] if count >= 0 else current[count:]
+                else:
+                    current.append(value)
+            elif operator == '$pull':
+                current = _get_one(doc, path)
+                if isinstance(current, list):
+                    current[:] = [item for item in current if not _pull_matches(item, value)]
+            else:
+                raise ValueError('unsupported update operator %s' % operator)
+
+
+class MemoryCursor(object):
+    """
+    The parts of a pymongo cursor the cache uses
+    """
+
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for key, direction in reversed(keys):
+            self._docs.sort(key=lambda doc: _get_one(doc, key), reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self._docs = self._docs[count:]
+        return self
+
+    def limit(self, count):
+        if count:
+            self._docs = self._docs[:count]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def count(self):
+        return len(self._docs)
+
+    def __getitem__(self, i):
+        return self._docs[i]
+
+    def __iter__(self):
+        return iter(self._docs)
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class MemoryBulk(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.operations = []
+        self.inserts = []
+
+    def insert(self, document):
+        if '_id' not in document:
+            document['_id'] = uuid.uuid4().hex
+        self.inserts.append(document)
+
+    def find(self, query):
+        bulk = self
+
+        class Operation(object):
+            upserting = False
+
+            def upsert(self):
+                self.upserting = True
+                return self
+
+            def update_one(self, update):
+                bulk.operations.append((query, update, self.upserting))
+
+        return Operation()
+
+    def execute(self):
+        # error indexes count the inserts only: the cache never mixes
+        # inserts and updates in one bulk operation
+        inserted = 0
+        errors = []
+        for index, document in enumerate(self.inserts):
+            try:
+                self.collection.insert(document)
+                inserted += 1
+            except DuplicateKeyError as e:
+                errors.append({'index': index, 'code': 11000, 'errmsg': str(e)})
+
+        matched = 0
+        upserted = 0
+        for query, update, upsert in self.operations:
+            result = self.collection.update(query, update, upsert=upsert)
+            if result.get('upserted') is not None:
+                upserted += 1
+            else:
+                matched += result['n']
+
+        result = {'nInserted': inserted, 'nMatched': matched, 'nUpserted': upserted}
+        if errors:
+            result['writeErrors'] = errors
+            raise BulkWriteError(result)
+        return result
+
+
+class MemoryCollection(object):
+    """
+    A collection held in a dict of _id -> document
+    """
+
+    def __init__(self):
+        self.docs = {}
+
+    def _matching(self, query):
+        query = query or {}
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self.docs.get(query['_id'])
+            return [doc] if doc is not None and matches(doc, query) else []
+        return [doc for doc in self.docs.itervalues() if matches(doc, query)]
+
+    def find(self, query=None, fields=None, **kwargs):
+        return MemoryCursor([project(doc, fields) for doc in self._matching(query)])
+
+    def find_one(self, query=None, fields=None):
+        for doc in self._matching(query):
+            return project(doc, fields)
+        return None
+
+    def _insert_one(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = uuid.uuid4().hex
+        if doc['_id'] in self.docs:
+            raise DuplicateKeyError('duplicate key %s' % doc['_id'])
+        self.docs[doc['_id']] = copy.deepcopy(doc)
+        return doc['_id']
+
+    def insert(self, docs, continue_on_error=False, **kwargs):
+        if isinstance(docs, dict):
+            return self._insert_one(docs)
+        ids = []
+        duplicate = None
+        for doc in docs:
+            try:
+                ids.append(self._insert_one(doc))
+            except DuplicateKeyError as e:
+                if not continue_on_error:
+                    raise
+                duplicate = e
+        if duplicate is not None:
+            raise duplicate
+        return ids
+
+    def save(self, doc, **kwargs):
+        if '_id' not in doc:
+            doc['_id'] = uuid.uuid4().hex
+        self.docs[doc['_id']] = copy.deepcopy(doc)
+        return doc['_id']
+
+    def update(self, query, update, upsert=False, multi=False, **kwargs):
+        docs = self._matching(query)
+        if not multi:
+            docs = docs[:1]
+        for doc in docs:
+            apply_update(doc, update)
+        if docs or not upsert:
+            return {'n': len(docs), 'updatedExisting': bool(docs)}
+
+        # upsert: a new document from the query's plain values
+        doc = {}
+        for key, value in query.iteritems():
+            if not key.startswith('$') and not (isinstance(value, dict) and any(k.startswith('$') for k in value)):
+                _set(doc, key, copy.deepcopy(value))
+        apply_update(doc, update, inserting=True)
+        self._insert_one(doc)
+        return {'n': 1, 'updatedExisting': False, 'upserted': doc['_id']}
+
+    def find_and_modify(self, query, update, sort=None, new=False, upsert=False, **kwargs):
+        docs = MemoryCursor(self._matching(query))
+        if sort:
+            docs.sort(sort)
+        for doc in docs:
+            before = copy.deepcopy(doc)
+            apply_update(doc, update)
+            return copy.deepcopy(doc) if new else before
+        if upsert:
+            self.update(query, update, upsert=True)
+            return self.find_one(query) if new else None
+        return None
+
+    def remove(self, query=None, **kwargs):
+        docs = self._matching(query)
+        for doc in docs:
+            del self.docs[doc['_id']]
+        return {'n': len(docs)}
+
+    def ensure_index(self, key, **kwargs):
+        pass
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+
+class MemoryDatabase(object):
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection()
+        return self.collections[name]
+
+
+class MemoryCache(MongoDBCache):
+    """
+    A MongoDBCache held entirely in memory
+    """
+
+    backend = 'memory'
+
+    def __init__(self, refresh_time=timedelta(days=365), database=None):
+        if database is None:
+            database = MemoryDatabase()
+        MongoDBCache.__init__(self, refresh_time=refresh_time, database=database)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Counters and timers for the matching stack.
+
+Metrics are off unless enable() is called (or CHAIN_METRICS is set in the
+environment); while off, inc() and timed() return straight away. Hot loops
+can check metrics.enabled themselves to skip even the call.
+
+    import metrics
+    metrics.enable()
+    metrics.inc('venues', stage='lookup')
+    with metrics.timed('db', op='find', collection='venues'):
+        ...
+    metrics.start_dumper(60, 'metrics.json', 'metrics.prom')
+
+Counters are exported as chain_<name>_total, timers as chain_<name>_calls
+and chain_<name>_seconds_total, and gauges (set_gauge) as chain_<name>.
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+
+enabled = bool(os.environ.get('CHAIN_METRICS'))
+
+_lock = threading.Lock()
+
+# (name, labels) -> count, (name, labels) -> [calls, seconds] and
+# (name, labels) -> value
+_counters = {}
+_timers = {}
+_gauges = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _gauges.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.iteritems()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Add value to a counter
+    """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge to its current value
+    """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def record(name, seconds, **labels):
+    """
+    Record one timed call
+    """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            timer = _timers[key] = [0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+
+
+class _Timer(object):
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.time() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+def timed(name, **labels):
+    """
+    Context manager timing the block it wraps
+    """
+    if not enabled:
+        return _null_timer
+    return _Timer(name, labels)
+
+
+class _TimedCursor(object):
+    """
+    Wraps a cursor so that the round trips made while it is read are timed
+    too, not just its creation. The time spent iterating is recorded once
+    the cursor is exhausted or dropped (as op '<op>.iterate'), and any other
+    call that reads from the server, such as count(), on its own.
+    """
+
+    def __init__(self, cursor, name, labels):
+        self._cursor = cursor
+        self._name = name
+        self._labels = labels
+
+    def __getattr__(self, attribute):
+        value = getattr(self._cursor, attribute)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            start = time.time()
+            result = value(*args, **kwargs)
+            if result is self._cursor:
+                # sort(), limit()... return the cursor, to chain calls
+                return self
+            record(self._name, time.time() - start, **self._op('.' + attribute))
+            return result
+        return call
+
+    def _op(self, suffix):
+        labels = dict(self._labels)
+        labels['op'] += suffix
+        return labels
+
+    def __iter__(self):
+        seconds = 0.0
+        iterator = iter(self._cursor)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                finally:
+                    seconds += time.time() - start
+                yield item
+        except StopIteration:
+            pass
+        finally:
+            record(self._name, seconds, **self._op('.iterate'))
+
+    def __getitem__(self, i):
+        with timed(self._name, **self._op('.getitem')):
+            return self._cursor[i]
+
+    def __len__(self):
+        return len(self._cursor)
+
+
+def timed_collection_op(name, cursor=False):
+    """
+    Decorator for MongoDBCache methods (whose first argument is the
+    collection), timing each call by operation, collection and backend (the
+    cache's backend attribute). With cursor, the method returns a cursor,
+    which is wrapped so that reading it is timed as well.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, collection, *args, **kwargs):
+            if not enabled:
+                return method(self, collection, *args, **kwargs)
+            labels = {'op': method.__name__, 'collection': collection, 'backend': self.backend}
+            start = time.time()
+            try:
+                result = method(self, collection, *args, **kwargs)
+            finally:
+                record(name, time.time() - start, **labels)
+            if cursor:
+                return _TimedCursor(result, name, labels)
+            return result
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    The current metrics, as a JSON-friendly dict
+    """
+    with _lock:
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.iteritems())]
+        timers = [{'name': name, 'labels': dict(labels), 'calls': calls, 'seconds': seconds}
+                  for (name, labels), (calls, seconds) in sorted(_timers.iteritems())]
+        gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                  for (name, labels), value in sorted(_gauges.iteritems())]
+    return {'time': time.time(), 'counters': counters, 'timers': timers, 'gauges': gauges}
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.iteritems()))
+
+
+def to_prometheus(snap=None):
+    """
+    The metrics in the Prometheus text exposition format
+    """
+    if snap is None:
+        snap = snapshot()
+    lines = []
+    typed = set()
+    for counter in snap['counters']:
+        metric = 'chain_%s_total' % counter['name']
+        if metric not in typed:
+            lines.append('# TYPE %s counter' % metric)
+            typed.add(metric)
+        lines.append('%s%s %s' % (metric, _prometheus_labels(counter['labels']), counter['value']))
+    # each metric's samples have to be grouped together
+    for suffix, field in [('calls', 'calls'), ('seconds_total', 'seconds')]:
+        for timer in snap['timers']:
+            metric = 'chain_%s_%s' % (timer['name'], suffix)
+            if metric not in typed:
+                lines.append('# TYPE %s counter' % metric)
+                typed.add(metric)
+            lines.append('%s%s %s' % (metric, _prometheus_labels(timer['labels']), timer[field]))
+    for gauge in snap.get('gauges', []):
+        metric = 'chain_%s' % gauge['name']
+        if metric not in typed:
+            lines.append('# TYPE %s gauge' % metric)
+            typed.add(metric)
+        lines.append('%s%s %s' % (metric, _prometheus_labels(gauge['labels']), gauge['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path, data):
+    # write then rename, so scrapers never read a half-written file
+    temp = '%s.tmp' % path
+    with open(temp, 'w') as f:
+        f.write(data)
+    os.rename(temp, path)
+
+
+def dump(json_path=None, prometheus_path=None):
+    snap = snapshot()
+    if json_path:
+        _write(json_path, json.dumps(snap, indent=2))
+    if prometheus_path:
+        _write(prometheus_path, to_prometheus(snap))
+
+
+class Dumper(threading.Thread):
+    """
+    Dumps the metrics every interval seconds in the background
+    """
+
+    def __init__(self, interval, json_path=None, prometheus_path=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            dump(self.json_path, self.prometheus_path)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        dump(self.json_path, self.prometheus_path)
+
+
+def start_dumper(interval=60, json_path='metrics.json', prometheus_path='metrics.prom'):
+    """
+    Turn metrics on and dump them periodically. Returns the Dumper, whose
+    stop() writes a final dump.
+    """
+    enable()
+    dumper = Dumper(interval, json_path, prometheus_path)
+    dumper.start()
+    return dumper
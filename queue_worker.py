@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Worker entry point for draining a WorkQueue of venue ids.
+
+    # fill the queue (once, from anywhere)
+    python queue_worker.py match --enqueue
+
+    # then start as many workers as you like, on as many machines as you
+    # like, all pointing at the same mongod
+    python queue_worker.py match --workers 4
+    python queue_worker.py local --workers 2
+
+'match' runs the chain matcher over each venue, 'local' runs the local
+chain/independent comparison and writes its rows to a csv file per worker.
+"""
+
+import csv
+import argparse
+import multiprocessing
+
+from db_cache import open_cache
+from work_queue import WorkQueue, drain, default_worker_id
+from venue_view import read_min_venues
+
+
+def match_worker(db_name, cache=None, refresh_every=100):
+    from venue_view import VenueView, venue_projection
+    from cache_chain_matching import CacheChainMatcher
+
+    ccm = CacheChainMatcher(db_name=db_name, cache=cache)
+    processed = [0]
+
+    def process_venue(venue_id, position):
+        # other workers are adding to the chains as we go, so every
+        # refresh_every venues pick up the lookups they have written
+        if processed[0] and processed[0] % refresh_every == 0:
+            ccm.lookup.refresh()
+        processed[0] += 1
+
+        venue = ccm.cache.get_fresh_document('venues', {'_id': venue_id}, fields=venue_projection())
+        if venue is not None:
+            # as in do_matching, only the csv rows after the venue are compared
+            ccm.i = position or 0
+            ccm.match_venue(VenueView(venue))
+
+    return process_venue, None
+
+
+def local_worker(db_name):
+    from local_options import LocalComparison, DISTANCES, data_fields
+
+    lc = LocalComparison(db_name)
+
+    # every worker writes its own output, to be concatenated afterwards
+    output_file = open('chain_indie_data.%s.csv' % default_worker_id().replace(':', '.'), 'w')
+    writer = csv.DictWriter(output_file, data_fields(DISTANCES))
+    writer.writeheader()
+
+    def process_venue(venue_id, position):
+        writer.writerow(lc.compare_venue(venue_id, DISTANCES))
+        output_file.flush()
+
+    return process_venue, output_file
+
+
+WORKERS = {
+    'match': match_worker,
+    'local': local_worker,
+}
+
+
+def enqueue(job, db_name, batch_size):
+    cache = open_cache(db_name, shared=True)
+    queue = WorkQueue(cache, job)
+
+    if job == 'match':
+        # the matcher works through the venues in the csv file, and the jobs
+        # keep their positions in it
+        venue_ids = [row['id'] for row in read_min_venues()]
+    else:
+        venue_ids = [v['_id'] for v in cache.get_documents('venues', {}, {'_id': True})]
+
+    added = queue.enqueue(venue_ids, batch_size)
+    print '%d jobs added to %s' % (added, job)
+
+
+def run_worker(job, db_name, lease_time, idle_wait):
+    cache = open_cache(db_name, shared=True)
+    queue = WorkQueue(cache, job, lease_time=lease_time)
+
+    process_venue, output_file = WORKERS[job](db_name)
+    try:
+        completed = drain(queue, process_venue, idle_wait=idle_wait)
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    print '%s completed %d jobs' % (default_worker_id(), completed)
+    return completed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Drain a queue of venue ids')
+    parser.add_argument('job', choices=sorted(WORKERS.keys()))
+    parser.add_argument('--db', default='fsqexp')
+    parser.add_argument('--enqueue', action='store_true', help='fill the queue instead of working on it')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes to start here')
+    parser.add_argument('--lease-time', type=int, default=300)
+    parser.add_argument('--idle-wait', type=float, default=None,
+                        help='keep polling for work every IDLE_WAIT seconds rather than stopping when empty')
+    args = parser.parse_args()
+
+    if args.enqueue:
+        enqueue(args.job, args.db, args.batch_size)
+    elif args.workers == 1:
+        run_worker(args.job, args.db, args.lease_time, args.idle_wait)
+    else:
+        processes = []
+        for i in range(args.workers):
+            p = multiprocessing.Process(target=run_worker, args=(args.job, args.db, args.lease_time, args.idle_wait))
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join()
+
+        queue = WorkQueue(open_cache(args.db, shared=True), args.job)
+        queue.reap()
+        print queue.counts()
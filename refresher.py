@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import Queue
+import threading
+import traceback
+
+import metrics
+
+
+class Refresher:
+    """
+    A small pool of background threads that refresh cached documents, so
+    callers can be given the cached copy straight away (see VenueSearcher's
+    revalidate mode).
+
+    Each refresh is submitted under a key, and a key that is already waiting
+    isn't queued again. The queue is bounded: when it is full, refreshes are
+    dropped rather than making the caller wait, and the document will be
+    submitted again the next time it is read.
+    """
+
+    def __init__(self, workers=2, max_pending=1000):
+
+        self.queue = Queue.Queue(max_pending)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='refresher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func, *args):
+        """
+        Queue func(*args) to be run in the background, unless a refresh for
+        key is already waiting. Returns whether it was queued.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        try:
+            self.queue.put_nowait((key, func, args))
+        except Queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+            metrics.inc('refreshes', outcome='dropped')
+            return False
+        metrics.inc('refreshes', outcome='queued')
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            key, func, args = item
+            try:
+                func(*args)
+                metrics.inc('refreshes', outcome='done')
+            except Exception:
+                metrics.inc('refreshes', outcome='error')
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Wait for everything queued so far to be refreshed
+        """
+        self.queue.join()
+
+    def stop(self):
+        """
+        Finish the refreshes already queued, then stop the threads
+        """
+        for thread in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -22,11 +22,12 @@ import json
 import codecs
 import itertools
 
-from collections import defaultdict
 from Levenshtein import ratio
 from urlparse import urlparse
 
 from db_cache import MongoDBCache
+from assets import CategoryIndex
+from blocking import BlockIndex, name_similarity, sorted_neighbourhood
 from venue_match import get_min_venue_from_csv
 from chain_manager import ChainManager
 from chain_match import find_best_chain_match
@@ -44,12 +45,20 @@ class Chain:
     def __repr__(self):
         return json.dumps({'id': self.id, 'venues': list(self.venues)})
 
+# blocks bigger than this are split by a secondary key, or left out and
+# reported if that doesn't bring them under the limit
+MAX_BLOCK_SIZE = 1000
+
+# how many neighbours each venue is compared with in the similar name passes
+# (python blocking.py prints recall and runtime for other window sizes)
+WINDOW_SIZE = 10
+
 csv_reader = csv.DictReader(open('min_venues.csv', 'r'))  #, 'utf-8'))
 
-name_ids = defaultdict(list)
-url_ids = defaultdict(list)
-twitter_ids = defaultdict(list)
-facebook_ids = defaultdict(list)
+name_ids = BlockIndex(MAX_BLOCK_SIZE)
+url_ids = BlockIndex(MAX_BLOCK_SIZE)
+twitter_ids = BlockIndex(MAX_BLOCK_SIZE)
+facebook_ids = BlockIndex(MAX_BLOCK_SIZE)
 
 venues = {}
 chain_lookup = {}
@@ -62,21 +71,42 @@ for i, v in enumerate(csv_reader):
 
     venue = get_min_venue_from_csv(v)
     venues[venue['id']] = venue
-    name_ids[venue['name']].append(venue['id'])
+    name_ids.add(venue['name'], venue['id'])
 
     if venue.get('url'):
         url = urlparse(venue['url']).netloc.lstrip("http://").lstrip('www.').lstrip().rstrip()
-        if url is not "":
-            url_ids[url].append(venue['id'])
+        url_ids.add(url, venue['id'])
 
     if venue.get('contact'):
         if venue['contact'].get('twitter'):
             t = venue['contact']['twitter']
-            twitter_ids[t].append(venue['id'])
+            twitter_ids.add(t, venue['id'])
 
         if venue['contact'].get('facebook'):
             f = venue['contact']['facebook']
-            facebook_ids[f].append(venue['id'])
+            facebook_ids.add(f, venue['id'])
+
+
+ct = CategoryIndex()
+
+def category_root(venue_id):
+    # secondary key: root of the venue's primary category
+    categories = venues[venue_id].get('categories')
+    if categories:
+        root = ct.get_root_node_for_id(categories[0])
+        if root is not None:
+            return root['foursq_id']
+    return None
+
+def url_or_category(venue_id):
+    # secondary key for names: the website if there is one
+    url = venues[venue_id].get('url')
+    if url:
+        return 'url:' + urlparse(url).netloc
+    root = category_root(venue_id)
+    if root is not None:
+        return 'category:' + root
+    return None
 
 
 # cache = MongoDBCache(db='fsqexp')
@@ -85,80 +115,83 @@ chains = {}
 
 print 'name'
 
-for name, vs in name_ids.iteritems():
-    if len(vs) > 1:
-        if name is not " ":
-            print name, len(vs)
-            chain = Chain()
-            chain.venues = chain.venues | set(vs)
-            chains[chain.id] = chain
-            for v in vs:
-                chain_lookup[v] = chain.id
+for name, vs in name_ids.blocks(url_or_category):
+    print name, len(vs)
+    chain = Chain()
+    chain.venues = chain.venues | set(vs)
+    chains[chain.id] = chain
+    for v in vs:
+        chain_lookup[v] = chain.id
+
+# chain id -> size the chain would have grown to, for the joins that were
+# refused because the chain was already at MAX_BLOCK_SIZE
+capped = {}
+
+def add_block(vs):
+    # put a block of venues into a chain, joining the chain any of them
+    # are already in. Blocks join chains together transitively (A~B, B~C...), so
+    # a chain is not allowed to grow past MAX_BLOCK_SIZE
+    cchains = set()
+    for v in vs:
+        if chain_lookup.get(v):
+            cchains.add(chain_lookup[v])
+    if len(cchains) > 1:
+        print 'more than one chain!'
+    if len(cchains) >  0:
+        chain = chains[list(cchains)[0]]
+        size = len(chain.venues | set(vs))
+        if size > MAX_BLOCK_SIZE:
+            capped[chain.id] = max(size, capped.get(chain.id, 0))
+            return
+        chain.venues = chain.venues | set(vs)
+    else:
+        chain = Chain()
+        chain.venues = chain.venues | set(vs)
+        chains[chain.id] = chain
+    for v in vs:
+        chain_lookup[v] = chain.id
+
+print 'similar names'
+
+# near-identical names ('Starbucks', 'Starbucks Coffee') from a few passes
+# over the venues sorted by name, comparing only neighbours
+similar = name_similarity(name_ids)
+for v1, v2 in sorted_neighbourhood([(v, venues[v]['name']) for v in venues], WINDOW_SIZE, similar):
+    add_block([v1, v2])
 
 print 'urls'
 
-for u, vs in url_ids.iteritems():
+for u, vs in url_ids.blocks(category_root):
     if len(vs) > 1:
         print u, len(vs)
-        cchains = set()
-        for v in vs:
-            if chain_lookup.get(v):
-                cchains.add(chain_lookup[v])
-        if len(cchains) > 1:
-            print 'more than one chain!'
-        if len(cchains) >  0:
-            chain = chains[list(cchains)[0]]
-            chain.venues = chain.venues | set(vs)
-        else:
-            chain = Chain()
-            chain.venues = chain.venues | set(vs)
-            chains[chain.id] = chain
-        for v in vs:
-            chain_lookup[v] = chain.id
+        add_block(vs)
 
 print 'twitter'
 
-for t, vs in twitter_ids.iteritems():
+for t, vs in twitter_ids.blocks(category_root):
     if len(vs) > 1:
         print t, len(vs)
-        cchains = set()
-        for v in vs:
-            if chain_lookup.get(v):
-                cchains.add(chain_lookup[v])
-        if len(cchains) > 1:
-            print 'more than one chain!'
-        if len(cchains) >  0:
-            chain = chains[list(cchains)[0]]
-            chain.venues = chain.venues | set(vs)
-        else:
-            chain = Chain()
-            chain.venues = chain.venues | set(vs)
-            chains[chain.id] = chain
-        for v in vs:
-            chain_lookup[v] = chain.id
+        add_block(vs)
 
 print 'facebook'
 
-for f, vs in facebook_ids.iteritems():
+for f, vs in facebook_ids.blocks(category_root):
     if len(vs) > 1:
         print f, len(vs)
-        cchains = set()
-        for v in vs:
-            if chain_lookup.get(v):
-                cchains.add(chain_lookup[v])
-        if len(cchains) > 1:
-            print 'more than one chain!'
-        if len(cchains) >  0:
-            chain = chains[list(cchains)[0]]
-            chain.venues = chain.venues | set(vs)
-        else:
-            chain = Chain()
-            chain.venues = chain.venues | set(vs)
-            chains[chain.id] = chain
-        for v in vs:
-            chain_lookup[v] = chain.id
-
-  
+        add_block(vs)
+
+
+# blocks that were too common to use, even after splitting
+oversized = {}
+for label, index in [('name', name_ids), ('url', url_ids), ('twitter', twitter_ids), ('facebook', facebook_ids)]:
+    for key, size in index.oversized.iteritems():
+        oversized['%s:%s' % (label, key)] = size
+for chain_id, size in capped.iteritems():
+    oversized['chain:%s' % chain_id] = size
+print '%d oversized blocks left out' % len(oversized)
+with open('oversized_blocks.json', 'w') as blocks_file:
+    json.dump(oversized, blocks_file)
+
 with open('chain_lookup_with_names.json', 'w') as chain_file:
     json.dump(chain_lookup, chain_file)
 
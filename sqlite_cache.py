@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+An embedded storage backend for MongoDBCache, so single machine runs don't
+need a mongod. Each collection is a SQLite table of (_id, JSON document),
+keyed on _id, and fields passed to ensure_index get an index on their JSON
+value. Queries, projections and updates are evaluated with the same code
+as the in-memory backend (see memory_cache).
+
+Every write is its own transaction, unless it's made inside a
+cache.batch() block, in which case the whole block is one transaction:
+
+    cache = SQLiteCache('fsqexp.sqlite')
+    with cache.batch():
+        for venue in venues:
+            cache.put_document('venues', venue)
+
+Write transactions take the write lock when they begin, and wait up to
+timeout seconds for other processes to release it. Reads are streamed
+from the table, a chunk of rows at a time.
+"""
+
+import re
+import json
+import uuid
+import base64
+import sqlite3
+import itertools
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+from db_cache import MongoDBCache
+from memory_cache import MemoryCursor, MemoryBulk, matches, project, apply_update, _set
+
+# sqlite allows 999 parameters in a statement
+_MAX_PARAMETERS = 900
+
+# rows fetched from a cursor at a time
+_FETCH_SIZE = 500
+
+# range operators that can be evaluated by sqlite
+_RANGE_OPERATORS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def _encode_default(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError('%r can not be stored' % (value,))
+
+
+def _encode_binary(value):
+    # Binary is a str, so json would try to store it as text
+    if isinstance(value, Binary):
+        return {'$binary': base64.b64encode(value)}
+    if isinstance(value, dict):
+        return dict((k, _encode_binary(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_encode_binary(v) for v in value]
+    return value
+
+
+def _decode_hook(value):
+    if len(value) == 1 and '$binary' in value:
+        return Binary(base64.b64decode(value['$binary']))
+    if len(value) == 1 and '$date' in value:
+        try:
+            return datetime.strptime(value['$date'], '%Y-%m-%dT%H:%M:%S.%f')
+        except ValueError:
+            return datetime.strptime(value['$date'], '%Y-%m-%dT%H:%M:%S')
+    return value
+
+
+def _dumps(doc):
+    return json.dumps(_encode_binary(doc), default=_encode_default, separators=(',', ':'))
+
+
+def _loads(data):
+    return json.loads(data, object_hook=_decode_hook)
+
+
+def _key(_id):
+    # json, so that '1' and 1 are different keys, as they are in mongo
+    return _dumps(_id)
+
+
+def _is_scalar(value):
+    return isinstance(value, (basestring, int, long, float)) and not isinstance(value, bool)
+
+
+def _is_range(value):
+    return isinstance(value, dict) and value and \
+        all(op in _RANGE_OPERATORS and _is_scalar(bound) for op, bound in value.iteritems())
+
+
+def _field_value(field):
+    # the sql for a field's value, written out in full so that sqlite can
+    # match it with the index made by ensure_index
+    return "json_extract(doc, '$.%s')" % re.sub(r'[^A-Za-z0-9_.]', '', field)
+
+
+def _id_order(sort):
+    # the direction of a sort on _id alone, which sqlite can do, or None
+    if sort and len(sort) == 1 and sort[0][0] == '_id':
+        return sort[0][1]
+    return None
+
+
+class SQLiteCursor(object):
+    """
+    The parts of a pymongo cursor the cache uses. Documents are read from
+    the table as the cursor is iterated; sorts on _id are done by sqlite,
+    any other sort reads all the documents first.
+    """
+
+    def __init__(self, collection, query, fields):
+        self._collection = collection
+        self._query = query or {}
+        self._fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._docs = None
+
+    def sort(self, key, direction=1):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def count(self):
+        if not self._query:
+            return self._collection._count()
+        return sum(1 for doc in self._collection._matching(self._query))
+
+    def _generate(self):
+        order = _id_order(self._sort)
+        docs = self._collection._matching(self._query, order)
+        if self._sort and order is None:
+            docs = MemoryCursor(list(docs)).sort(self._sort)
+        end = self._skip + self._limit if self._limit else None
+        for doc in itertools.islice(docs, self._skip, end):
+            yield project(doc, self._fields)
+
+    def _all(self):
+        if self._docs is None:
+            self._docs = list(self._generate())
+        return self._docs
+
+    def __getitem__(self, i):
+        return self._all()[i]
+
+    def __iter__(self):
+        if self._docs is not None:
+            return iter(self._docs)
+        return self._generate()
+
+    def __len__(self):
+        return len(self._all())
+
+
+class SQLiteCollection(object):
+    """
+    A collection stored in a SQLite table, with the parts of the pymongo
+    collection API that the cache uses
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.table = '"c_%s"' % re.sub(r'[^A-Za-z0-9_]', '_', name)
+        # fields with an index on their value
+        self.indexed = set()
+
+        with self.database.batch() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, doc TEXT NOT NULL)' % self.table)
+            # ordered and range queries on _id go through the value of _id
+            # (the id column holds its json, which sorts differently)
+            c.execute('CREATE INDEX IF NOT EXISTS "i_%s__id" ON %s (%s)' % (self.table.strip('"'), self.table, _field_value('_id')))
+            prefix = 'i_%s_' % self.table.strip('"')
+            for (index,) in c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE ?", (prefix + '%',)):
+                self.indexed.add(index[len(prefix):].replace('__', '.'))
+
+    def _rows(self, sql, parameters=()):
+        # stream the documents, taking the connection for one chunk of rows
+        # at a time
+        with self.database.lock:
+            cursor = self.database.connection.execute(sql, parameters)
+        while True:
+            with self.database.lock:
+                rows = cursor.fetchmany(_FETCH_SIZE)
+            if not rows:
+                break
+            for (doc,) in rows:
+                yield _loads(doc)
+
+    def _count(self):
+        with self.database.lock:
+            return self.database.connection.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def _matching(self, query, order=None):
+        """
+        The documents matching the query, sorted by _id in the given
+        direction if order is given. Lookups by _id go through the primary
+        key, and equality and ranges on _id or an indexed field are left to
+        sqlite (with its indexes); what's left of the query is evaluated on
+        the documents sqlite returns.
+        """
+        query = query or {}
+
+        _id = query.get('_id')
+        if isinstance(_id, dict) and list(_id.keys()) == ['$in']:
+            docs = []
+            keys = [_key(value) for value in _id['$in']]
+            for start in xrange(0, len(keys), _MAX_PARAMETERS):
+                chunk = keys[start:start + _MAX_PARAMETERS]
+                docs.extend(self._rows('SELECT doc FROM %s WHERE id IN (%s)' % (self.table, ','.join('?' * len(chunk))), chunk))
+            if order is not None:
+                docs.sort(key=lambda doc: doc['_id'], reverse=order < 0)
+        else:
+            conditions = []
+            parameters = []
+            if _id is not None and not isinstance(_id, dict):
+                conditions.append('id = ?')
+                parameters.append(_key(_id))
+            for field, value in query.iteritems():
+                if field != '_id' and field not in self.indexed:
+                    continue
+                if field != '_id' and _is_scalar(value):
+                    conditions.append('%s = ?' % _field_value(field))
+                    parameters.append(value)
+                elif _is_range(value):
+                    for op, bound in value.iteritems():
+                        conditions.append('%s %s ?' % (_field_value(field), _RANGE_OPERATORS[op]))
+                        parameters.append(bound)
+
+            sql = 'SELECT doc FROM %s' % self.table
+            if conditions:
+                sql += ' WHERE ' + ' AND '.join(conditions)
+            if order is not None:
+                sql += ' ORDER BY %s %s' % (_field_value('_id'), 'DESC' if order < 0 else 'ASC')
+            docs = self._rows(sql, parameters)
+
+        for doc in docs:
+            if matches(doc, query):
+                yield doc
+
+    def find(self, query=None, fields=None, **kwargs):
+        return SQLiteCursor(self, query, fields)
+
+    def find_one(self, query=None, fields=None):
+        for doc in self._matching(query):
+            return project(doc, fields)
+        return None
+
+    def _write(self, c, doc):
+        # updated in place, rather than replaced, so that a scan already
+        # reading the table doesn't come across the document again
+        key = _key(doc['_id'])
+        data = _dumps(doc)
+        if not c.execute('UPDATE %s SET doc = ? WHERE id = ?' % self.table, (data, key)).rowcount:
+            c.execute('INSERT INTO %s (id, doc) VALUES (?, ?)' % self.table, (key, data))
+
+    def _insert_one(self, c, doc):
+        if '_id' not in doc:
+            doc['_id'] = uuid.uuid4().hex
+        try:
+            c.execute('INSERT INTO %s (id, doc) VALUES (?, ?)' % self.table, (_key(doc['_id']), _dumps(doc)))
+        except sqlite3.IntegrityError:
+            raise DuplicateKeyError('duplicate key %s' % doc['_id'])
+        return doc['_id']
+
+    def insert(self, docs, continue_on_error=False, **kwargs):
+        with self.database.batch() as c:
+            if isinstance(docs, dict):
+                return self._insert_one(c, docs)
+            ids = []
+            duplicate = None
+            for doc in docs:
+                try:
+                    ids.append(self._insert_one(c, doc))
+                except DuplicateKeyError as e:
+                    if not continue_on_error:
+                        raise
+                    duplicate = e
+        if duplicate is not None:
+            raise duplicate
+        return ids
+
+    def save(self, doc, **kwargs):
+        if '_id' not in doc:
+            doc['_id'] = uuid.uuid4().hex
+        with self.database.batch() as c:
+            self._write(c, doc)
+        return doc['_id']
+
+    def update(self, query, update, upsert=False, multi=False, **kwargs):
+        with self.database.batch() as c:
+            if multi:
+                docs = list(self._matching(query))
+            else:
+                docs = list(itertools.islice(self._matching(query), 1))
+            for doc in docs:
+                apply_update(doc, update)
+                self._write(c, doc)
+            if docs or not upsert:
+                return {'n': len(docs), 'updatedExisting': bool(docs)}
+
+            # upsert: a new document from the query's plain values
+            doc = {}
+            for key, value in query.iteritems():
+                if not key.startswith('$') and not (isinstance(value, dict) and any(k.startswith('$') for k in value)):
+                    _set(doc, key, value)
+            apply_update(doc, update, inserting=True)
+            self._insert_one(c, doc)
+            return {'n': 1, 'updatedExisting': False, 'upserted': doc['_id']}
+
+    def find_and_modify(self, query, update, sort=None, new=False, upsert=False, **kwargs):
+        with self.database.batch() as c:
+            order = _id_order(sort)
+            if sort and order is None:
+                docs = MemoryCursor(list(self._matching(query))).sort(sort)
+            else:
+                # only the first match is needed
+                docs = list(itertools.islice(self._matching(query, order), 1))
+            for doc in docs:
+                before = _loads(_dumps(doc))
+                apply_update(doc, update)
+                self._write(c, doc)
+                return doc if new else before
+            if upsert:
+                self.update(query, update, upsert=True)
+                return self.find_one(query) if new else None
+            return None
+
+    def remove(self, query=None, **kwargs):
+        with self.database.batch() as c:
+            if not query:
+                count = c.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+                c.execute('DELETE FROM %s' % self.table)
+                return {'n': count}
+            keys = [(_key(doc['_id']),) for doc in self._matching(query)]
+            c.executemany('DELETE FROM %s WHERE id = ?' % self.table, keys)
+            return {'n': len(keys)}
+
+    def ensure_index(self, key, **kwargs):
+        # a single field, or a compound index given as [(field, direction)]
+        fields = [key] if isinstance(key, basestring) else [field for field, direction in key]
+        with self.database.batch() as c:
+            for field in fields:
+                if field == '_id' or field in self.indexed:
+                    continue
+                index = '"i_%s_%s"' % (self.table.strip('"'), field.replace('.', '__'))
+                c.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (index, self.table, _field_value(field)))
+                self.indexed.add(field)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+
+class SQLiteDatabase(object):
+    """
+    A database held in a single SQLite file. Connections are shared between
+    threads, one statement at a time. Other processes holding the write
+    lock are waited for for up to timeout seconds.
+    """
+
+    def __init__(self, path, timeout=60):
+
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA busy_timeout = %d' % int(timeout * 1000))
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+
+        self.collections = {}
+        self.lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def batch(self):
+        """
+        Run the block in one write transaction (joining any already open in
+        this thread), yielding the cursor to use. The write lock is taken
+        when the transaction begins: a transaction that read first and then
+        asked for it could fail straight away rather than wait, if another
+        process were already waiting to write.
+        """
+        with self.lock:
+            self._depth += 1
+            if self._depth == 1:
+                self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection.cursor()
+            except:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.connection.execute('COMMIT')
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = SQLiteCollection(self, name)
+            return self.collections[name]
+
+    def close(self):
+        self.connection.close()
+
+
+class SQLiteCache(MongoDBCache):
+    """
+    A MongoDBCache stored in a SQLite file
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path, refresh_time=timedelta(days=365), timeout=60):
+        MongoDBCache.__init__(self, refresh_time=refresh_time, database=SQLiteDatabase(path, timeout))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import csv
+import random
+import bisect
+import argparse
+
+from collections import Counter
+
+from assets import load_asset
+from venue_view import csv_category_ids
+from venue_extractor import LABELS
+
+
+def _slug(name):
+    return re.sub(r'[^a-z0-9]+', '', name.lower())
+
+
+def _category_column(category_ids):
+    # the categories column as min_venue_row writes it, a list repr
+    return unicode([unicode(category) for category in category_ids])
+
+
+class SyntheticVenues:
+    """
+    Generates made-up venues that look like the real ones: chain venues are
+    drawn from the brands in the facebook/twitter handle maps, weighted by how
+    many venues each brand really has, with their handles, a website and a
+    category, and with some variation in the names. Independent venues get
+    names made from the words of real names, and handles of their own.
+
+    Every venue is a min_venues.csv row (see venue_extractor.LABELS), and
+    brand records which brand (if any) each venue was made from.
+    """
+
+    def __init__(self, seed=0, chain_fraction=0.4, p_url=0.6, p_twitter=0.5, p_facebook=0.5):
+
+        self.rng = random.Random(seed)
+
+        self.chain_fraction = chain_fraction
+        self.p_url = p_url
+        self.p_twitter = p_twitter
+        self.p_facebook = p_facebook
+
+        self.categories = sorted(load_asset('categories').keys())
+        self._load_brands()
+
+        # venue id -> brand name, for the chain venues generated
+        self.brand = {}
+
+    def _load_brands(self):
+        brands = {}
+        words = Counter()
+        for handles_name, names_name, field in [('fb', 'facebook_names', 'facebook'), ('twitter', 'twitter_names', 'twitter')]:
+            handles = load_asset(handles_name)
+            names = load_asset(names_name)
+            for handle in handles.keys():
+                handle_names = names[handle]
+                for name in handle_names:
+                    words.update(name.split())
+                if len(handle_names) < 2:
+                    continue
+                name = Counter(handle_names).most_common(1)[0][0]
+                brand = brands.setdefault(name.lower(), {'name': name, 'size': 0})
+                brand[field] = handle
+                brand['size'] = max(brand['size'], len(handle_names))
+
+        self.brands = sorted(brands.values(), key=lambda brand: brand['name'])
+        for brand in self.brands:
+            brand['url'] = 'http://www.%s.com/' % (_slug(brand['name']) or 'brand')
+            brand['category'] = self.rng.choice(self.categories)
+
+        # cumulative brand sizes, to pick brands in proportion to their size
+        self._cumulative = []
+        total = 0
+        for brand in self.brands:
+            total += brand['size']
+            self._cumulative.append(total)
+
+        self.words = [word for word, count in words.most_common(5000)]
+
+    def _id(self):
+        return '%024x' % self.rng.getrandbits(96)
+
+    def _pick_brand(self):
+        return self.brands[bisect.bisect_right(self._cumulative, self.rng.random() * self._cumulative[-1])]
+
+    def _vary(self, name):
+        # most chain venues have the brand name, some a branch suffix or a typo
+        r = self.rng.random()
+        if r < 0.1:
+            return '%s %s' % (name, self.rng.choice(self.words))
+        if r < 0.2 and len(name) > 3:
+            i = self.rng.randrange(len(name))
+            return name[:i] + name[i + 1:]
+        return name
+
+    def venue(self):
+        """
+        A single venue, as a min_venues.csv row
+        """
+        venue_id = self._id()
+        row = dict.fromkeys(LABELS, u'')
+        row['id'] = venue_id
+
+        if self.rng.random() < self.chain_fraction:
+            brand = self._pick_brand()
+            self.brand[venue_id] = brand['name']
+            row['name'] = self._vary(brand['name'])
+            if self.rng.random() < self.p_url:
+                row['url'] = brand['url']
+            if brand.get('twitter') and self.rng.random() < self.p_twitter:
+                row['contact-twitter'] = brand['twitter']
+            if brand.get('facebook') and self.rng.random() < self.p_facebook:
+                row['contact-facebook'] = brand['facebook']
+            row['categories'] = _category_column([brand['category']])
+        else:
+            row['name'] = u' '.join(self.rng.choice(self.words) for i in xrange(self.rng.randint(1, 3)))
+            slug = _slug(row['name']) or venue_id
+            if self.rng.random() < self.p_url / 3:
+                row['url'] = 'http://%s%d.com/' % (slug, self.rng.randrange(1000))
+            if self.rng.random() < self.p_twitter / 3:
+                row['contact-twitter'] = '%s%d' % (slug, self.rng.randrange(1000))
+            if self.rng.random() < self.p_facebook / 3:
+                row['contact-facebook'] = '%d' % self.rng.getrandbits(48)
+            row['categories'] = _category_column([self.rng.choice(self.categories)])
+        return row
+
+    def venues(self, count):
+        for i in xrange(count):
+            yield self.venue()
+
+    def write_csv(self, path, count):
+        """
+        Write count venues to a csv file in the same format as min_venues.csv
+        """
+        with open(path, 'wb') as output:
+            writer = csv.DictWriter(output, LABELS)
+            writer.writeheader()
+            for row in self.venues(count):
+                writer.writerow(dict((key, value.encode('utf-8')) for key, value in row.iteritems()))
+
+
+def venue_document(row):
+    """
+    A venue document for the cache's venues collection, from a csv row
+    """
+    venue = {'_id': row['id'], 'id': row['id'], 'name': row['name']}
+    if row['url']:
+        venue['url'] = row['url']
+    contact = {}
+    if row['contact-twitter']:
+        contact['twitter'] = row['contact-twitter']
+    if row['contact-facebook']:
+        contact['facebook'] = row['contact-facebook']
+    if contact:
+        venue['contact'] = contact
+    if row['categories']:
+        venue['categories'] = [{'id': category} for category in csv_category_ids(row['categories'])]
+    return venue
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic min_venues.csv')
+    parser.add_argument('count', type=int)
+    parser.add_argument('--output', default='synthetic_venues.csv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    SyntheticVenues(seed=args.seed).write_csv(args.output, args.count)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Tests for the leased work queue, against an in-memory cache:
+
+    python -m unittest test_work_queue
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from assets import ASSETS
+from memory_cache import MemoryCache
+from queue_worker import match_worker
+from synthetic_venues import SyntheticVenues, venue_document
+from venue_view import read_min_venues
+from work_queue import WorkQueue, drain, PENDING, LEASED, DONE, FAILED
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MemoryCache()
+        self.queue = WorkQueue(self.cache, 'match', lease_time=60, max_attempts=2)
+        self.venue_ids = ['%024x' % i for i in range(10)]
+
+    def expire(self, job):
+        # make a job's lease run out
+        self.cache.update_document('work_queue', {'_id': job['_id']}, {'$set': {'lease_expires': 0}})
+
+    def test_enqueue(self):
+        self.assertEqual(self.queue.enqueue(self.venue_ids, batch_size=4), 3)
+        # enqueueing the same list again adds nothing
+        self.assertEqual(self.queue.enqueue(self.venue_ids, batch_size=4), 0)
+
+        jobs = sorted(self.cache.get_documents('work_queue', {}), key=lambda job: job['_id'])
+        self.assertEqual([job['start'] for job in jobs], [0, 4, 8])
+        self.assertEqual(jobs[2]['venues'], self.venue_ids[8:])
+        self.assertEqual(self.queue.counts()[PENDING], 3)
+
+    def test_lease(self):
+        self.queue.enqueue(self.venue_ids, batch_size=5)
+
+        first = self.queue.lease('a')
+        second = self.queue.lease('b')
+        self.assertEqual(first['venues'], self.venue_ids[:5])
+        self.assertEqual(second['venues'], self.venue_ids[5:])
+        self.assertEqual(first['attempts'], 1)
+        # everything is leased
+        self.assertIsNone(self.queue.lease('c'))
+        self.assertEqual(self.queue.counts()[LEASED], 2)
+
+    def test_heartbeat(self):
+        self.queue.enqueue(self.venue_ids, batch_size=10)
+        job = self.queue.lease('a')
+        self.assertTrue(self.queue.heartbeat(job, 'a'))
+        self.assertFalse(self.queue.heartbeat(job, 'b'))
+
+        # once the lease runs out another worker can take the job, and the
+        # first worker's lease is lost
+        self.expire(job)
+        taken = self.queue.lease('b')
+        self.assertEqual(taken['_id'], job['_id'])
+        self.assertEqual(taken['attempts'], 2)
+        self.assertFalse(self.queue.heartbeat(job, 'a'))
+        self.assertTrue(self.queue.complete(taken, 'b'))
+        self.assertEqual(self.queue.counts()[DONE], 1)
+
+    def test_reap(self):
+        self.queue.enqueue(self.venue_ids, batch_size=10)
+
+        # a job whose workers keep dying is given out max_attempts times
+        for attempt in range(2):
+            job = self.queue.lease('a')
+            self.assertIsNotNone(job)
+            self.expire(job)
+        self.assertIsNone(self.queue.lease('a'))
+
+        self.assertEqual(self.queue.reap(), 1)
+        self.assertEqual(self.queue.counts()[FAILED], 1)
+
+    def test_drain(self):
+        self.queue.enqueue(self.venue_ids, batch_size=3)
+
+        seen = []
+        def process_venue(venue_id, position):
+            seen.append((venue_id, position))
+
+        self.assertEqual(drain(self.queue, process_venue, worker_id='a'), 4)
+        self.assertEqual(seen, [(venue_id, i) for i, venue_id in enumerate(self.venue_ids)])
+        self.assertEqual(self.queue.counts()[DONE], 4)
+
+    def test_drain_release(self):
+        self.queue.enqueue(self.venue_ids, batch_size=10)
+
+        def process_venue(venue_id, position):
+            raise ValueError(venue_id)
+
+        # a failing job is given back and retried, until it runs out of attempts
+        self.assertEqual(drain(self.queue, process_venue, worker_id='a'), 0)
+        self.assertEqual(self.queue.reap(), 1)
+
+
+class MatchWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        # two workers sharing a cache, each with its own chain lookups
+        self.cache = MemoryCache()
+        self.workers = [(worker_id, match_worker('test', cache=self.cache, refresh_every=3)[0]) for worker_id in ('a', 'b')]
+
+        # the matcher reads min_venues.csv (and the reference files) from
+        # the working directory
+        self.home = os.getcwd()
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.workdir = tempfile.mkdtemp(prefix='chain-test-')
+        for source in ASSETS.values():
+            os.symlink(os.path.join(here, source), os.path.join(self.workdir, source))
+        os.chdir(self.workdir)
+
+        generator = SyntheticVenues(seed=1, chain_fraction=0.8)
+        generator.write_csv('min_venues.csv', 60)
+        self.venue_ids = []
+        for row in read_min_venues():
+            self.cache.put_document('venues', venue_document(row))
+            self.venue_ids.append(row['id'])
+
+    def tearDown(self):
+        os.chdir(self.home)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_two_workers(self):
+        queue = WorkQueue(self.cache, 'match')
+        queue.enqueue(self.venue_ids, batch_size=5)
+
+        # the workers take jobs in turn
+        while True:
+            leased = 0
+            for worker_id, process_venue in self.workers:
+                job = queue.lease(worker_id)
+                if job is None:
+                    continue
+                leased += 1
+                for offset, venue_id in enumerate(job['venues']):
+                    process_venue(venue_id, job['start'] + offset)
+                self.assertTrue(queue.complete(job, worker_id))
+            if not leased:
+                break
+
+        chains = list(self.cache.get_documents('chains', {}))
+        self.assertTrue(chains)
+        members = {}
+        for chain in chains:
+            for venue_id in chain['venues']:
+                self.assertNotIn(venue_id, members)
+                members[venue_id] = chain['_id']
+        for venue_id, chain_id in members.items():
+            lookup = self.cache.get_fresh_document('chain_id_lookup', {'_id': venue_id})
+            self.assertEqual(lookup['chain_id'], chain_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
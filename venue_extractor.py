@@ -14,9 +14,86 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
 import csv
 import json
-from db_cache import MongoDBCache
+import shutil
+import tempfile
+import multiprocessing
+
+from db_cache import open_cache
+from venue_view import venue_projection, venue_data
+
+LABELS = ['name', 'id', 'url', 'contact-twitter', 'contact-facebook', 'categories']
+
+
+def min_venue_row(v):
+    """
+    Turn a (projected) venue document into a row for the min_venues csv
+    """
+    v = venue_data(v)
+
+    min_v = {}
+    min_v['id'] = v['id']
+    min_v['name'] = v['name'].encode('utf-8')
+
+    if v.get('url') :
+        min_v['url'] = v['url'].encode('utf-8')
+    else:
+        min_v['url'] = ""
+
+    if v.get('contact'):
+
+        if v['contact'].get('twitter'):
+            min_v['contact-twitter'] = v['contact']['twitter'].encode('utf-8')
+        else:
+            min_v['contact-twitter'] = ""
+
+        if v['contact'].get('facebook'):
+            min_v['contact-facebook'] = v['contact']['facebook'].encode('utf-8')
+        else:
+            min_v['contact-facebook'] = ""
+    else:
+        min_v['contact-twitter'] = ""
+        min_v['contact-facebook'] = ""
+
+    if v.get('categories'):
+        min_v['categories'] = []
+        for c in v['categories']:
+            min_v['categories'].append(c['id'])
+    else:
+        min_v['categories'] = []
+
+    return min_v
+
+
+def extract_range(args):
+    """
+    Write every venue with an _id in [lower, upper) to its own csv part file.
+    Runs in a worker process, so opens its own database connection.
+    """
+    db_name, lower, upper, part_path, batch_size = args
+
+    query = {}
+    if lower is not None or upper is not None:
+        query['_id'] = {}
+        if lower is not None:
+            query['_id']['$gte'] = lower
+        if upper is not None:
+            query['_id']['$lt'] = upper
+
+    cache = open_cache(db_name, shared=True)
+    venues = cache.get_documents('venues', query, venue_projection()).sort('_id', 1).batch_size(batch_size)
+
+    count = 0
+    with open(part_path, 'wb') as part_file:
+        csv_writer = csv.DictWriter(part_file, LABELS)
+        for v in venues:
+            csv_writer.writerow(min_venue_row(v))
+            count += 1
+
+    return part_path, count
+
 
 class VenueExtractor():
     """
@@ -24,58 +101,66 @@ class VenueExtractor():
     """
     def __init__(self, db_name='fsqexp'):
 
+        self.db_name = db_name
+
         # access to the database
-        self.cache = MongoDBCache(db=db_name)
-
-    def extract_venues(self):
-
-        venues = self.cache.get_collection('venues')
-        labels = ['name', 'id', 'url', 'contact-twitter', 'contact-facebook', 'categories']
-        
-        with open('min_venues.csv', 'w') as outfile:
-            csv_writer = csv.DictWriter(outfile, labels)
-            csv_writer.writeheader()
-
-            i = 0
-            for v in venues:
-                if i % 1000 == 0:
-                    print i
-                if v.get('response'):
-                    v = v['response']['venue']
-
-                min_v = {}
-                min_v['id'] = v['id']
-                min_v['name'] = v['name'].encode('utf-8')
-
-                if v.get('url') :
-                    min_v['url'] = v['url'].encode('utf-8')
-                else:
-                    min_v['url'] = ""
-                
-                if v.get('contact'):
-
-                    if v['contact'].get('twitter'):
-                        min_v['contact-twitter'] = v['contact']['twitter'].encode('utf-8')
-                    else:
-                        min_v['contact-twitter'] = ""
-
-                    if v['contact'].get('facebook'):
-                        min_v['contact-facebook'] = v['contact']['facebook'].encode('utf-8')
-                    else:
-                        min_v['contact-facebook'] = ""
-                else:
-                    min_v['contact-twitter'] = ""
-                    min_v['contact-facebook'] = ""
-
-                if v.get('categories'):
-                    min_v['categories'] = []
-                    for c in v['categories']:
-                        min_v['categories'].append(c['id'])
-                else:
-                    min_v['categories'] = []
-
-                csv_writer.writerow(min_v)
-                i += 1
+        self.cache = open_cache(db_name, shared=True)
+
+    def id_ranges(self, num_ranges):
+        """
+        Split the _id space of the venues collection into num_ranges ranges
+        of roughly equal size. Venue ids aren't evenly spread over the hex
+        space, so the boundaries are taken from the (indexed) ids themselves,
+        stepping through them in one pass rather than skipping to each one.
+        """
+        ids = self.cache.get_documents('venues', {}, {'_id': True})
+        step = max(ids.count() // num_ranges, 1)
+
+        boundaries = []
+        for i, b in enumerate(ids.sort('_id', 1).batch_size(10000)):
+            if i and i % step == 0 and len(boundaries) < num_ranges - 1:
+                boundaries.append(b['_id'])
+
+        lowers = [None] + boundaries
+        uppers = boundaries + [None]
+        return zip(lowers, uppers)
+
+    def extract_venues(self, output='min_venues.csv', processes=None, batch_size=1000):
+        """
+        Export the minimum venue information for every venue to csv. The _id
+        space is scanned in ranges by a pool of worker processes, and their
+        output copied into the final file in range order, so rows come out in
+        _id order (the matchers depend on row position) whatever the timing.
+        """
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        part_dir = tempfile.mkdtemp()
+        ranges = self.id_ranges(processes * 4)
+        jobs = []
+        for i, (lower, upper) in enumerate(ranges):
+            jobs.append((self.db_name, lower, upper, os.path.join(part_dir, 'part-%05d.csv' % i), batch_size))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            with open(output, 'wb') as outfile:
+                csv_writer = csv.DictWriter(outfile, LABELS)
+                csv_writer.writeheader()
+
+                total = 0
+                for part_path, count in pool.imap(extract_range, jobs):
+                    with open(part_path, 'rb') as part_file:
+                        shutil.copyfileobj(part_file, outfile)
+                    os.remove(part_path)
+                    total += count
+                    print total
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+        return total
 
 if __name__ == '__main__':
     v = VenueExtractor()
@@ -16,11 +16,13 @@
 
 from Levenshtein import ratio
 from urlparse import urlparse
+from venue_view import as_venue_view, venue_data, csv_category_ids
+
+import metrics
 
 def get_min_venue_from_db(venue):
 
-    if venue.get('response'):
-        venue = venue['response']['venue']
+    venue = venue_data(venue)
 
     v = {}
     v['name'] = venue['name']
@@ -54,7 +56,7 @@ def get_min_venue_from_csv(venue):
         if venue['contact-facebook'] is not "":
             v['contact']['facebook'] = venue['contact-facebook']                    
     if venue['categories']:
-        v['categories'] = venue['categories'].split(',')
+        v['categories'] = list(csv_category_ids(venue['categories']))
 
     return v
 
@@ -62,56 +64,41 @@ def calc_venue_match_confidence(venue1, venue2):
 
     """
     calculates distance between two venues by comparing names, 
-    social media handles, URLs and categories
+    social media handles, URLs and categories. Venues can be API
+    responses, venue dicts, csv rows or VenueViews of any of those.
     """
 
     # just need the venue data, not the whole API response
-    if venue1.get('response'):
-        v1 = venue1['response']['venue']
-    else:
-        v1 = venue1
-    if venue2.get('response'):
-        v2 = venue2['response']['venue']
-    else:
-        v2 = venue2
+    v1 = as_venue_view(venue1)
+    v2 = as_venue_view(venue2)
 
     #levenshtein distance of names
-    name_distance = ratio(v1['name'], v2['name'])
+    if metrics.enabled:
+        metrics.inc('ratio_calls', caller='venue_match')
+    name_distance = ratio(v1.name, v2.name)
     url_match = 0.0
     social_media_match = 0.0
     category_match = 0.0
 
     # compare URLs
-    if v1.get('url') and v2.get('url'):
-        if v1['url']:
-            if urlparse(v1['url']).netloc:
-                if urlparse(v2['url']).netloc:
-                    if urlparse(v1['url']).netloc == urlparse(v2['url']).netloc:
-                        url_match = 1.0
+    if v1.netloc and v2.netloc:
+        if v1.netloc == v2.netloc:
+            url_match = 1.0
 
     # compare social media
-    if v1.get('contact') and v2.get('contact'):
-        if v1['contact'].get('twitter') and v2['contact'].get('twitter'):
-            if v1['contact']['twitter'] == v2['contact']['twitter'] and v1['contact']['twitter'] and v1['contact']['twitter'] != "none":
-                social_media_match += 1.0
-        if v1['contact'].get('facebook') and v2['contact'].get('facebook'):
-            if v1['contact']['facebook'] == v2['contact']['facebook'] and v1['contact']['facebook'] and v1['contact']['facebook'] != "none":
-                social_media_match += 1.0
+    if v1.twitter and v2.twitter:
+        if v1.twitter == v2.twitter and v1.twitter != "none":
+            social_media_match += 1.0
+    if v1.facebook and v2.facebook:
+        if v1.facebook == v2.facebook and v1.facebook != "none":
+            social_media_match += 1.0
 
     # compare categories if names match - match = +1.0, - no match = -1.0
     if name_distance > 0.9:
-        c1 = set()
-        c2 = set()
-        if v1.get('categories') and v2.get('categories'):
-            for category in v1['categories']:
-                c1.add(category)
-            for category in v2['categories']:
-                c2.add(category)
-        common = c1 & c2
+        common = set(v1.category_ids) & set(v2.category_ids)
         if len(common) > 0:
             category_match = 1.0
         else:
             category_match = -1.0
 
     return name_distance, url_match, social_media_match, category_match
-    
\ No newline at end of file
@@ -14,28 +14,107 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import json
+import zlib
 import urllib2
+import hashlib
+import argparse
 
-from _credentials import *
 from itertools import ifilter
+from multiprocessing.pool import ThreadPool
 from Levenshtein import ratio
 from datetime import timedelta
-from db_cache import MongoDBCache
-from api import APIGateway, APIWrapper
+from db_cache import open_cache
+from bson.binary import Binary
+from api_replay import open_api
+from venue_view import minimal_venue, venue_data
+from refresher import Refresher
+from api_scheduler import default_scheduler, SchedulerBusy
+
+import metrics
+
+# the collections search results are cached in, keyed on search_key(params)
+SEARCH_COLLECTIONS = ['global_searches', 'local_searches', 'alternates']
+
+
+def search_key(params):
+    """
+    A canonical key for a set of search parameters, the same whatever
+    order the parameters were added in
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def venue_document(venue_id, response, compress=True):
+    """
+    The document to cache a venue response in: the minimal venue (see
+    venue_view.minimal_venue) that the matching code reads, next to the raw
+    response, which is zlib compressed unless compress is False
+    """
+    if compress:
+        doc = {'raw': Binary(zlib.compress(json.dumps(response, separators=(',', ':'))))}
+    else:
+        doc = dict(response)
+    doc['_id'] = venue_id
+    doc['min'] = minimal_venue(response)
+    return doc
+
+
+def raw_response(doc):
+    """
+    The raw response from a cached venue document, however it was stored
+    """
+    if doc.get('raw') is not None:
+        return json.loads(zlib.decompress(doc['raw']))
+    return doc
 
 
 class VenueSearcher:
+    """
+    Looks venues and searches up in the cache, going to the Foursquare API
+    for anything that isn't there.
+
+    With check_fresh, a stale cached document is treated as missing and
+    fetched again before returning. In revalidate mode the cached document
+    is returned straight away whatever its age, and any document past
+    refresh_ahead of the cache's refresh_time (so stale documents, and those
+    about to go stale) is refreshed in the background by a Refresher.
+
+    API calls wait their turn with the ApiScheduler, as request_class
+    ('interactive' for classification, 'batch' for bulk jobs); background
+    refreshes go as 'refresh'.
 
-    def __init__(self, db_name='fsqexp'):
-        
-        self.gateway = APIGateway(access_token, 500, [client_id, client_secret], 5000)
-        self.wrapper = APIWrapper(self.gateway)
+    The API is the real one unless another is passed in or configured (see
+    api_replay.open_api), and the cache can be passed in the same way.
+    """
+
+    def __init__(self, db_name='fsqexp', compress=True, revalidate=False, refresh_ahead=0.9, refresh_workers=2, max_pending_refreshes=1000,
+                 request_class='interactive', scheduler=None, api=None, cache=None, fetch_workers=8):
+
+        if api is None:
+            api = open_api()
+        self.wrapper = api
 
         self.params = {
             'v' : 20140713
         }
 
-        self.cache = MongoDBCache(db=db_name)
+        if cache is None:
+            cache = open_cache(db_name)
+        self.cache = cache
+        self.compress = compress
+
+        self.request_class = request_class
+        self.scheduler = scheduler or default_scheduler()
+
+        # threads for fetching many venues at once, started when first needed
+        self.fetch_workers = fetch_workers
+        self._pool = None
+
+        self.refresh_ahead = refresh_ahead
+        self.refresher = None
+        if revalidate:
+            self.refresher = Refresher(refresh_workers, max_pending_refreshes)
 
 
     def venue_has_chain_property(self, venue):
@@ -46,6 +125,54 @@ class VenueSearcher:
         return False
 
 
+    def _cached(self, collection, key, check_fresh, refresh, *args, **kwargs):
+        """
+        The cached document for key, or None if it should be fetched now.
+        Queues a background refresh(*args) for ageing documents in
+        revalidate mode.
+        """
+        fields = kwargs.get('fields')
+        if self.refresher is None:
+            return self.cache.get_fresh_document(collection, {'_id': key}, check_fresh, fields)
+
+        doc = self.cache.get_fresh_document(collection, {'_id': key}, False, fields)
+        if doc is not None and self.cache.freshness(doc) >= self.refresh_ahead:
+            self.refresher.submit((collection, key), refresh, *args)
+        return doc
+
+
+    def _fetch_search(self, request_class, kind, collection, key, params, *args):
+        # run a search against the API and cache the results
+        try:
+            metrics.inc('searcher_requests', kind=kind, source='api')
+            with self.scheduler.slot(request_class), metrics.timed('api', endpoint='venues/search'):
+                results = self.wrapper.query_routine('venues', 'search', params, True, *args)
+            if results is not None:
+                results['_id'] = key
+                results['params'] = params
+                self.cache.put_document(collection, results)
+            return results
+        except urllib2.HTTPError, e:
+            metrics.inc('api_errors', endpoint='venues/search')
+        except urllib2.URLError, e:
+            metrics.inc('api_errors', endpoint='venues/search')
+        except SchedulerBusy:
+            # too many requests already waiting (counted by the scheduler):
+            # treated as not found
+            pass
+
+
+    def _search(self, kind, collection, params, check_fresh, *args):
+        key = search_key(params)
+        results = self._cached(collection, key, check_fresh, self._fetch_search, 'refresh', kind, collection, key, params, *args)
+        if results is not None:
+            metrics.inc('searcher_requests', kind=kind, source='cache')
+        else:
+            results = self._fetch_search(self.request_class, kind, collection, key, params, *args)
+        if results is not None:
+            return results['response']['venues']
+
+
     def global_search(self, query, check_fresh=False):
 
         params = {}
@@ -53,22 +180,8 @@ class VenueSearcher:
         params['intent'] = 'global'
         params['limit'] = 50
         params['query'] = query
-        
 
-        if self.cache.document_exists('global_searches', {'params': params}, check_fresh):
-            results = self.cache.get_document('global_searches', {'params': params}, check_fresh)
-            return results['response']['venues']
-        else:
-            try:
-                results = self.wrapper.query_routine('venues', 'search', params, True)
-                if not results is None:
-                    results['params'] = params
-                    self.cache.put_document('global_searches', results)
-                return results['response']['venues']
-            except urllib2.HTTPError, e:
-                pass
-            except urllib2.URLError, e:
-                pass
+        return self._search('global_search', 'global_searches', params, check_fresh)
 
 
     def local_search(self, venue, query, radius, check_fresh=False):
@@ -87,44 +200,78 @@ class VenueSearcher:
         params['categoryId'] = categories
         params['query'] = query
 
-        if self.cache.document_exists('local_searches', {'params': params}, check_fresh):
-            results = self.cache.get_document('local_searches', {'params': params}, check_fresh)
-            return results['response']['venues']
-        else:
-            try:
-                results = self.wrapper.query_routine('venues', 'search', params, True)
-                if results is not None:
-                    results['params'] = params
-                    self.cache.put_document('local_searches', results)
-                return results['response']['venues']
-            except urllib2.HTTPError, e:
-                pass
-            except urllib2.URLError, e:
-                pass
+        return self._search('local_search', 'local_searches', params, check_fresh)
+
+
+    def _fetch_venue(self, request_class, venue_id):
+        # get a venue from the API and cache it
+        response = None
+        try:
+            metrics.inc('searcher_requests', kind='venue', source='api')
+            with self.scheduler.slot(request_class), metrics.timed('api', endpoint='venues'):
+                response = self.wrapper.query_resource('venues', venue_id, get_params=self.params, userless=True, tenacious=True)
+        except urllib2.HTTPError, e:
+            metrics.inc('api_errors', endpoint='venues')
+        except urllib2.URLError, e:
+            metrics.inc('api_errors', endpoint='venues')
+        except SchedulerBusy:
+            # too many requests already waiting (counted by the scheduler):
+            # treated as not found, so one rejection doesn't lose the rest
+            # of a get_venue_jsons batch
+            pass
+        if not response is None:
+            self.cache.put_document('venues', venue_document(venue_id, response, self.compress))
+        return response
 
 
     def get_venue_json(self, venue_id, check_fresh=False):
 
-        response = None
-        if self.cache.document_exists('venues', {'_id': '%s' % (venue_id)}, check_fresh):
-            response = self.cache.get_document('venues', {'_id': '%s' % (venue_id)}, check_fresh)
+        venue_id = '%s' % (venue_id)
+        response = self._cached('venues', venue_id, check_fresh, self._fetch_venue, 'refresh', venue_id, fields={'min': False})
+        if response is not None:
+            response = raw_response(response)
+            metrics.inc('searcher_requests', kind='venue', source='cache')
         else:
-            try:
-                response = self.wrapper.query_resource('venues', venue_id, get_params=self.params, userless=True, tenacious=True)
-            except urllib2.HTTPError, e:
-                pass
-            except urllib2.URLError, e:
-                pass
-            if not response is None:
-                response['_id'] = venue_id
-                self.cache.put_document('venues', response)
+            response = self._fetch_venue(self.request_class, venue_id)
 
         if not response is None:
-            return response['response']['venue']
+            return venue_data(response)
         else:
             return None
 
 
+    def get_venue_jsons(self, venue_ids, check_fresh=False):
+        """
+        Many venues at once: one cache query for all of them, then the ones
+        that aren't cached (or are stale, with check_fresh) fetched from the
+        API in parallel. Returns the venues in the same order as the ids,
+        with None for any that couldn't be found.
+        """
+        venue_ids = ['%s' % (venue_id) for venue_id in venue_ids]
+
+        responses = {}
+        unique_ids = list(set(venue_ids))
+        for doc in self.cache.get_documents('venues', {'_id': {'$in': unique_ids}}, {'min': False}):
+            freshness = self.cache.freshness(doc)
+            if self.refresher is not None:
+                if freshness >= self.refresh_ahead:
+                    self.refresher.submit(('venues', doc['_id']), self._fetch_venue, 'refresh', doc['_id'])
+            elif check_fresh and freshness > 1:
+                continue
+            responses[doc['_id']] = raw_response(doc)
+            metrics.inc('searcher_requests', kind='venue', source='cache')
+
+        missing = [venue_id for venue_id in unique_ids if venue_id not in responses]
+        if missing:
+            if self._pool is None:
+                self._pool = ThreadPool(self.fetch_workers)
+            fetched = self._pool.map(lambda venue_id: self._fetch_venue(self.request_class, venue_id), missing)
+            responses.update(zip(missing, fetched))
+
+        return [venue_data(responses[venue_id]) if responses.get(venue_id) is not None else None
+                for venue_id in venue_ids]
+
+
     def search_alternates(self, venue, radius=500, check_fresh=False):
 
         lat = venue['location']['lat']
@@ -140,18 +287,63 @@ class VenueSearcher:
         params['limit'] = 50
         params['categoryId'] = categories
 
-        if self.cache.document_exists('alternates', {'params': params}, check_fresh):
-            alternatives = self.cache.get_document('alternates', {'params': params}, check_fresh)
-            return alternatives['response']['venues']
-        else:
-            try:
-                alternatives = self.wrapper.query_routine('venues', 'search', params, True, True)
-                if not alternatives is None:
-                    alternatives['params'] = params
-                    self.cache.put_document('alternates', alternatives)
-                return alternatives['response']['venues']
-            except urllib2.HTTPError, e:
-                pass
-            except urllib2.URLError, e:
-                pass   
+        return self._search('search_alternates', 'alternates', params, check_fresh, True)
+
+
+
+def backfill_search_keys(cache, collections=SEARCH_COLLECTIONS):
+    """
+    Move cached searches stored before they were keyed on search_key(params)
+    to their keys. Where the same search was cached more than once, the most
+    recent result is kept. Returns the number of documents moved.
+    """
+    moved = 0
+    for collection in collections:
+        old_ids = [doc['_id'] for doc in cache.get_documents(collection, {}, {'_id': True, 'params': True})
+                   if doc.get('params') is not None and doc['_id'] != search_key(doc['params'])]
+        for _id in old_ids:
+            doc = cache.get_document(collection, {'_id': _id})
+            key = search_key(doc['params'])
+            current = cache.get_fresh_document(collection, {'_id': key}, fields={'last_modified': True})
+            if current is None or current.get('last_modified', 0) < doc.get('last_modified', 0):
+                doc['_id'] = key
+                cache.put_document(collection, doc)
+            cache.remove_documents(collection, {'_id': _id})
+            moved += 1
+        print '%s: %d searches moved' % (collection, len(old_ids))
+    return moved
+
+
+def compact_venues(cache, compress=True, batch_size=1000):
+    """
+    Rewrite venues cached by older versions (the whole response as the
+    document) with their minimal venue, and compressed. Returns the number
+    of venues rewritten.
+    """
+    ids = [doc['_id'] for doc in cache.get_documents('venues', {'min': {'$exists': False}, 'response': {'$exists': True}}, {'_id': True})]
+    for start in xrange(0, len(ids), batch_size):
+        with cache.batch():
+            for doc in cache.get_documents('venues', {'_id': {'$in': ids[start:start + batch_size]}}):
+                last_modified = doc.pop('last_modified', None)
+                doc = venue_document(doc.pop('_id'), doc, compress)
+                doc['last_modified'] = last_modified
+                cache.put_document('venues', doc)
+        print '%d of %d venues compacted' % (min(start + batch_size, len(ids)), len(ids))
+    return len(ids)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Maintain the venue and search caches')
+    parser.add_argument('--db', default='fsqexp')
+    parser.add_argument('--backfill-search-keys', action='store_true',
+                        help='key searches cached by older versions on their canonical search key')
+    parser.add_argument('--compact-venues', action='store_true',
+                        help='store venues cached by older versions with their minimal venue, compressed')
+    parser.add_argument('--no-compress', action='store_true', help='with --compact-venues, leave the raw response uncompressed')
+    args = parser.parse_args()
 
+    if args.backfill_search_keys:
+        backfill_search_keys(open_cache(args.db))
+    if args.compact_venues:
+        compact_venues(open_cache(args.db), not args.no_compress)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import csv
+
+from urlparse import urlparse
+
+_missing = object()
+
+# the parts of a venue document used for matching, everything else can stay
+# on the server
+VENUE_FIELDS = ['id', 'name', 'url', 'contact.twitter', 'contact.facebook', 'categories.id']
+
+
+def venue_projection():
+    """
+    Server-side projection covering venues stored with their minimal venue
+    (min), raw venues and those still wrapped in a full API response
+    (response.venue)
+    """
+    fields = {'min': True}
+    for field in VENUE_FIELDS:
+        fields[field] = True
+        fields['response.venue.%s' % field] = True
+    return fields
+
+
+def venue_data(venue):
+    """
+    The venue inside a cached venue document, whichever way it was stored
+    """
+    if venue.get('min'):
+        return venue['min']
+    if venue.get('response'):
+        return venue['response']['venue']
+    return venue
+
+
+def minimal_venue(venue):
+    """
+    Just the VENUE_FIELDS of a venue, in the same shape as the full venue,
+    to be stored next to the raw response
+    """
+    venue = venue_data(venue)
+    v = {'id': venue['id'], 'name': venue['name']}
+    if venue.get('url'):
+        v['url'] = venue['url']
+    contact = venue.get('contact') or {}
+    if contact.get('twitter') or contact.get('facebook'):
+        v['contact'] = {}
+        if contact.get('twitter'):
+            v['contact']['twitter'] = contact['twitter']
+        if contact.get('facebook'):
+            v['contact']['facebook'] = contact['facebook']
+    if venue.get('categories'):
+        v['categories'] = [{'id': c['id'] if isinstance(c, dict) else c} for c in venue['categories']]
+    return v
+
+
+# the ids in a python list repr ("[u'4bf58dd8d48988d1e0931735', ...]")
+_QUOTED = re.compile(r"u?'([^']*)'")
+
+
+def csv_category_ids(value):
+    """
+    The category ids in the categories column of min_venues.csv. The venue
+    extractor writes the column as a python list repr; bare comma separated
+    ids are read as well.
+    """
+    value = value.strip() if value else ''
+    if not value:
+        return ()
+    if value.startswith('['):
+        return tuple(_QUOTED.findall(value))
+    return tuple(c.strip() for c in value.split(',') if c.strip())
+
+
+def read_min_venues(path='min_venues.csv'):
+    """
+    The rows of a min_venues csv file. The python 2 csv module can't read
+    unicode, so rows are read as utf-8 and decoded afterwards.
+    """
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            yield dict((k, v.decode('utf-8') if v is not None else v) for k, v in row.iteritems())
+
+
+class VenueView(object):
+    """
+    Read-only view over a venue, wrapping without copying any of:
+
+        - a full API response ({'response': {'venue': {...}}})
+        - a venue document from the cache, or a minimum venue dict
+        - a row from min_venues.csv (as read by csv.DictReader)
+
+    The fields used for matching are available as attributes, computed on
+    first use and then cached. The view also supports get() and [] so it
+    can be passed to code expecting a venue dict.
+    """
+
+    __slots__ = ('_venue', '_from_csv', '_netloc', '_category_ids')
+
+    def __init__(self, venue):
+
+        # just need the venue data, not the whole API response
+        venue = venue_data(venue)
+
+        self._venue = venue
+        self._from_csv = 'contact-twitter' in venue
+
+        self._netloc = None
+        self._category_ids = None
+
+    @property
+    def venue(self):
+        # the underlying venue data
+        return self._venue
+
+    @property
+    def id(self):
+        return self._venue['id']
+
+    @property
+    def name(self):
+        return self._venue['name']
+
+    @property
+    def url(self):
+        return self._venue.get('url') or None
+
+    @property
+    def netloc(self):
+        if self._netloc is None:
+            url = self.url
+            if url:
+                self._netloc = urlparse(url).netloc
+            else:
+                self._netloc = ''
+        return self._netloc
+
+    @property
+    def twitter(self):
+        if self._from_csv:
+            return self._venue.get('contact-twitter') or None
+        contact = self._venue.get('contact')
+        if contact:
+            return contact.get('twitter') or None
+        return None
+
+    @property
+    def facebook(self):
+        if self._from_csv:
+            return self._venue.get('contact-facebook') or None
+        contact = self._venue.get('contact')
+        if contact:
+            return contact.get('facebook') or None
+        return None
+
+    @property
+    def category_ids(self):
+        if self._category_ids is None:
+            categories = self._venue.get('categories')
+            if not categories:
+                self._category_ids = ()
+            elif isinstance(categories, basestring):
+                # a min_venues.csv column
+                self._category_ids = csv_category_ids(categories)
+            else:
+                # full venues hold category objects, minimum venues just the ids
+                self._category_ids = tuple(c['id'] if isinstance(c, dict) else c for c in categories)
+        return self._category_ids
+
+    def get(self, key, default=None):
+        if not self._from_csv:
+            return self._venue.get(key, default)
+
+        # present csv rows in the same shape as a minimum venue
+        if key == 'id' or key == 'name':
+            return self._venue.get(key, default)
+        if key == 'url':
+            return self.url or default
+        if key == 'contact':
+            contact = {}
+            if self.twitter:
+                contact['twitter'] = self.twitter
+            if self.facebook:
+                contact['facebook'] = self.facebook
+            return contact or default
+        if key == 'categories':
+            return list(self.category_ids) or default
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __repr__(self):
+        return 'VenueView(%r)' % self._venue
+
+
+def as_venue_view(venue):
+    """
+    Wrap a venue in a VenueView, unless it already is one
+    """
+    if isinstance(venue, VenueView):
+        return venue
+    return VenueView(venue)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Martin J Chorley
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+import socket
+import threading
+import traceback
+
+from db_cache import DuplicateDocumentError
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    """
+    A queue of jobs (batches of venue ids) held in a collection in the cache,
+    so any number of workers on any number of machines can drain it without
+    a coordinator.
+
+    A worker leases a job for lease_time seconds and must renew the lease
+    (heartbeat) while it works. If a worker dies its lease expires and the
+    job is handed to someone else, up to max_attempts times before it is
+    marked as failed.
+    """
+
+    def __init__(self, cache, queue, collection='work_queue', lease_time=300, max_attempts=3):
+
+        self.cache = cache
+        self.queue = queue
+        self.collection = collection
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+        self.cache.ensure_index(self.collection, [('queue', 1), ('state', 1), ('lease_expires', 1)])
+
+    def enqueue(self, venue_ids, batch_size=100):
+        """
+        Add venue ids to the queue in batches. Job ids are derived from the
+        batch position, so enqueueing the same list again adds nothing new.
+        Each job records where its venues are in the list (see drain).
+        Returns the number of jobs added.
+        """
+        added = 0
+        for start in xrange(0, len(venue_ids), batch_size):
+            job = {'_id': '%s:%08d' % (self.queue, start // batch_size),
+                   'queue': self.queue,
+                   'venues': list(venue_ids[start:start + batch_size]),
+                   'start': start,
+                   'state': PENDING,
+                   'attempts': 0,
+                   'worker': None,
+                   'lease_expires': 0}
+            try:
+                self.cache.insert_document(self.collection, job)
+                added += 1
+            except DuplicateDocumentError:
+                pass
+        return added
+
+    def lease(self, worker_id):
+        """
+        Take the next available job: one that is pending, or whose lease has
+        expired. Returns the job document, or None if there is nothing to do.
+        """
+        now = time.time()
+        query = {'queue': self.queue,
+                 'attempts': {'$lt': self.max_attempts},
+                 '$or': [{'state': PENDING},
+                         {'state': LEASED, 'lease_expires': {'$lt': now}}]}
+        update = {'$set': {'state': LEASED, 'worker': worker_id, 'lease_expires': now + self.lease_time},
+                  '$inc': {'attempts': 1}}
+        return self.cache.find_and_modify(self.collection, query, update, sort=[('_id', 1)])
+
+    def heartbeat(self, job, worker_id):
+        """
+        Renew the lease on a job. Returns False if the lease has been lost
+        (it expired and was given to another worker).
+        """
+        query = {'_id': job['_id'], 'state': LEASED, 'worker': worker_id}
+        update = {'$set': {'lease_expires': time.time() + self.lease_time}}
+        return self.cache.update_document(self.collection, query, update) > 0
+
+    def complete(self, job, worker_id):
+        query = {'_id': job['_id'], 'worker': worker_id}
+        return self.cache.update_document(self.collection, query, {'$set': {'state': DONE}}) > 0
+
+    def release(self, job, worker_id):
+        """
+        Give a job back after failing to process it, so it can be retried
+        """
+        query = {'_id': job['_id'], 'state': LEASED, 'worker': worker_id}
+        update = {'$set': {'state': PENDING, 'worker': None, 'lease_expires': 0}}
+        return self.cache.update_document(self.collection, query, update) > 0
+
+    def reap(self):
+        """
+        Mark jobs that have used up all their attempts as failed
+        """
+        query = {'queue': self.queue,
+                 'attempts': {'$gte': self.max_attempts},
+                 '$or': [{'state': PENDING},
+                         {'state': LEASED, 'lease_expires': {'$lt': time.time()}}]}
+        count = 0
+        while self.cache.find_and_modify(self.collection, query, {'$set': {'state': FAILED}}) is not None:
+            count += 1
+        return count
+
+    def counts(self):
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        for job in self.cache.get_documents(self.collection, {'queue': self.queue}, {'state': True}):
+            counts[job['state']] += 1
+        return counts
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renews the lease on a job in the background while it is being worked on
+    """
+
+    def __init__(self, queue, job, worker_id):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.job = job
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # renew well before the lease runs out
+        while not self._stop_event.wait(self.queue.lease_time / 3.0):
+            if not self.queue.heartbeat(self.job, self.worker_id):
+                self.lost = True
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def default_worker_id():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def drain(queue, process_venue, worker_id=None, idle_wait=None):
+    """
+    Lease jobs from the queue and call process_venue(venue_id, position) on
+    every venue id in them, until the queue is empty. position is where the
+    venue was in the list given to enqueue (None for jobs queued without
+    it). If idle_wait is given, keep polling every
+    idle_wait seconds for new work instead of stopping. Returns the number of
+    jobs completed.
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+
+    completed = 0
+    while True:
+        job = queue.lease(worker_id)
+        if job is None:
+            if idle_wait is None:
+                break
+            time.sleep(idle_wait)
+            continue
+
+        heartbeat = Heartbeat(queue, job, worker_id)
+        heartbeat.start()
+        try:
+            start = job.get('start')
+            for offset, venue_id in enumerate(job['venues']):
+                if heartbeat.lost:
+                    break
+                process_venue(venue_id, start + offset if start is not None else None)
+        except Exception:
+            # give the job back to be retried (up to max_attempts)
+            traceback.print_exc()
+            heartbeat.stop()
+            queue.release(job, worker_id)
+            continue
+        heartbeat.stop()
+
+        # if the lease was lost another worker has the job now
+        if not heartbeat.lost and queue.complete(job, worker_id):
+            completed += 1
+
+    return completed